@@ -0,0 +1,477 @@
+"""
+The server's Unix domain socket, and the code that lets several HTTP worker
+processes share one set of controllers.
+
+The GPIO pins, timers and state must have exactly one owner, so the process
+that built the registry (the actuator) keeps them, and the workers it forks
+send it commands over a Unix domain socket. Commands are applied one at a
+time on the actuator's IOLoop, so writes to the hardware stay serialized
+however many workers there are. The actuator pushes each controller's status
+to the workers whenever it changes, so /status/ never has to ask.
+
+The socket is open even without workers, so the scheduler, check_pids and
+other tools on the Pi can use it instead of HTTP (see localclient.py).
+
+The protocol is one JSON object per line in each direction:
+
+    {"id": 1, "ops": [{"op": "station_on", "station": 3, "minutes": 10}]}
+        -> {"id": 1, "response": "ok", "error": null, "results": [...]}
+        The operations are the ones /batch/ takes.
+
+    {"id": 2, "subscribe": true}
+        -> {"id": 2, "response": "ok", "error": null}
+        -> {"snapshot": {"default": {"etag": "...", "status": "..."}}}
+        A snapshot of every controller follows straight away, then one
+        with the controllers that changed each time something does.
+
+    {"id": 3, "call": "status", "controller": "default"}
+        -> {"id": 3, "response": "ok", "error": null, "result": {...}}
+        Runs one of the calls the server registered, like "status",
+        "controllers", "schedule" or "schedule_reload". Any other keys are
+        passed to it.
+
+    {"log": "message", "controller": "default"}
+        Writes a line to a controller's log. There is no reply.
+
+    {"metrics": {...}}
+        A worker's metrics, as metrics.export() returns them. The actuator
+        adds the latest from each worker into /metrics/. There is no reply.
+"""
+import itertools
+import json
+import os
+import signal
+import socket
+import time
+import traceback
+
+import tornado.concurrent
+import tornado.gen
+import tornado.ioloop
+import tornado.iostream
+import tornado.netutil
+import tornado.tcpserver
+
+import clock
+import localclient
+import logwriter
+import metrics
+from events import EventStore
+
+# The longest line either side will read, in bytes
+MAX_MESSAGE_BYTES = 1024 * 1024
+
+# How long a worker keeps trying to reach the actuator when it starts, in seconds
+CONNECT_TIMEOUT = 10
+
+# How often each worker sends its metrics to the actuator, in seconds
+METRICS_INTERVAL = 1.0
+
+
+class ActuatorServer(tornado.tcpserver.TCPServer):
+    """
+    The actuator's end of the socket. `execute(items)` applies a list of
+    operations and returns the response to send back. `calls` maps the name
+    of each call to a function that takes the message and returns the
+    result, or raises a ValueError explaining why it can't.
+    """
+
+    def __init__(self, registry, execute, ioloop, calls=None):
+        tornado.tcpserver.TCPServer.__init__(self, io_loop=ioloop, max_buffer_size=MAX_MESSAGE_BYTES)
+        self.registry = registry
+        self.execute = execute
+        self.ioloop = ioloop
+        self.calls = calls or {}
+
+        self.subscribers = set()
+
+        # connection -> the metrics it last sent, for the workers
+        self.metrics = {}
+
+        # Controller ids that have changed since the last snapshot was pushed
+        self._dirty = set()
+
+        for sprinkler in registry:
+            sprinkler.listeners.append(self._state_changed)
+
+    def listen_unix(self, path, mode=0o600):
+        self.add_socket(tornado.netutil.bind_unix_socket(path, mode=mode))
+
+    def handle_stream(self, stream, address):
+        ActuatorConnection(self, stream).start()
+
+    def call(self, message):
+        """
+        Runs a call and returns the reply.
+        """
+        reply = {'id': message.get('id')}
+        function = self.calls.get(message['call'])
+        if function is None:
+            reply.update(response='error', error='Unknown call: %s' % message['call'])
+            return reply
+
+        try:
+            reply.update(response='ok', error=None, result=function(message))
+        except ValueError, e:
+            reply.update(response='error', error=str(e))
+        return reply
+
+    def worker_metrics(self):
+        """
+        Returns the latest metrics from every worker that is connected, to
+        pass to metrics.render().
+        """
+        return self.metrics.values()
+
+    ### Snapshots ###
+
+    def snapshot(self, controller_ids):
+        snapshot = {}
+        for controller_id in controller_ids:
+            etag, body = self.registry.get(controller_id).status_snapshot()
+            snapshot[controller_id] = {'etag': etag, 'status': body}
+        return snapshot
+
+    def subscribe(self, connection):
+        connection.send({'snapshot': self.snapshot(sprinkler.controller_id for sprinkler in self.registry)})
+        self.subscribers.add(connection)
+
+    def _state_changed(self, sprinkler):
+        if not self._dirty:
+            self.ioloop.add_callback(self.publish)
+        self._dirty.add(sprinkler.controller_id)
+
+    def publish(self):
+        """
+        Pushes a snapshot of the controllers that have changed, if any.
+        """
+        dirty, self._dirty = self._dirty, set()
+        if not dirty or not self.subscribers:
+            return
+
+        message = {'snapshot': self.snapshot(dirty)}
+        for connection in list(self.subscribers):
+            connection.send(message)
+
+
+class ActuatorConnection():
+    """
+    One client connected to the actuator.
+    """
+
+    def __init__(self, server, stream):
+        self.server = server
+        self.stream = stream
+
+    def start(self):
+        self.stream.set_close_callback(self._closed)
+        self._read()
+
+    def send(self, message):
+        if not self.stream.closed():
+            self.stream.write(json.dumps(message) + '\n')
+
+    def _read(self):
+        if not self.stream.closed():
+            self.stream.read_until('\n', self._received, max_bytes=MAX_MESSAGE_BYTES)
+
+    def _received(self, line):
+        try:
+            message = json.loads(line)
+            if not isinstance(message, dict):
+                raise ValueError
+        except ValueError:
+            self.send({'response': 'error', 'error': 'Messages must be JSON objects'})
+            self._read()
+            return
+
+        if 'ops' in message:
+            try:
+                response = self.server.execute(message['ops'])
+            except ValueError, e:
+                response = {'response': 'error', 'error': str(e)}
+            except Exception, e:
+                # Some operations may have been applied, so the reply and the
+                # new state still go out, and the connection carries on
+                traceback.print_exc()
+                response = {'response': 'error', 'error': 'Could not apply the operations: %s' % e}
+            response['id'] = message.get('id')
+
+            # Push the new state first, so whoever sent the command sees it
+            # as soon as they have the reply
+            self.server.publish()
+            self.send(response)
+
+        elif 'call' in message:
+            self.send(self.server.call(message))
+
+        elif message.get('subscribe'):
+            self.send({'id': message.get('id'), 'response': 'ok', 'error': None})
+            self.server.subscribe(self)
+
+        elif 'log' in message:
+            sprinkler = self.server.registry.get(message.get('controller'))
+            if sprinkler is not None:
+                sprinkler.log(message['log'])
+
+        elif isinstance(message.get('metrics'), dict):
+            self.server.metrics[self] = message['metrics']
+
+        else:
+            self.send({'id': message.get('id'), 'response': 'error', 'error': 'Unknown message'})
+
+        self._read()
+
+    def _closed(self):
+        self.server.subscribers.discard(self)
+        self.server.metrics.pop(self, None)
+
+
+class ActuatorClient():
+    """
+    A worker's connection to the actuator. Keeps the latest status of every
+    controller as the actuator pushes it.
+    """
+
+    def __init__(self, path, ioloop):
+        self.path = path
+        self.ioloop = ioloop
+
+        self.stream = None
+        self.ids = itertools.count(1)
+        self.pending = {}
+
+        # (etag, body) for each controller id
+        self.snapshots = {}
+
+        # Called with no arguments if the connection to the actuator is lost
+        self.on_close = None
+
+    @tornado.gen.coroutine
+    def connect(self):
+        """
+        Connects and subscribes to the snapshots. The actuator might still be
+        starting, so this keeps trying for CONNECT_TIMEOUT seconds.
+        """
+        deadline = time.time() + CONNECT_TIMEOUT
+        while True:
+            stream = tornado.iostream.IOStream(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM),
+                io_loop=self.ioloop, max_buffer_size=MAX_MESSAGE_BYTES)
+            try:
+                yield stream.connect(self.path)
+                break
+            except (socket.error, tornado.iostream.StreamClosedError):
+                if time.time() > deadline:
+                    raise
+                yield tornado.gen.sleep(0.1)
+
+        self.stream = stream
+        self.stream.set_close_callback(self._closed)
+        self._read()
+
+        # The first snapshot arrives straight after the reply
+        yield self._request({'subscribe': True})
+        while not self.snapshots:
+            yield tornado.gen.moment
+
+    def execute(self, items):
+        """
+        Sends a list of operations. Returns a Future that resolves to the
+        actuator's response (the same as a /batch/ response).
+        """
+        return self._request({'ops': items})
+
+    def log(self, controller_id, message):
+        self._send({'log': message, 'controller': controller_id})
+
+    def send_metrics(self):
+        """
+        Sends this process's metrics, for the actuator's /metrics/.
+        """
+        if not self.stream.closed():
+            self._send({'metrics': metrics.export()})
+
+    def _request(self, message):
+        message['id'] = next(self.ids)
+        future = tornado.concurrent.Future()
+        self.pending[message['id']] = future
+        self._send(message)
+        return future
+
+    def _send(self, message):
+        self.stream.write(json.dumps(message) + '\n')
+
+    def _read(self):
+        if not self.stream.closed():
+            self.stream.read_until('\n', self._received, max_bytes=MAX_MESSAGE_BYTES)
+
+    def _received(self, line):
+        message = json.loads(line)
+        if 'snapshot' in message:
+            for controller_id, snapshot in message['snapshot'].items():
+                self.snapshots[controller_id] = (snapshot['etag'], snapshot['status'])
+        else:
+            future = self.pending.pop(message.pop('id', None), None)
+            if future is not None:
+                future.set_result(message)
+        self._read()
+
+    def _closed(self):
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            future.set_exception(tornado.iostream.StreamClosedError())
+        if self.on_close is not None:
+            self.on_close()
+
+
+### Worker Side ###
+
+class RemoteLog():
+    """
+    Stands in for a controller's LogWriter in a worker. The actuator writes
+    the log; a worker only needs to know where it is.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def flush(self):
+        # Lines the actuator hasn't written yet show up within a second
+        pass
+
+
+class RemoteController():
+    """
+    What a worker knows about one of the actuator's controllers: enough for
+    the handlers to check requests, read the log and events, and serve the
+    status the actuator last pushed.
+    """
+
+    def __init__(self, client, controller_id, number_of_stations, master_station,
+                 max_concurrency, log_path, events_path):
+        self.client = client
+        self.controller_id = controller_id
+        self.number_of_stations = number_of_stations
+        self.master_station = master_station
+        self.max_concurrency = max_concurrency
+        self.logger = RemoteLog(log_path)
+        self.events = EventStore(events_path)
+
+    @classmethod
+    def describe(cls, sprinkler):
+        """
+        The arguments (after the client) to build a RemoteController that
+        mirrors an OpenSprinkler.
+        """
+        return (sprinkler.controller_id, sprinkler.number_of_stations, sprinkler.master_station,
+            sprinkler.max_concurrency, sprinkler.logger.path, sprinkler.events.path)
+
+    def status_snapshot(self):
+        return self.client.snapshots[self.controller_id]
+
+    def log(self, message):
+        now_time = clock.now().strftime('%Y-%m-%d %H:%M:%S')
+        print '%s\t\t%s' % (now_time, message)
+        self.client.log(self.controller_id, message)
+
+
+class RemoteRegistry():
+    """
+    A worker's view of the actuator's ControllerRegistry.
+    """
+
+    def __init__(self, controllers):
+        self.controllers = dict((controller.controller_id, controller) for controller in controllers)
+        self.order = [controller.controller_id for controller in controllers]
+
+    def __iter__(self):
+        return (self.controllers[controller_id] for controller_id in self.order)
+
+    def __len__(self):
+        return len(self.order)
+
+    def get(self, controller_id=None):
+        if controller_id is None:
+            controller_id = self.order[0]
+        return self.controllers.get(controller_id)
+
+    @property
+    def max_stations(self):
+        return max(controller.number_of_stations for controller in self)
+
+
+class WorkerPool():
+    """
+    Forks `count` worker processes, each of which calls `run()`, and starts
+    a new one whenever one dies. Workers must not touch the hardware or
+    anything else the actuator owns, including its threads and executors:
+    the workers are forked after those have started, so each one gets new
+    locks and log writers before `run()`, and has to make its own executors.
+    """
+
+    def __init__(self, count, run, ioloop, log):
+        self.count = count
+        self.run = run
+        self.ioloop = ioloop
+        self.log = log
+
+        self.pids = set()
+        self._checker = None
+
+    def start(self):
+        for _ in range(self.count):
+            self._spawn()
+        self._checker = tornado.ioloop.PeriodicCallback(self._check, 1000, io_loop=self.ioloop)
+        self._checker.start()
+
+    def stop(self):
+        """
+        Stops the workers. This is registered to run at exit.
+        """
+        if self._checker is not None:
+            self._checker.stop()
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self.pids = set()
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid:
+            self.pids.add(pid)
+            return
+
+        # In the worker. It must never return into the actuator's code or run
+        # its exit handlers, which would turn the stations off.
+        status = 0
+        try:
+            # Only this thread came across. The actuator's log writers and
+            # executor threads did not, and any lock one of them held when we
+            # forked (like a metric's) would stay locked here for good, so
+            # start over with new ones. run() makes its own executors.
+            metrics.after_fork()
+            logwriter.after_fork()
+            localclient.after_fork()
+
+            self.run()
+        except KeyboardInterrupt:
+            pass
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        finally:
+            os._exit(status)
+
+    def _check(self):
+        for pid in list(self.pids):
+            try:
+                finished, status = os.waitpid(pid, os.WNOHANG)
+            except OSError:
+                finished = pid
+            if finished:
+                self.pids.discard(pid)
+                self.log('Worker process %d exited. Starting a new one.' % pid)
+                self._spawn()
@@ -0,0 +1,312 @@
+"""
+Benchmarks the server end to end. The application from server.py is run
+in-process on an unused port, driving controllers on MockGPIO in a temporary
+directory, and exercised over HTTP:
+
+    * status polling throughput, with and without the ETag
+    * history reads against synthetic logs of 10k, 1M and 10M lines
+    * latency of station on and off commands
+    * delay churn across many stations, one request at a time and batched
+    * shift register updates for 8 to 256 stations (bench_shift_register.py)
+
+Run it from anywhere:
+
+    $ python benchmarks/bench_server.py > before.json
+
+Prints the results as JSON, along with the commit that was benchmarked, so
+two runs can be compared. Use --quick to skip the 10M line log, which takes
+a while to generate.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+CUR_DIR = os.path.dirname(os.path.realpath(__file__))
+PARENT_DIR = os.path.abspath(os.path.join(CUR_DIR, os.pardir))
+
+# Add the parent dir to the search path so we can import the server
+sys.path.insert(0, PARENT_DIR)
+
+import tornado.gen
+import tornado.httpclient
+import tornado.httpserver
+import tornado.ioloop
+import tornado.testing
+
+# The demo mode notice is printed on import; keep it out of the JSON
+stdout, sys.stdout = sys.stdout, sys.stderr
+from controllers import ControllerRegistry
+from history import HistoryReader
+from runqueue import RunQueue
+from sprinkler import OpenSprinkler
+from stream import StreamHub
+import bench_shift_register
+import server
+sys.stdout = stdout
+
+# Stations on the controller used for the HTTP benchmarks
+NUMBER_OF_STATIONS = 64
+
+HISTORY_SIZES = [10000, 1000000, 10000000]
+QUICK_HISTORY_SIZES = [10000, 1000000]
+
+STATUS_REQUESTS = 2000
+STATUS_CONCURRENCY = 10
+HISTORY_REQUESTS = 200
+COMMAND_REQUESTS = 500
+DELAY_ROUNDS = 20
+
+
+def percentiles(samples):
+    """
+    Summarises a list of latencies (in seconds) in milliseconds.
+    """
+    samples = sorted(samples)
+    def at(fraction):
+        return samples[min(len(samples) - 1, int(len(samples) * fraction))] * 1000
+    return {
+        'count': len(samples),
+        'mean_ms': sum(samples) / len(samples) * 1000,
+        'p50_ms': at(0.50),
+        'p90_ms': at(0.90),
+        'p99_ms': at(0.99),
+        'max_ms': samples[-1] * 1000,
+    }
+
+
+def write_log(path, lines):
+    """
+    Writes a synthetic log.txt with one line per second, oldest first.
+    """
+    start = int(time.mktime((2015, 1, 1, 0, 0, 0, 0, 0, -1)))
+    with open(path, 'w') as f:
+        for minute in xrange(0, (lines + 59) // 60):
+            prefix = time.strftime('%Y-%m-%d %H:%M:', time.localtime(start + minute * 60))
+            count = min(60, lines - minute * 60)
+            f.write(''.join('%s%02d\t\tOperating station %d for %d minutes.\n' % (prefix, second,
+                (minute + second) % 8 + 1, second % 30 + 1) for second in xrange(count)))
+
+
+class Harness():
+    """
+    The application running in-process against a registry of controllers,
+    and an HTTP client to poke it with.
+    """
+
+    def __init__(self, registry, schedule_path):
+        self.registry = registry
+        self.ioloop = tornado.ioloop.IOLoop.instance()
+
+        for sprinkler in registry:
+            sprinkler.ioloop = self.ioloop
+            sprinkler.timeouts = {}
+            sprinkler.delays.attach(self.ioloop)
+            sprinkler.usage.attach(self.ioloop)
+            sprinkler.run_queue = RunQueue(sprinkler, self.ioloop, server.run_station)
+
+        schedule = server.ScheduleService(schedule_path, lambda event: None, self.ioloop)
+        app = server.make_app(registry, schedule, StreamHub(registry, self.ioloop))
+
+        sock, self.port = tornado.testing.bind_unused_port()
+        self.server = tornado.httpserver.HTTPServer(app)
+        self.server.add_sockets([sock])
+
+        self.client = tornado.httpclient.AsyncHTTPClient(max_clients=STATUS_CONCURRENCY)
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.port, path)
+
+    @tornado.gen.coroutine
+    def timed(self, path, method='GET', body=None, headers=None):
+        if method == 'POST' and body is None:
+            body = ''
+        start = time.time()
+        response = yield self.client.fetch(self.url(path), method=method, body=body,
+            headers=headers, raise_error=False)
+        raise tornado.gen.Return((time.time() - start, response))
+
+    def run(self, func, *args):
+        return self.ioloop.run_sync(lambda: func(*args), timeout=3600)
+
+    def close(self):
+        self.server.stop()
+        self.client.close()
+
+
+### Benchmarks ###
+
+@tornado.gen.coroutine
+def bench_status(harness):
+    """
+    Requests per second for /status/ with STATUS_CONCURRENCY requests in
+    flight, first as a plain poll and then sending the ETag back.
+    """
+    results = {}
+
+    elapsed, response = yield harness.timed('/status/')
+    etag = response.headers['Etag']
+
+    for name, headers in [('full', None), ('etag_304', {'If-None-Match': etag})]:
+        latencies = []
+        start = time.time()
+        for _ in range(STATUS_REQUESTS // STATUS_CONCURRENCY):
+            responses = yield [harness.timed('/status/', headers=headers)
+                for _ in range(STATUS_CONCURRENCY)]
+            latencies.extend(elapsed for elapsed, response in responses)
+        results[name] = percentiles(latencies)
+        results[name]['requests_per_second'] = STATUS_REQUESTS / (time.time() - start)
+
+    raise tornado.gen.Return(results)
+
+
+@tornado.gen.coroutine
+def bench_history(harness, sprinkler):
+    """
+    /history/ latency for the newest page, a page from the middle of the log
+    (by offset) and a page found by timestamp.
+    """
+    url = '/controller/%s/history/' % sprinkler.controller_id
+    size = os.path.getsize(sprinkler.logger.path)
+
+    # Building the index reads the whole log once
+    start = time.time()
+    HistoryReader(sprinkler.logger.path).update_index()
+    results = {'log_bytes': size, 'index_build_seconds': time.time() - start}
+
+    # Find an entry about halfway through the log to page back from
+    elapsed, response = yield harness.timed('%s?limit=1' % url)
+    middle = json.loads(response.body)[0]['offset'] // 2
+    elapsed, response = yield harness.timed('%s?limit=1&before=%d' % (url, middle))
+    timestamp = json.loads(response.body)[0]['date']
+
+    for name, path in [('newest', url), ('by_offset', '%s?before=%d' % (url, middle)),
+                       ('by_timestamp', '%s?before=%s' % (url, timestamp.replace(' ', '%20')))]:
+        latencies = []
+        for _ in range(HISTORY_REQUESTS):
+            elapsed, response = yield harness.timed(path)
+            latencies.append(elapsed)
+        results[name] = percentiles(latencies)
+
+    raise tornado.gen.Return(results)
+
+
+@tornado.gen.coroutine
+def bench_commands(harness):
+    """
+    Latency of turning stations on and off, one request at a time.
+    """
+    on = []
+    off = []
+    for i in range(COMMAND_REQUESTS):
+        station = i % NUMBER_OF_STATIONS + 1
+        elapsed, response = yield harness.timed('/station/%d/on/5/' % station, method='POST')
+        on.append(elapsed)
+        elapsed, response = yield harness.timed('/station/%d/off/' % station, method='POST')
+        off.append(elapsed)
+    raise tornado.gen.Return({'on': percentiles(on), 'off': percentiles(off)})
+
+
+@tornado.gen.coroutine
+def bench_delays(harness):
+    """
+    Creating and removing a delay on every station, DELAY_ROUNDS times, first
+    with one request per change and then with one /batch/ per round.
+    """
+    results = {}
+
+    start = time.time()
+    for round in range(DELAY_ROUNDS):
+        for station in range(1, NUMBER_OF_STATIONS + 1):
+            yield harness.timed('/delay/%d/create/%d/' % (station, round + 1), method='POST')
+        for station in range(1, NUMBER_OF_STATIONS + 1):
+            yield harness.timed('/delay/%d/remove/' % station, method='POST')
+    changes = DELAY_ROUNDS * NUMBER_OF_STATIONS * 2
+    results['single'] = {'changes_per_second': changes / (time.time() - start)}
+
+    start = time.time()
+    for round in range(DELAY_ROUNDS):
+        creates = [{'op': 'delay_create', 'station': station, 'hours': round + 1}
+            for station in range(1, NUMBER_OF_STATIONS + 1)]
+        removes = [{'op': 'delay_remove', 'station': station}
+            for station in range(1, NUMBER_OF_STATIONS + 1)]
+        yield harness.timed('/batch/', method='POST', body=json.dumps(creates + removes))
+    results['batch'] = {'changes_per_second': changes / (time.time() - start)}
+
+    raise tornado.gen.Return(results)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=PARENT_DIR).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(history_sizes):
+    work_dir = tempfile.mkdtemp(prefix='neptune-bench-')
+
+    # The controllers print every line they log; keep that out of the results
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+
+    try:
+        results = {}
+
+        # One controller per synthetic log, plus one for the commands
+        registry = ControllerRegistry()
+        registry.add(OpenSprinkler(number_of_stations=NUMBER_OF_STATIONS,
+            state_dir=os.path.join(work_dir, 'default')))
+        for lines in history_sizes:
+            state_dir = os.path.join(work_dir, 'history-%d' % lines)
+            os.makedirs(state_dir)
+            write_log(os.path.join(state_dir, 'log.txt'), lines)
+            registry.add(OpenSprinkler(number_of_stations=NUMBER_OF_STATIONS,
+                controller_id='history-%d' % lines, state_dir=state_dir))
+
+        harness = Harness(registry, os.path.join(work_dir, 'schedule.json'))
+        try:
+            results['status'] = harness.run(bench_status, harness)
+            results['commands'] = harness.run(bench_commands, harness)
+            results['delays'] = harness.run(bench_delays, harness)
+
+            results['history'] = {}
+            for lines in history_sizes:
+                sprinkler = registry.get('history-%d' % lines)
+                sprinkler.logger.flush()
+                results['history'][str(lines)] = harness.run(bench_history, harness, sprinkler)
+        finally:
+            harness.close()
+            registry.cleanup()
+
+        results['shift_register'] = [bench_shift_register.benchmark(n)
+            for n in bench_shift_register.STATION_COUNTS]
+
+        return results
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--quick', action='store_true', default=False,
+        help='skip the 10M line history log')
+    args = parser.parse_args()
+
+    history_sizes = QUICK_HISTORY_SIZES if args.quick else HISTORY_SIZES
+
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'timestamp': int(time.time()),
+        'results': run_benchmarks(history_sizes),
+    }
+    print json.dumps(report, indent=2, sort_keys=True)
@@ -0,0 +1,94 @@
+"""
+Counts GPIO calls per shift register update, comparing the bit-packed driver
+against the old one-call-per-pin-per-station loop. Runs against MockGPIO, so it
+can be run anywhere:
+
+    $ python benchmarks/bench_shift_register.py
+
+Prints the results as JSON.
+"""
+import json
+import os
+import random
+import sys
+import time
+
+CUR_DIR = os.path.dirname(os.path.realpath(__file__))
+PARENT_DIR = os.path.abspath(os.path.join(CUR_DIR, os.pardir))
+
+# Add the parent dir to the search path so we can import the driver
+sys.path.insert(0, PARENT_DIR)
+import shiftregister
+from shiftregister import ShiftRegisterDriver
+
+STATION_COUNTS = [8, 16, 32, 64, 128, 256]
+UPDATES = 1000
+
+
+class CountingGPIO():
+    """
+    Wraps the GPIO module and counts calls to output().
+    """
+
+    def __init__(self, gpio):
+        self.gpio = gpio
+        self.calls = 0
+
+    def __getattr__(self, name):
+        return getattr(self.gpio, name)
+
+    def output(self, pin, value):
+        self.calls += 1
+        self.gpio.output(pin, value)
+
+
+def legacy_calls(number_of_stations):
+    """
+    The old _set_shift_registers made 3 calls per station plus 3 for the clock
+    and latch, every time it was called.
+    """
+    return 3 * number_of_stations + 3
+
+
+def run_updates(driver, gpio, updates):
+    """
+    Applies a list of bitmasks and returns (calls per update, seconds per update).
+    """
+    gpio.calls = 0
+    start = time.time()
+    for bits in updates:
+        driver.write(bits)
+    elapsed = time.time() - start
+    return float(gpio.calls) / len(updates), elapsed / len(updates)
+
+
+def benchmark(number_of_stations):
+    gpio = CountingGPIO(shiftregister.GPIO)
+    shiftregister.GPIO = gpio
+    try:
+        driver = ShiftRegisterDriver(number_of_stations, clock_pin=4, latch_pin=22,
+            data_pin=27, enable_pin=17)
+        driver.write(0, force=True)
+
+        random.seed(number_of_stations)
+        scenarios = {
+            # Repeating the current state (e.g. a stop on an idle controller)
+            'unchanged': [0] * UPDATES,
+            # One station on at a time, like a program stepping through zones
+            'single_station': [1 << random.randrange(number_of_stations) for _ in range(UPDATES)],
+            # Random patterns, the worst case for the data pin
+            'random': [random.getrandbits(number_of_stations) for _ in range(UPDATES)],
+        }
+
+        results = {'stations': number_of_stations, 'legacy_calls_per_update': legacy_calls(number_of_stations)}
+        for name, updates in sorted(scenarios.items()):
+            driver.write(0)
+            calls, seconds = run_updates(driver, gpio, updates)
+            results[name] = {'calls_per_update': calls, 'usec_per_update': seconds * 1e6}
+        return results
+    finally:
+        shiftregister.GPIO = gpio.gpio
+
+
+if __name__ == "__main__":
+    print json.dumps([benchmark(n) for n in STATION_COUNTS], indent=2, sort_keys=True)
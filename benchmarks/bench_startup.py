@@ -0,0 +1,142 @@
+"""
+Measures how long it takes to get going, which is what the tools run from
+cron pay for on every run:
+
+    * cold start of a fresh interpreter importing each entry point (the
+      sprinkler module, check_pids, the scheduler, the local client and the
+      server), along with whether arrow and tornado got loaded
+    * building an OpenSprinkler with and without setting up the hardware,
+      counting the GPIO calls it makes on MockGPIO
+
+Run it from anywhere:
+
+    $ python benchmarks/bench_startup.py > after.json
+
+Prints the results as JSON, along with the commit that was benchmarked, so
+two runs can be compared.
+"""
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+CUR_DIR = os.path.dirname(os.path.realpath(__file__))
+PARENT_DIR = os.path.abspath(os.path.join(CUR_DIR, os.pardir))
+
+# Add the parent dir to the search path so we can build controllers
+sys.path.insert(0, PARENT_DIR)
+
+# The demo mode notice is printed on import; keep it out of the JSON
+stdout, sys.stdout = sys.stdout, sys.stderr
+import shiftregister
+import sprinkler
+from sprinkler import OpenSprinkler
+from bench_shift_register import CountingGPIO
+sys.stdout = stdout
+
+# How many times each entry point is started
+COLD_STARTS = 20
+
+# What each entry point imports, run from the code directory
+ENTRY_POINTS = [
+    ('python', ''),
+    ('sprinkler', 'import sprinkler'),
+    ('check_pids', 'sys.path.insert(0, "utilities"); import check_pids'),
+    ('scheduler', 'import scheduler.scheduler'),
+    ('localclient', 'import localclient'),
+    ('server', 'import server'),
+]
+
+# Reports what got loaded as the last line of output
+REPORT = 'import json; print json.dumps([len(sys.modules), "arrow" in sys.modules, "tornado" in sys.modules])'
+
+STATION_COUNTS = [8, 64]
+CONTROLLERS = 50
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=PARENT_DIR).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def cold_start(code):
+    """
+    Starts a fresh interpreter COLD_STARTS times and summarises the wall
+    time in milliseconds.
+    """
+    script = 'import sys; %s; %s' % (code, REPORT) if code else 'import sys; %s' % REPORT
+    samples = []
+    for _ in range(COLD_STARTS):
+        start = time.time()
+        output = subprocess.check_output([sys.executable, '-c', script], cwd=PARENT_DIR)
+        samples.append(time.time() - start)
+
+    modules, arrow, tornado = json.loads(output.strip().splitlines()[-1])
+    samples.sort()
+    return {
+        'mean_ms': sum(samples) / len(samples) * 1000,
+        'min_ms': samples[0] * 1000,
+        'p50_ms': samples[len(samples) // 2] * 1000,
+        'modules': modules,
+        'imports_arrow': arrow,
+        'imports_tornado': tornado,
+    }
+
+
+def build_controllers(number_of_stations, initialize_hardware):
+    """
+    Builds CONTROLLERS controllers, each in a fresh state directory, and
+    reports the time and GPIO calls per controller.
+    """
+    work_dir = tempfile.mkdtemp(prefix='neptune-bench-')
+    gpio = CountingGPIO(shiftregister.GPIO)
+    shiftregister.GPIO = sprinkler.GPIO = gpio
+
+    # The controllers print every line they log; keep that out of the results
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        elapsed = 0
+        for number in range(CONTROLLERS):
+            state_dir = os.path.join(work_dir, str(number))
+            start = time.time()
+            OpenSprinkler(number_of_stations=number_of_stations, state_dir=state_dir,
+                initialize_hardware=initialize_hardware)
+            elapsed += time.time() - start
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        shiftregister.GPIO = sprinkler.GPIO = gpio.gpio
+        shutil.rmtree(work_dir)
+
+    return {
+        'stations': number_of_stations,
+        'initialize_hardware': initialize_hardware,
+        'mean_ms': elapsed / CONTROLLERS * 1000,
+        'gpio_calls': gpio.calls // CONTROLLERS,
+    }
+
+
+def run_benchmarks():
+    results = {}
+    results['cold_start'] = dict((name, cold_start(code)) for name, code in ENTRY_POINTS)
+    results['controller'] = [build_controllers(stations, initialize_hardware)
+        for stations in STATION_COUNTS for initialize_hardware in (True, False)]
+    return results
+
+
+if __name__ == "__main__":
+
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'timestamp': int(time.time()),
+        'results': run_benchmarks(),
+    }
+    print json.dumps(report, indent=2, sort_keys=True)
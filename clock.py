@@ -0,0 +1,34 @@
+"""
+Where the controllers, the schedule and the timers get the time from.
+
+Normally that's the system clock. simulation.py points it at a virtual clock
+instead, so weeks of schedules can be played out in seconds; everything that
+starts, stops, expires or records a run asks this module rather than calling
+time.time() or datetime.now() itself.
+"""
+import datetime
+import time as _time
+
+_source = _time.time
+
+
+def time():
+    """
+    The current time in epoch seconds.
+    """
+    return _source()
+
+
+def now():
+    """
+    The current local time as a datetime.
+    """
+    return datetime.datetime.fromtimestamp(_source())
+
+
+def set_source(source=None):
+    """
+    Makes `source()` the clock. With no source, goes back to the system clock.
+    """
+    global _source
+    _source = source or _time.time
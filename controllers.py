@@ -0,0 +1,169 @@
+import json
+import os
+import re
+import sys
+
+from shiftregister import GPIO, resolve_pins
+from sprinkler import CUR_DIR, OpenSprinkler
+
+# Optional file describing the boards this server drives. Without it there is
+# a single controller called 'default'.
+CONFIG_FILE_PATH = os.path.join(CUR_DIR, 'controllers.json')
+
+# Controllers other than 'default' keep their state under this directory
+CONTROLLERS_DIR = os.path.join(CUR_DIR, 'controllers')
+
+
+class ControllerRegistry():
+    """
+    Maps controller ids to OpenSprinkler instances so one server can drive
+    several boards. The first controller added is the default one, which is
+    what the URLs without a /controller/<id> prefix operate on.
+    """
+
+    def __init__(self):
+        self.controllers = {}
+        self.order = []
+
+    def __iter__(self):
+        return (self.controllers[controller_id] for controller_id in self.order)
+
+    def __len__(self):
+        return len(self.order)
+
+    def add(self, sprinkler):
+        if sprinkler.controller_id in self.controllers:
+            raise ValueError('Duplicate controller id: %s' % sprinkler.controller_id)
+        self.controllers[sprinkler.controller_id] = sprinkler
+        self.order.append(sprinkler.controller_id)
+
+    def get(self, controller_id=None):
+        """
+        Returns the controller with the id, or the default controller if the
+        id is None. Returns None for an unknown id.
+        """
+        if controller_id is None:
+            controller_id = self.order[0]
+        return self.controllers.get(controller_id)
+
+    @property
+    def max_stations(self):
+        return max(sprinkler.number_of_stations for sprinkler in self)
+
+    def cleanup(self):
+        """
+        Turns off every controller, then runs GPIO cleanup once. Controllers
+        opened read-only never set up the pins, so they are left alone.
+        """
+        for sprinkler in self:
+            sprinkler.cleanup(gpio_cleanup=False)
+        if any(not sprinkler.readonly for sprinkler in self):
+            GPIO.cleanup()
+
+    @classmethod
+    def load(cls, debug=False, number_of_stations=8, config_path=CONFIG_FILE_PATH,
+             max_concurrency=1, master_station=None, flow_rates=None, initialize_hardware=True,
+             state_root=None):
+        """
+        Builds the registry from controllers.json, which is a list like:
+
+            [
+                {"id": "front", "stations": 16},
+                {"id": "back", "stations": 8, "max_concurrency": 2, "master_station": 8,
+                 "max_runtimes": {"3": 10}, "flow_rates": {"1": 2.5, "2": 4},
+                 "pins": {"clock": 5, "enable": 6, "latch": 13, "data": 19}}
+            ]
+
+        `max_runtimes` caps how many minutes a station can run for before the
+        watchdog stops it. `flow_rates` is how much water a station uses per
+        minute, for the usage totals.
+
+        If the file doesn't exist, there is one controller called 'default'
+        with number_of_stations stations on the standard pins. Controllers
+        that don't give max_concurrency, master_station or flow_rates use the
+        values passed in.
+
+        Pass initialize_hardware=False to open the controllers read-only, for
+        looking at the state a running server keeps: the GPIO pins aren't set
+        up, no file is created or changed, and anything that would change a
+        controller raises RuntimeError.
+
+        With a state_root, every controller keeps its files in a directory
+        named after its id under it, rather than in the usual places.
+        """
+        registry = cls()
+
+        if not os.path.exists(config_path):
+            state_dir = os.path.join(state_root, 'default') if state_root is not None else CUR_DIR
+            registry.add(OpenSprinkler(debug=debug, number_of_stations=number_of_stations,
+                state_dir=state_dir, max_concurrency=max_concurrency, master_station=master_station,
+                flow_rates=flow_rates, initialize_hardware=initialize_hardware))
+            return registry
+
+        try:
+            with open(config_path, 'r') as f:
+                config = json.load(f)
+        except ValueError:
+            sys.exit("Error in %s syntax. Invalid JSON." % config_path)
+
+        # GPIO pin -> (controller id, pin name), so no two boards share a pin
+        used_pins = {}
+
+        for item in config:
+            try:
+                controller_id = item['id']
+                stations = item.get('stations', number_of_stations)
+                pins = item.get('pins')
+                concurrency = item.get('max_concurrency', max_concurrency)
+                master = item.get('master_station', master_station)
+                max_runtimes = dict((int(station), int(minutes))
+                    for station, minutes in item.get('max_runtimes', {}).items())
+                rates = flow_rates
+                if 'flow_rates' in item:
+                    rates = dict((int(station), float(rate))
+                        for station, rate in item['flow_rates'].items())
+            except (KeyError, TypeError, AttributeError, ValueError), e:
+                sys.exit('Error reading %s. Missing or invalid key: %s' % (config_path, e))
+
+            # The id is used in URLs and directory names
+            if not re.match(r'^[\w-]+$', controller_id):
+                sys.exit('Error reading %s. Invalid controller id: %s' % (config_path, controller_id))
+
+            if not isinstance(concurrency, int) or concurrency < 1:
+                sys.exit('Error reading %s. Invalid max_concurrency for %s: %s' % (config_path,
+                    controller_id, concurrency))
+
+            if master is not None and not (isinstance(master, int) and 1 <= master <= stations):
+                sys.exit('Error reading %s. Invalid master_station for %s: %s' % (config_path,
+                    controller_id, master))
+
+            # Two controllers on the same pins would drive the same shift
+            # registers, and each driver would skip writes it thinks the
+            # registers already hold. Boards left on the standard pins count.
+            if pins is not None and not isinstance(pins, dict):
+                sys.exit('Error reading %s. Invalid pins for %s: %s' % (config_path, controller_id, pins))
+            for name, pin in sorted(resolve_pins(pins).items()):
+                if pin in used_pins:
+                    other_id, other_name = used_pins[pin]
+                    sys.exit('Error reading %s. Controller %s uses pin %s for %s, which controller %s '
+                        'already uses for %s. Give each board its own "pins".' % (config_path,
+                        controller_id, pin, name, other_id, other_name))
+                used_pins[pin] = (controller_id, name)
+
+            # The 'default' controller keeps its files where they always were
+            if state_root is not None:
+                state_dir = os.path.join(state_root, controller_id)
+            elif controller_id == 'default':
+                state_dir = CUR_DIR
+            else:
+                state_dir = os.path.join(CONTROLLERS_DIR, controller_id)
+
+            registry.add(OpenSprinkler(debug=debug, number_of_stations=stations,
+                controller_id=controller_id, state_dir=state_dir, pins=pins,
+                max_concurrency=concurrency, master_station=master, max_runtimes=max_runtimes,
+                flow_rates=rates, initialize_hardware=initialize_hardware))
+
+        if not len(registry):
+            sys.exit('Error reading %s. No controllers defined.' % config_path)
+
+        return registry
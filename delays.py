@@ -0,0 +1,248 @@
+import heapq
+import os
+
+import clock
+
+# The journal is rewritten with just the delays in effect once it holds this
+# many records for every delay, so it can't grow without limit on a server
+# that runs for months...
+COMPACT_RATIO = 4
+
+# ...though a journal this short is always left to grow
+COMPACT_MIN_RECORDS = 64
+
+
+class DelayManager():
+    """
+    Keeps station delays in memory, ordered by expiration in a min-heap.
+    Every change is appended to a small journal file which is replayed (and
+    compacted) when the manager starts up, and compacted again whenever it
+    has grown well past the number of delays.
+
+    A read-only manager (for tools that look at a running server's state)
+    replays the journal but never writes to it.
+
+    Expirations are epoch seconds. If an IOLoop is attached, delays are
+    expired by a timer as soon as they run out; otherwise they are expired
+    when they are next looked at.
+    """
+
+    def __init__(self, journal_path, on_expire=None, readonly=False):
+        self.journal_path = journal_path
+        self.readonly = readonly
+
+        # Called with the station number whenever a delay runs out
+        self.on_expire = on_expire
+
+        # station -> expiration. This is the authority; the heap can hold
+        # stale entries for delays that were replaced or removed, and those
+        # are skipped when they reach the top.
+        self.expirations = {}
+        self.heap = []
+
+        self.ioloop = None
+        self._timeout = None
+
+        # Journal records waiting to be written while changes are held
+        self._held = None
+
+        # If set, journal writes are made on this executor's threads
+        self.executor = None
+
+        # How many records the journal holds
+        self._records = 0
+
+        self._replay()
+
+    ### Queries ###
+
+    def get(self, station):
+        """
+        Returns the expiration of the delay on a station, or None.
+        """
+        expiration = self.expirations.get(station)
+        if expiration is not None and expiration <= clock.time():
+            # The timer hasn't caught up with this one yet
+            self.expire()
+            return None
+        return expiration
+
+    def next_expiration(self):
+        """
+        Returns the soonest expiration of any delay, or None.
+        """
+        self._discard_stale()
+        return self.heap[0][0] if self.heap else None
+
+    ### Changes ###
+
+    def set(self, station, expiration):
+        """
+        Sets (or replaces) the delay on a station.
+        """
+        expiration = int(expiration)
+        self.expirations[station] = expiration
+        heapq.heappush(self.heap, (expiration, station))
+        self._append('S %d %d\n' % (station, expiration))
+        self._arm()
+
+    def remove(self, station):
+        """
+        Removes the delay on a station. Returns False if there wasn't one.
+        """
+        if station not in self.expirations:
+            return False
+        del self.expirations[station]
+        self._append('R %d\n' % station)
+        self._arm()
+        return True
+
+    def clear(self):
+        """
+        Removes every delay.
+        """
+        self.expirations = {}
+        self.heap = []
+        self._append('C\n')
+        self._arm()
+
+    def expire(self, now=None):
+        """
+        Removes every delay that has run out and returns their stations.
+        """
+        if now is None:
+            now = clock.time()
+
+        expired = []
+        while self.heap and self.heap[0][0] <= now:
+            expiration, station = heapq.heappop(self.heap)
+            if self.expirations.get(station) == expiration:
+                del self.expirations[station]
+                expired.append(station)
+
+        for station in expired:
+            self._append('R %d\n' % station)
+
+        for station in expired:
+            if self.on_expire:
+                self.on_expire(station)
+
+        return expired
+
+    def hold(self):
+        """
+        Holds journal writes and timer changes until release() is called, so a
+        group of changes costs one journal write.
+        """
+        if self._held is None:
+            self._held = []
+
+    def release(self):
+        """
+        Writes the journal records held since hold() and re-arms the timer.
+        """
+        records, self._held = self._held, None
+        if records:
+            self._append(''.join(records))
+        self._arm()
+
+    def _discard_stale(self):
+        while self.heap and self.expirations.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+
+    ### Timer ###
+
+    def attach(self, ioloop):
+        """
+        Expire delays from a timer on the IOLoop rather than waiting for them
+        to be looked at.
+        """
+        self.ioloop = ioloop
+        self._arm()
+
+    def _arm(self):
+        if self.ioloop is None or self._held is not None:
+            return
+
+        if self._timeout is not None:
+            self.ioloop.remove_timeout(self._timeout)
+            self._timeout = None
+
+        expiration = self.next_expiration()
+        if expiration is not None:
+            self._timeout = self.ioloop.add_timeout(expiration, self._on_timer)
+
+    def _on_timer(self):
+        self._timeout = None
+        self.expire()
+        self._arm()
+
+    ### Journal ###
+
+    def _append(self, record):
+        if self.readonly:
+            return
+        if self._held is not None:
+            self._held.append(record)
+            return
+        if self.executor is not None:
+            self.executor.submit(self._write, record, key=self.journal_path)
+        else:
+            self._write(record)
+
+        self._records += record.count('\n')
+        if self._records >= max(COMPACT_MIN_RECORDS, COMPACT_RATIO * len(self.expirations)):
+            self._compact()
+
+    def _write(self, record):
+        with open(self.journal_path, 'a') as f:
+            f.write(record)
+
+    def _replay(self):
+        """
+        Rebuilds the delays from the journal, then rewrites the journal with
+        just the delays that are still in effect. A read-only manager leaves
+        the journal alone, since the server may be appending to it.
+        """
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'r') as f:
+                for line in f:
+                    fields = line.split()
+                    try:
+                        if fields[0] == 'S':
+                            self.expirations[int(fields[1])] = int(fields[2])
+                        elif fields[0] == 'R':
+                            self.expirations.pop(int(fields[1]), None)
+                        elif fields[0] == 'C':
+                            self.expirations = {}
+                    except (IndexError, ValueError):
+                        # A torn write at the end of the journal; skip it
+                        continue
+
+        now = clock.time()
+        self.expirations = dict((s, e) for s, e in self.expirations.items() if e > now)
+        self.heap = [(e, s) for s, e in self.expirations.items()]
+        heapq.heapify(self.heap)
+
+        if not self.readonly:
+            self._compact()
+
+    def _compact(self):
+        """
+        Rewrites the journal with just the delays in effect. With an executor,
+        the rewrite goes in order with the appends, after the ones already
+        waiting and before any made later.
+        """
+        text = ''.join('S %d %d\n' % (station, expiration)
+            for station, expiration in sorted(self.expirations.items()))
+        self._records = len(self.expirations)
+        if self.executor is not None:
+            self.executor.submit(self._rewrite, text, key=self.journal_path)
+        else:
+            self._rewrite(text)
+
+    def _rewrite(self, text):
+        temp_path = '%s.tmp' % self.journal_path
+        with open(temp_path, 'w') as f:
+            f.write(text)
+        os.rename(temp_path, self.journal_path)
@@ -0,0 +1,207 @@
+"""
+A structured record of everything a controller does, kept in SQLite next to
+log.txt. Each event has a time (epoch seconds), a type, the station it was
+for (None for events like standby that aren't about one station) and any
+details as JSON.
+
+log.txt is still written as before, for people to read; this is for
+questions like "when did station 3 last run", which can be answered from an
+index instead of by scanning the log.
+"""
+import json
+import os
+import sqlite3
+import time
+
+import clock
+
+# Event types
+OPERATE = 'operate'
+REFUSED = 'refused'
+PREEMPT = 'preempt'
+RESUME = 'resume'
+STOP = 'stop'
+DELAY_CREATE = 'delay_create'
+DELAY_REMOVE = 'delay_remove'
+DELAY_EXPIRE = 'delay_expire'
+STANDBY_CREATE = 'standby_create'
+STANDBY_REMOVE = 'standby_remove'
+
+EVENT_TYPES = [OPERATE, REFUSED, PREEMPT, RESUME, STOP, DELAY_CREATE, DELAY_REMOVE,
+    DELAY_EXPIRE, STANDBY_CREATE, STANDBY_REMOVE]
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS events ('
+    ' id INTEGER PRIMARY KEY,'
+    ' time REAL NOT NULL,'
+    ' type TEXT NOT NULL,'
+    ' station INTEGER,'
+    ' data TEXT)',
+    'CREATE INDEX IF NOT EXISTS events_station_time ON events (station, time)',
+    'CREATE INDEX IF NOT EXISTS events_type_time ON events (type, time)',
+]
+
+
+class EventStore():
+    """
+    Records events for one controller and answers queries on them.
+
+    The database is in WAL mode and isn't synced on every commit, so
+    recording an event costs an append to the write-ahead log rather than a
+    trip to the disk. Like the delay journal, writes can be held during a
+    batch and committed together in one transaction.
+
+    A read-only store only answers queries. It doesn't create the database
+    or its tables, and finds no events if there isn't one yet.
+    """
+
+    def __init__(self, path, readonly=False):
+        self.path = path
+        self.readonly = readonly
+
+        # Events waiting to be committed while writes are held
+        self._held = None
+
+        # If set, inserts are made on this executor's threads
+        self.executor = None
+
+        if readonly:
+            self.connection = None
+            if os.path.exists(path):
+                self.connection = sqlite3.connect(path, check_same_thread=False)
+                self.connection.execute('PRAGMA query_only=ON')
+            return
+
+        # The connection is used from the file executor's thread when there
+        # is one, always the same thread for the same database
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        for statement in SCHEMA:
+            self.connection.execute(statement)
+        self.connection.commit()
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    ### Recording ###
+
+    def record(self, event_type, station=None, **data):
+        """
+        Records an event that happened just now.
+        """
+        if self.readonly:
+            raise RuntimeError('%s was opened read-only' % self.path)
+        row = (clock.time(), event_type, station, json.dumps(data) if data else None)
+        if self._held is not None:
+            self._held.append(row)
+            return
+        self._insert([row])
+
+    def hold(self):
+        """
+        Keeps new events in memory until release() is called.
+        """
+        if self._held is None:
+            self._held = []
+
+    def release(self):
+        """
+        Commits everything recorded since hold() in one transaction.
+        """
+        rows, self._held = self._held, None
+        if rows:
+            self._insert(rows)
+
+    def _insert(self, rows):
+        if self.executor is not None:
+            self.executor.submit(self._commit, rows, key=self.path)
+        else:
+            self._commit(rows)
+
+    def _commit(self, rows):
+        with self.connection:
+            self.connection.executemany(
+                'INSERT INTO events (time, type, station, data) VALUES (?, ?, ?, ?)', rows)
+
+    ### Querying ###
+
+    def query(self, station=None, event_type=None, start=None, end=None, limit=100):
+        """
+        Returns up to `limit` events, newest first, as dictionaries. `start`
+        and `end` are epoch seconds; `start` is inclusive and `end` isn't.
+        """
+        if self.connection is None:
+            return []
+
+        conditions = []
+        parameters = []
+        if station is not None:
+            conditions.append('station = ?')
+            parameters.append(station)
+        if event_type is not None:
+            conditions.append('type = ?')
+            parameters.append(event_type)
+        if start is not None:
+            conditions.append('time >= ?')
+            parameters.append(start)
+        if end is not None:
+            conditions.append('time < ?')
+            parameters.append(end)
+
+        sql = 'SELECT id, time, type, station, data FROM events'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY time DESC, id DESC LIMIT ?'
+        parameters.append(limit)
+
+        events = []
+        for event_id, when, event_type, station, data in self.connection.execute(sql, parameters):
+            event = json.loads(data) if data else {}
+            event.update({
+                'id': event_id,
+                'time': when,
+                'date': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(when)),
+                'type': event_type,
+                'station': station,
+            })
+            events.append(event)
+        return events
+
+    def query_async(self, **kwargs):
+        """
+        Runs query() on the executor, in order with the inserts, and returns
+        a Future. Without an executor the query runs right away.
+        """
+        if self.executor is None:
+            # Only the server needs this, so tools that read events don't
+            # pay for importing tornado
+            import tornado.concurrent
+            future = tornado.concurrent.Future()
+            future.set_result(self.query(**kwargs))
+            return future
+        return self.executor.submit(self.query, key=self.path, **kwargs)
+
+
+def parse_time(value):
+    """
+    Turns an argument from a query into epoch seconds. Accepts epoch seconds
+    or a local time like the ones in log.txt ('2016-05-14 22:09:48',
+    '2016-05-14T22:09:48' or just '2016-05-14'). Raises ValueError if it
+    can't be read.
+    """
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    value = value.replace('T', ' ')
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return time.mktime(time.strptime(value, fmt))
+        except ValueError:
+            continue
+    raise ValueError('Could not read time %s' % value)
@@ -0,0 +1,97 @@
+"""
+Background threads for the blocking work that would otherwise run on the
+IOLoop: bit-banging the shift registers, and writing and reading files
+(pid files, STANDBY, the delay journal, the state file, usage totals,
+events and history). On an SD card a single slow write can take long
+enough to hold up every client.
+
+The server uses two executors: one worker for the hardware, so writes to
+the pins are strictly serialized, and a small pool for files. Work for the
+same file (or the same pins) is always given the same key, and work with
+the same key runs in the order it was submitted.
+"""
+import Queue
+import sys
+import threading
+import time
+
+import tornado.concurrent
+
+from metrics import Gauge, Histogram
+
+# How many threads do file work
+FILE_IO_WORKERS = 2
+
+# How many tasks can wait for each thread. Submitting more than this waits
+# for room, which slows the IOLoop down rather than letting memory run away.
+MAX_QUEUED_TASKS = 1000
+
+QUEUE_DEPTH = Gauge('neptune_executor_queue_depth',
+    'Tasks waiting for or running on an executor.', labels=('executor',))
+
+WAIT_SECONDS = Histogram('neptune_executor_wait_seconds',
+    'Time tasks waited before an executor started them.', labels=('executor',))
+
+TASK_SECONDS = Histogram('neptune_executor_task_duration_seconds',
+    'Time tasks took to run on an executor.', labels=('executor',))
+
+
+class Executor():
+    """
+    A fixed number of daemon threads, each with its own queue. Tasks with a
+    key always go to the same thread; tasks without one go to the thread with
+    the least waiting. submit() returns a Future that is resolved on the
+    IOLoop.
+    """
+
+    def __init__(self, name, workers, ioloop, max_queued=MAX_QUEUED_TASKS):
+        self.name = name
+        self.ioloop = ioloop
+
+        self.queues = [Queue.Queue(max_queued) for _ in range(workers)]
+        for queue in self.queues:
+            thread = threading.Thread(target=self._work, args=(queue,),
+                name='%s-executor' % name)
+            thread.daemon = True
+            thread.start()
+
+        QUEUE_DEPTH.set(0, labels=(name,))
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Queues fn(*args, **kwargs). Pass key= to keep it in order with other
+        work for the same thing.
+        """
+        key = kwargs.pop('key', None)
+        if key is not None:
+            queue = self.queues[hash(key) % len(self.queues)]
+        else:
+            queue = min(self.queues, key=lambda queue: queue.qsize())
+
+        future = tornado.concurrent.Future()
+        QUEUE_DEPTH.inc(labels=(self.name,))
+        queue.put((future, fn, args, kwargs, time.time()))
+        return future
+
+    def drain(self):
+        """
+        Waits for everything submitted so far to finish.
+        """
+        for queue in self.queues:
+            queue.join()
+
+    def _work(self, queue):
+        while True:
+            future, fn, args, kwargs, submitted = queue.get()
+            started = time.time()
+            WAIT_SECONDS.observe(started - submitted, labels=(self.name,))
+            try:
+                result = fn(*args, **kwargs)
+            except Exception:
+                self.ioloop.add_callback(future.set_exc_info, sys.exc_info())
+            else:
+                self.ioloop.add_callback(future.set_result, result)
+            finally:
+                TASK_SECONDS.observe(time.time() - started, labels=(self.name,))
+                QUEUE_DEPTH.dec(labels=(self.name,))
+                queue.task_done()
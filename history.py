@@ -0,0 +1,245 @@
+import bisect
+import os
+import tempfile
+
+# How much of the log we read at a time when walking backwards from the end
+BLOCK_SIZE = 64 * 1024
+
+# Roughly how many bytes of log sit between two entries in the sparse index
+INDEX_INTERVAL = 256 * 1024
+
+
+def _parse_line(line):
+    """
+    Splits a tab-delimited log line into its date and message. Returns None
+    for lines that don't look like log entries.
+    """
+    parts = line.rstrip('\r\n').split('\t')
+    if len(parts) < 2:
+        return None
+    return parts[0], parts[-1]
+
+
+def _normalize_timestamp(value):
+    """
+    Accepts '2016-05-14 22:09:48', '2016-05-14T22:09:48' or a prefix like
+    '2016-05-14' and returns something that compares correctly against the
+    timestamps in the log.
+    """
+    return value.strip().replace('T', ' ')
+
+
+class HistoryReader():
+    """
+    Reads log.txt from the end without loading the whole file. A sparse index
+    of timestamp -> byte offset is kept next to the log so that timestamp
+    lookups only need to scan a small part of the file.
+    """
+
+    def __init__(self, log_path, index_path=None):
+        self.log_path = log_path
+        self.index_path = index_path or '%s.idx' % log_path
+
+        # A sorted list of (timestamp, offset) pairs. Each offset is the start
+        # of the line carrying the timestamp.
+        self.index = []
+
+        # How far into the log the index has been built, and which file it
+        # was built for (the log can be rotated or trimmed out from under us)
+        self.indexed_to = 0
+        self.identity = None
+
+        self._load_index()
+
+    ### Sparse Index ###
+
+    def _log_identity(self, stat):
+        return '%d:%d' % (stat.st_dev, stat.st_ino)
+
+    def _load_index(self):
+        """
+        Reads the index file written by a previous run, if there is one.
+        """
+        if not os.path.exists(self.index_path):
+            return
+
+        try:
+            with open(self.index_path, 'r') as f:
+                header = f.readline().rstrip('\n').split('\t')
+                index = []
+                for line in f:
+                    timestamp, offset = line.rstrip('\n').split('\t')
+                    index.append((timestamp, int(offset)))
+            self.identity = header[0]
+            self.indexed_to = int(header[1])
+            self.index = index
+        except (ValueError, IndexError):
+            # A damaged index is no big deal, it will be rebuilt
+            self._reset_index()
+
+    def _save_index(self):
+        # Worker processes (and the file threads in each) can save the same
+        # index at once, so each writes its own temp file. Whichever rename
+        # comes last wins, and every one of them installs a whole index.
+        fd, temp_path = tempfile.mkstemp(prefix='%s.' % os.path.basename(self.index_path),
+            suffix='.tmp', dir=os.path.dirname(self.index_path))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write('%s\t%d\n' % (self.identity, self.indexed_to))
+                for timestamp, offset in self.index:
+                    f.write('%s\t%d\n' % (timestamp, offset))
+            os.rename(temp_path, self.index_path)
+        except (IOError, OSError):
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def _reset_index(self):
+        self.index = []
+        self.indexed_to = 0
+        self.identity = None
+
+    def update_index(self):
+        """
+        Extends the index over anything appended to the log since the last
+        update. If the log was rotated or truncated, the index is rebuilt.
+        """
+        if not os.path.exists(self.log_path):
+            self._reset_index()
+            return
+
+        stat = os.stat(self.log_path)
+        identity = self._log_identity(stat)
+
+        if identity != self.identity or stat.st_size < self.indexed_to:
+            self._reset_index()
+            self.identity = identity
+
+        if stat.st_size == self.indexed_to:
+            return
+
+        last_offset = self.index[-1][1] if self.index else None
+        position = self.indexed_to
+
+        with open(self.log_path, 'rb') as f:
+            f.seek(position)
+            for line in f:
+                # Stop at a partially-written line; it gets indexed next time
+                if not line.endswith('\n'):
+                    break
+                parsed = _parse_line(line)
+                if parsed and (last_offset is None or position - last_offset >= INDEX_INTERVAL):
+                    self.index.append((parsed[0], position))
+                    last_offset = position
+                position += len(line)
+
+        self.indexed_to = position
+        self._save_index()
+
+    def offset_before(self, timestamp):
+        """
+        Returns the byte offset of the first line logged at or after the
+        timestamp, i.e. the point to read backwards from to get everything
+        logged before it.
+        """
+        timestamp = _normalize_timestamp(timestamp)
+        self.update_index()
+
+        # Jump to the last indexed line that comes before the timestamp and
+        # scan forward from there. This never reads more than INDEX_INTERVAL
+        # bytes (plus anything not yet indexed).
+        i = bisect.bisect_left(self.index, (timestamp,))
+        position = self.index[i-1][1] if i > 0 else 0
+
+        with open(self.log_path, 'rb') as f:
+            f.seek(position)
+            for line in f:
+                parsed = _parse_line(line)
+                if parsed and parsed[0] >= timestamp:
+                    return position
+                position += len(line)
+
+        return position
+
+    ### Reading ###
+
+    def _complete_end(self, f, end):
+        """
+        Moves `end` back to just after the last complete line before it. The
+        log writer may be part way through writing the line at the end of
+        the file, and that line isn't an entry yet.
+        """
+        position = end
+        while position > 0:
+            size = min(BLOCK_SIZE, position)
+            f.seek(position - size)
+            newline = f.read(size).rfind('\n')
+            if newline >= 0:
+                return position - size + newline + 1
+            position -= size
+        return 0
+
+    def _reverse_lines(self, f, end):
+        """
+        Yields (offset, line) pairs walking backwards from the end offset.
+        """
+        position = end
+        remainder = ''
+
+        while position > 0:
+            size = min(BLOCK_SIZE, position)
+            position -= size
+            f.seek(position)
+            block = f.read(size) + remainder
+
+            lines = block.split('\n')
+            remainder = lines.pop(0)
+
+            line_start = position + len(block)
+            for line in reversed(lines):
+                line_start -= len(line)
+                if line:
+                    yield line_start, line
+                line_start -= 1
+
+        if remainder:
+            yield 0, remainder
+
+    def read(self, limit=100, before=None, since=None):
+        """
+        Returns up to `limit` log entries, newest first. `before` is either an
+        offset returned with a previous entry (for paging) or a timestamp.
+        `since` is a timestamp; older entries are not returned.
+
+        Offsets are positions in the current log.txt, so they only page
+        correctly until the log is rotated. After that, start again from the
+        newest entries or page by timestamp.
+        """
+        if not os.path.exists(self.log_path):
+            return []
+
+        if before is None:
+            end = os.path.getsize(self.log_path)
+        elif isinstance(before, (int, long)):
+            end = before
+        else:
+            end = self.offset_before(before)
+
+        if since is not None:
+            since = _normalize_timestamp(since)
+
+        entries = []
+        with open(self.log_path, 'rb') as f:
+            end = self._complete_end(f, min(end, os.fstat(f.fileno()).st_size))
+            for offset, line in self._reverse_lines(f, end):
+                parsed = _parse_line(line)
+                if parsed is None:
+                    continue
+                date, message = parsed
+                if since is not None and date < since:
+                    break
+                entries.append({'date': date, 'msg': message, 'offset': offset})
+                if len(entries) >= limit:
+                    break
+
+        return entries
@@ -0,0 +1,311 @@
+"""
+A small blocking client for the server's Unix domain socket, for the
+scheduler, utilities/check_pids.py and anything else running on the Pi
+that wants to send the server commands or read its state.
+
+Going through the socket means no TCP setup and no curl process per
+request. Most importantly, the server stays the only thing that writes to
+the GPIO pins. Connections are kept open between requests and shared by
+the threads of a process, so a tool that sends many requests only connects
+once:
+
+    from localclient import get_client
+
+    client = get_client()
+    client.station_on(3, 10)
+    print client.status()['3']['state']
+
+The protocol is described in actuator.py. This module only uses the
+standard library, so importing it is cheap.
+"""
+import itertools
+import json
+import os
+import socket
+import sys
+import threading
+
+CUR_DIR = os.path.dirname(os.path.realpath(__file__))
+
+# Where the server listens. This is ACTUATOR_SOCKET_PATH in server.py.
+SOCKET_PATH = os.path.join(CUR_DIR, 'actuator.sock')
+
+# How long to wait for the server to connect or reply, in seconds
+TIMEOUT = 5
+
+# How many open connections each client keeps for reuse
+MAX_IDLE_CONNECTIONS = 4
+
+# The longest reply that will be read, in bytes
+MAX_MESSAGE_BYTES = 1024 * 1024
+
+
+class ServerUnavailable(Exception):
+    """
+    Raised when the server can't be reached, or goes away before replying.
+    """
+    pass
+
+
+class ServerError(Exception):
+    """
+    Raised when the server refuses a request. `errors` lists the problems it
+    found, if it gave any.
+    """
+
+    def __init__(self, message, errors=None):
+        Exception.__init__(self, message)
+        self.errors = errors or []
+
+
+# One client per socket, shared by everything in the process
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(path=SOCKET_PATH, **kwargs):
+    """
+    Returns the LocalClient for a socket path, creating it if needed.
+    """
+    path = os.path.abspath(path)
+    with _clients_lock:
+        if path not in _clients:
+            _clients[path] = LocalClient(path, **kwargs)
+        return _clients[path]
+
+
+def after_fork():
+    """
+    Forgets the parent's clients, whose connections and locks the child
+    mustn't share. Call this in a forked child.
+    """
+    global _clients_lock
+    _clients_lock = threading.Lock()
+    _clients.clear()
+
+
+class Connection():
+    """
+    One connection to the server, used by one thread at a time.
+    """
+
+    def __init__(self, path, timeout):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.settimeout(timeout)
+        self.socket.connect(path)
+        self.reader = self.socket.makefile('rb')
+
+    def send(self, message):
+        self.socket.sendall(json.dumps(message) + '\n')
+
+    def receive(self, message_id):
+        """
+        Reads lines until the reply to `message_id` arrives.
+        """
+        while True:
+            line = self.reader.readline(MAX_MESSAGE_BYTES)
+            if not line.endswith('\n'):
+                raise ServerUnavailable('Connection closed before the server replied')
+            reply = json.loads(line)
+            if reply.get('id') == message_id:
+                return reply
+
+    def close(self):
+        self.reader.close()
+        self.socket.close()
+
+
+class LocalClient():
+    """
+    Sends requests to the server over its socket and waits for the replies.
+    Idle connections are kept for the next request.
+    """
+
+    def __init__(self, path=SOCKET_PATH, timeout=TIMEOUT, max_idle=MAX_IDLE_CONNECTIONS):
+        self.path = path
+        self.timeout = timeout
+        self.max_idle = max_idle
+
+        self.ids = itertools.count(1)
+        self._idle = []
+        self._lock = threading.Lock()
+
+    ### Commands ###
+
+    def execute(self, ops):
+        """
+        Applies a list of operations, as /batch/ does, and returns the
+        response. Raises a ServerError if any of them are invalid, in which
+        case none were applied.
+        """
+        return self.request({'ops': ops})
+
+    def station_on(self, station, minutes, controller=None):
+        return self._operation('station_on', controller, station=station, minutes=minutes)
+
+    def station_off(self, station=0, controller=None):
+        """
+        Turns a station off. Station 0 turns off every station.
+        """
+        return self._operation('station_off', controller, station=station)
+
+    def create_delay(self, station, hours, controller=None):
+        return self._operation('delay_create', controller, station=station, hours=hours)
+
+    def remove_delay(self, station=0, controller=None):
+        return self._operation('delay_remove', controller, station=station)
+
+    def create_standby(self, controller=None):
+        return self._operation('standby_create', controller)
+
+    def remove_standby(self, controller=None):
+        return self._operation('standby_remove', controller)
+
+    def reload_schedule(self, file_path=None):
+        """
+        Makes the server read its schedule file again. Returns how many events
+        there are and how many were added and removed. With a file_path, the
+        server refuses unless that's the file it runs.
+        """
+        if file_path is None:
+            return self.call('schedule_reload')
+        return self.call('schedule_reload', file=os.path.abspath(file_path))
+
+    def log(self, message, controller=None):
+        """
+        Writes a line to a controller's log. The server doesn't reply.
+        """
+        self._exchange({'log': message, 'controller': controller}, wait=False)
+
+    ### Queries ###
+
+    def status(self, controller=None):
+        return self.call('status', controller=controller)
+
+    def controllers(self):
+        return self.call('controllers')
+
+    def schedule(self):
+        return self.call('schedule')
+
+    ### Requests ###
+
+    def call(self, name, **kwargs):
+        """
+        Makes one of the calls the server offers and returns its result.
+        """
+        kwargs['call'] = name
+        return self.request(kwargs)['result']
+
+    def request(self, message):
+        """
+        Sends a message and returns the server's reply. Raises a ServerError
+        if the server refuses it and ServerUnavailable if it can't be reached.
+        """
+        reply = self._exchange(message)
+        if reply.get('response') != 'ok':
+            raise ServerError(reply.get('error') or 'Request failed', reply.get('errors'))
+        return reply
+
+    def _operation(self, op, controller, **params):
+        params.update(op=op, controller=controller)
+        result = self.execute([params])['results'][0]
+        if result['error']:
+            raise ServerError(result['error'])
+        return result
+
+    def _exchange(self, message, wait=True):
+        message = dict(message, id=next(self.ids))
+
+        connection, reused = self._acquire()
+        try:
+            try:
+                connection.send(message)
+            except socket.error:
+                # An idle connection can have been closed by a server that
+                # has since restarted. Nothing was sent, so try a new one.
+                connection.close()
+                if not reused:
+                    raise
+                connection, reused = self._connect(), False
+                connection.send(message)
+
+            reply = connection.receive(message['id']) if wait else None
+        except (socket.error, ServerUnavailable, ValueError), e:
+            connection.close()
+            raise ServerUnavailable('Could not talk to the server at %s: %s' % (self.path, e))
+
+        self._release(connection)
+        return reply
+
+    ### Connections ###
+
+    def _acquire(self):
+        """
+        Returns (connection, reused).
+        """
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        try:
+            return self._connect(), False
+        except socket.error, e:
+            raise ServerUnavailable('Could not connect to the server at %s: %s' % (self.path, e))
+
+    def _connect(self):
+        return Connection(self.path, self.timeout)
+
+    def _release(self, connection):
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+
+if __name__ == "__main__":
+
+    # A quick way to talk to the server from the shell. argparse is imported
+    # here so programs using the client don't load it.
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--socket', default=SOCKET_PATH)
+    parser.add_argument('--controller')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('status')
+    commands.add_parser('controllers')
+    commands.add_parser('schedule')
+    commands.add_parser('reload')
+    on = commands.add_parser('on')
+    on.add_argument('station', type=int)
+    on.add_argument('minutes', type=int)
+    off = commands.add_parser('off')
+    off.add_argument('station', type=int, nargs='?', default=0)
+    args = parser.parse_args()
+
+    client = get_client(args.socket)
+    try:
+        if args.command == 'status':
+            result = client.status(args.controller)
+        elif args.command == 'controllers':
+            result = client.controllers()
+        elif args.command == 'schedule':
+            result = client.schedule()
+        elif args.command == 'reload':
+            result = client.reload_schedule()
+        elif args.command == 'on':
+            result = client.station_on(args.station, args.minutes, args.controller)
+        else:
+            result = client.station_off(args.station, args.controller)
+    except ServerError, e:
+        sys.exit('\n'.join([str(e)] + e.errors))
+    except ServerUnavailable, e:
+        sys.exit(str(e))
+
+    print json.dumps(result, indent=4, sort_keys=True)
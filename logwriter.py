@@ -0,0 +1,205 @@
+import atexit
+import os
+import threading
+import time
+
+import clock
+from metrics import LOG_FLUSH_SECONDS, LOG_LINES
+
+# Write out whatever is queued once this many lines are waiting...
+BATCH_SIZE = 64
+
+# ...or once the oldest queued line has waited this many seconds
+FLUSH_INTERVAL = 1.0
+
+# 'batch' calls fsync() after every batch is written, 'never' leaves it to the OS
+FSYNC_POLICY = 'batch'
+
+# Rotate log.txt to log.txt.1 once it grows past this size, keeping this many old files
+MAX_BYTES = 10 * 1024 * 1024
+BACKUP_COUNT = 5
+
+# One writer per log file, shared by everything in the process that logs to it
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def get_log_writer(path, **kwargs):
+    """
+    Returns the LogWriter for a path, creating (and starting) it if needed.
+    """
+    path = os.path.abspath(path)
+    with _writers_lock:
+        if path not in _writers:
+            _writers[path] = LogWriter(path, **kwargs)
+        return _writers[path]
+
+
+def close_all():
+    """
+    Flushes and stops every writer. This is registered to run at exit.
+    """
+    with _writers_lock:
+        writers = list(_writers.values())
+    for writer in writers:
+        writer.close()
+
+atexit.register(close_all)
+
+
+def after_fork():
+    """
+    Forgets the parent's writers, whose threads didn't survive the fork and
+    whose locks may be held. Call this in a forked child; get_log_writer()
+    then starts new writers there. Lines the parent had queued are its to
+    write.
+    """
+    global _writers_lock
+    _writers_lock = threading.Lock()
+    _writers.clear()
+
+
+class LogWriter():
+    """
+    Appends tab-delimited lines to a log file from a background thread.
+    Callers only pay for putting a line on an in-memory queue; the file is
+    written in batches and rotated when it gets too big.
+    """
+
+    def __init__(self, path, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL,
+                 fsync_policy=FSYNC_POLICY, max_bytes=MAX_BYTES, backup_count=BACKUP_COUNT):
+
+        if fsync_policy not in ('batch', 'never'):
+            raise ValueError('Unknown fsync policy: %s' % fsync_policy)
+
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync_policy = fsync_policy
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+
+        # Lines waiting to be written, and how many have been handed to the
+        # writer thread in total. `written` trails `queued` until a flush.
+        self.pending = []
+        self.queued = 0
+        self.written = 0
+
+        # Functions called with each batch of lines after it hits the disk
+        self.listeners = []
+
+        self.condition = threading.Condition()
+        self.flush_waiting = 0
+        self.closed = False
+
+        self.thread = threading.Thread(target=self._run, name='LogWriter')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, message):
+        """
+        Queues a message. The timestamp is taken now, not when it is written.
+        """
+        now_time = clock.now().strftime('%Y-%m-%d %H:%M:%S')
+        line = '%s\t\t%s\n' % (now_time, message)
+
+        with self.condition:
+            if self.closed and not self.thread.is_alive():
+                # Nothing is left to write it for us, so do it ourselves
+                self._write_lines([line])
+                return
+            self.pending.append(line)
+            self.queued += 1
+            # Wake the writer to start its flush timer, or because the batch is full
+            if len(self.pending) == 1 or len(self.pending) >= self.batch_size:
+                self.condition.notify_all()
+
+    def flush(self):
+        """
+        Blocks until everything queued so far is on disk.
+        """
+        with self.condition:
+            target = self.queued
+            self.flush_waiting += 1
+            self.condition.notify_all()
+            while self.written < target and self.thread.is_alive():
+                self.condition.wait(0.1)
+            self.flush_waiting -= 1
+
+    def close(self):
+        """
+        Flushes anything left and stops the writer thread.
+        """
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+
+    ### Writer Thread ###
+
+    def _run(self):
+        while True:
+            with self.condition:
+                # Sleep until there is something to write
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+
+                # Give the batch a chance to fill up, unless someone is
+                # waiting on a flush or we're shutting down
+                deadline = time.time() + self.flush_interval
+                while not self.closed and not self.flush_waiting and len(self.pending) < self.batch_size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+
+                lines = self.pending
+                self.pending = []
+                closed = self.closed
+
+            if lines:
+                try:
+                    self._write_lines(lines)
+                except (IOError, OSError), e:
+                    print "** Could not write to %s: %s **" % (self.path, e)
+
+            with self.condition:
+                self.written += len(lines)
+                self.condition.notify_all()
+
+            if closed and not self.pending:
+                return
+
+    def _write_lines(self, lines):
+        timer = LOG_FLUSH_SECONDS.time()
+        with open(self.path, 'a') as f:
+            f.write(''.join(lines))
+            if self.fsync_policy == 'batch':
+                f.flush()
+                os.fsync(f.fileno())
+            size = f.tell()
+        timer.stop()
+        LOG_LINES.inc(len(lines))
+
+        for listener in self.listeners:
+            listener(lines)
+
+        if self.max_bytes and size >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        """
+        Moves log.txt to log.txt.1, log.txt.1 to log.txt.2 and so on, dropping
+        anything past the retention count.
+        """
+        for i in range(self.backup_count - 1, 0, -1):
+            source = '%s.%d' % (self.path, i)
+            if os.path.exists(source):
+                os.rename(source, '%s.%d' % (self.path, i + 1))
+
+        if self.backup_count > 0:
+            os.rename(self.path, '%s.1' % self.path)
+        else:
+            os.remove(self.path)
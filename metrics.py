@@ -0,0 +1,259 @@
+import bisect
+import threading
+import time
+
+# Upper bounds (in seconds) of the histogram buckets used for timings. Most of
+# what we time is well under a millisecond, but a slow SD card can take a while.
+DEFAULT_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0]
+
+# How often the IOLoop lag probe runs, in seconds
+LAG_PROBE_INTERVAL = 1.0
+
+# Every metric created, in the order they were created
+_metrics = []
+
+
+def render(others=()):
+    """
+    Returns every metric in the Prometheus text format. `others` are what
+    export() returned in other processes (like the HTTP workers), which are
+    added to this process's values.
+    """
+    return ''.join(metric.render([other.get(metric.name, []) for other in others])
+        for metric in _metrics)
+
+
+def export():
+    """
+    Returns the value of every metric in a form that can be sent as JSON to
+    another process and passed to its render().
+    """
+    return dict((metric.name, metric.export()) for metric in _metrics)
+
+
+def after_fork():
+    """
+    Gives every metric a new lock and starts it from zero. Call this in a
+    forked child: a lock some other thread held at the moment of the fork
+    would never be released, and the parent's counts are the parent's to
+    report.
+    """
+    for metric in _metrics:
+        metric.lock = threading.Lock()
+        metric.values = {}
+
+
+def _add_values(metric, others):
+    """
+    Returns a counter's or gauge's values with those exported by other
+    processes added in.
+    """
+    with metric.lock:
+        values = dict(metric.values)
+    for exported in others:
+        for labels, value in exported:
+            labels = tuple(labels)
+            values[labels] = values.get(labels, 0) + value
+    return values
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in pairs)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Counter():
+    """
+    A count that only goes up, optionally split by labels.
+    """
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+        # label values -> count
+        self.values = {}
+        self.lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, amount=1, labels=()):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def export(self):
+        with self.lock:
+            return [[list(labels), value] for labels, value in self.values.items()]
+
+    def render(self, others=()):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s counter' % self.name]
+        for labels, value in sorted(_add_values(self, others).items()):
+            lines.append('%s%s %s' % (self.name, _format_labels(self.labels, labels),
+                _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class Gauge():
+    """
+    A value that can go up and down, optionally split by labels.
+    """
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+        # label values -> value
+        self.values = {}
+        self.lock = threading.Lock()
+        _metrics.append(self)
+
+    def set(self, value, labels=()):
+        with self.lock:
+            self.values[labels] = value
+
+    def inc(self, amount=1, labels=()):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, amount=1, labels=()):
+        self.inc(-amount, labels)
+
+    def export(self):
+        with self.lock:
+            return [[list(labels), value] for labels, value in self.values.items()]
+
+    def render(self, others=()):
+        # The gauges are things like queue depths, so the processes' values
+        # add up to the server's
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s gauge' % self.name]
+        for labels, value in sorted(_add_values(self, others).items()):
+            lines.append('%s%s %s' % (self.name, _format_labels(self.labels, labels),
+                _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class Histogram():
+    """
+    Counts observations into fixed buckets, optionally split by labels.
+    Observing is a binary search and two additions.
+    """
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = sorted(buckets)
+
+        # label values -> [count per bucket (plus one for +Inf), sum]
+        self.values = {}
+        self.lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value, labels=()):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(labels)
+            if series is None:
+                series = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    def time(self, labels=()):
+        """
+        Returns a timer whose stop() observes the seconds since it was made.
+        """
+        return _Timer(self, labels)
+
+    def export(self):
+        with self.lock:
+            return [[list(labels), [list(counts), total]] for labels, (counts, total) in self.values.items()]
+
+    def render(self, others=()):
+        with self.lock:
+            values = dict((labels, [list(counts), total]) for labels, (counts, total) in self.values.items())
+        for exported in others:
+            for labels, (counts, total) in exported:
+                series = values.setdefault(tuple(labels), [[0] * (len(self.buckets) + 1), 0.0])
+                series[0] = [mine + theirs for mine, theirs in zip(series[0], counts)]
+                series[1] += total
+
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        for labels, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + [float('inf')], counts):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (self.name,
+                    _format_labels(self.labels, labels, [('le', _format_value(bound))]), cumulative))
+            lines.append('%s_sum%s %s' % (self.name, _format_labels(self.labels, labels),
+                _format_value(total)))
+            lines.append('%s_count%s %d' % (self.name, _format_labels(self.labels, labels),
+                cumulative))
+        return '\n'.join(lines) + '\n'
+
+
+class _Timer():
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = time.time()
+
+    def stop(self):
+        self.histogram.observe(time.time() - self.start, self.labels)
+
+
+class IOLoopLagProbe():
+    """
+    Schedules a timeout every `interval` seconds and records how late it
+    runs. Anything that blocks the IOLoop shows up as lag.
+    """
+
+    def __init__(self, ioloop, interval=LAG_PROBE_INTERVAL):
+        self.ioloop = ioloop
+        self.interval = interval
+        self.deadline = None
+
+    def start(self):
+        self.deadline = time.time() + self.interval
+        self.ioloop.add_timeout(self.deadline, self._probe)
+
+    def _probe(self):
+        IOLOOP_LAG_SECONDS.observe(max(0.0, time.time() - self.deadline))
+        self.start()
+
+
+### The metrics themselves ###
+
+REQUEST_SECONDS = Histogram('neptune_request_duration_seconds',
+    'Time taken to handle HTTP requests.', labels=('handler', 'method', 'code'))
+
+GPIO_WRITE_SECONDS = Histogram('neptune_gpio_write_duration_seconds',
+    'Time taken to shift a new state out to the shift registers.')
+
+GPIO_WRITES = Counter('neptune_gpio_writes_total',
+    'Shift register writes, by whether anything changed.', labels=('changed',))
+
+STATION_TRANSITIONS = Counter('neptune_station_transitions_total',
+    'Station outputs switched on or off.', labels=('direction',))
+
+LOG_FLUSH_SECONDS = Histogram('neptune_log_flush_duration_seconds',
+    'Time taken to write (and fsync) a batch of log lines.')
+
+LOG_LINES = Counter('neptune_log_lines_total', 'Lines written to log files.')
+
+TIMER_DRIFT_SECONDS = Histogram('neptune_timer_drift_seconds',
+    'How late stations were stopped compared to when they were due to stop.')
+
+IOLOOP_LAG_SECONDS = Histogram('neptune_ioloop_lag_seconds',
+    'How late a periodic probe timeout ran on the IOLoop.')
@@ -0,0 +1,188 @@
+import cProfile
+import pstats
+import time
+import traceback
+
+import tornado.concurrent
+
+from metrics import Counter
+
+# The IOLoop is reported as blocked once a single callback (or request
+# handler) has run for this many seconds
+SLOW_CALLBACK_SECONDS = 0.5
+
+# The most a profile can run for, in seconds, whether it is for a window of
+# time or for a number of requests
+MAX_PROFILE_SECONDS = 300
+
+# What the functions in a profile summary can be sorted by
+SORT_FIELDS = {
+    'cumulative': 'cumulative_seconds',
+    'total': 'total_seconds',
+    'calls': 'calls',
+}
+
+SLOW_CALLBACKS = Counter('neptune_slow_callbacks_total',
+    'Times the IOLoop was blocked for longer than the slow callback threshold.')
+
+
+class Profiler():
+    """
+    Runs cProfile in the live server, either for a window of time or around
+    the next N requests to one handler. Only one profile runs at a time.
+
+    The server calls request_started() and request_finished() for every
+    request so the profiler can switch itself on and off around the ones it
+    was asked to watch.
+    """
+
+    def __init__(self, ioloop):
+        self.ioloop = ioloop
+        self._reset()
+
+    def _reset(self):
+        self.profile = None
+        self.mode = None
+        self.handler_name = None
+        self.remaining = 0
+        self.started = None
+        self.future = None
+        self._timeout = None
+
+    @property
+    def active(self):
+        return self.mode is not None
+
+    def status(self):
+        return {
+            'mode': self.mode,
+            'handler': self.handler_name,
+            'remaining_requests': self.remaining if self.mode == 'requests' else None,
+            'started': self.started,
+        }
+
+    ### Starting ###
+
+    def profile_window(self, seconds):
+        """
+        Profiles everything the server does for a number of seconds. Returns
+        a Future that resolves to the pstats.Stats.
+        """
+        self._start('window')
+        self.profile.enable()
+        self._timeout = self.ioloop.add_timeout(time.time() + seconds, self._stop)
+        return self.future
+
+    def profile_requests(self, handler_name, count):
+        """
+        Profiles the next `count` requests handled by the handler class with
+        this name. Returns a Future that resolves to the pstats.Stats, which
+        stops early (with whatever was collected) after MAX_PROFILE_SECONDS.
+        """
+        self._start('requests')
+        self.handler_name = handler_name
+        self.remaining = count
+        self._timeout = self.ioloop.add_timeout(time.time() + MAX_PROFILE_SECONDS, self._stop)
+        return self.future
+
+    def _start(self, mode):
+        if self.active:
+            raise RuntimeError('A profile is already running')
+        self.profile = cProfile.Profile()
+        self.mode = mode
+        self.started = time.time()
+        self.future = tornado.concurrent.Future()
+
+    ### Request Hooks ###
+
+    def _watching(self, handler):
+        return self.mode == 'requests' and type(handler).__name__ == self.handler_name
+
+    def request_started(self, handler):
+        if self._watching(handler) and self.remaining > 0:
+            handler._profiled = True
+            self.profile.enable()
+
+    def request_finished(self, handler):
+        if not getattr(handler, '_profiled', False) or not self._watching(handler):
+            return
+        self.profile.disable()
+        self.remaining -= 1
+        if self.remaining <= 0:
+            self._stop()
+
+    ### Finishing ###
+
+    def _stop(self):
+        if self._timeout is not None:
+            self.ioloop.remove_timeout(self._timeout)
+        self.profile.disable()
+
+        profile, future = self.profile, self.future
+        self._reset()
+
+        # An empty profile can't be turned into Stats
+        try:
+            stats = pstats.Stats(profile)
+        except TypeError:
+            stats = None
+        future.set_result(stats)
+
+
+def summarize(stats, limit=30, sort='cumulative'):
+    """
+    Turns pstats.Stats into a list of the top functions, most expensive
+    first, that can be sent as JSON.
+    """
+    if stats is None:
+        return []
+
+    rows = []
+    for (file_name, line, function), (primitive_calls, calls, total, cumulative, callers) in stats.stats.items():
+        rows.append({
+            'function': '%s:%d(%s)' % (file_name, line, function),
+            'calls': calls,
+            'primitive_calls': primitive_calls,
+            'total_seconds': total,
+            'cumulative_seconds': cumulative,
+        })
+
+    rows.sort(key=lambda row: row[SORT_FIELDS[sort]], reverse=True)
+    return rows[:limit]
+
+
+class SlowCallbackDetector():
+    """
+    Uses the IOLoop's blocking signal (a SIGALRM timer that is reset every
+    time the loop goes round) to catch callbacks and handlers that run for
+    longer than `threshold` seconds. The stack of whatever was running is
+    printed, and a one-line summary is passed to `log`.
+    """
+
+    def __init__(self, ioloop, log, threshold=SLOW_CALLBACK_SECONDS):
+        self.ioloop = ioloop
+        self.log = log
+        self.threshold = threshold
+
+    def start(self):
+        self.ioloop.set_blocking_signal_threshold(self.threshold, self._blocked)
+
+    def stop(self):
+        self.ioloop.set_blocking_signal_threshold(None, None)
+
+    def _blocked(self, signal_number, frame):
+        # This runs in a signal handler, so just grab the stack and report it
+        # once the loop is free again
+        stack = traceback.extract_stack(frame)
+        self.ioloop.add_callback_from_signal(self._report, stack)
+
+    def _report(self, stack):
+        SLOW_CALLBACKS.inc()
+
+        print 'IOLoop blocked for more than %.2fs. Stack:' % self.threshold
+        print ''.join(traceback.format_list(stack)).rstrip()
+
+        # The log is one line per message, so summarise the innermost frames
+        frames = ['%s:%d %s' % (file_name.split('/')[-1], line, function)
+            for file_name, line, function, text in reversed(stack[-5:])]
+        self.log('IOLoop blocked for more than %.2fs in %s' % (self.threshold, ' <- '.join(frames)))
@@ -0,0 +1,248 @@
+import json
+import math
+import os
+
+import clock
+
+
+class RunQueue():
+    """
+    Runs a program -- an ordered list of (station, minutes) steps -- on one
+    controller, one step after another, with an optional gap in seconds
+    between steps.
+
+    Starting and stopping stations goes through `run_station(sprinkler,
+    station, minutes, on_complete)`, which calls on_complete when the step's
+    time is up. Progress is saved to queue.json in the controller's state
+    directory after every change so a restarted server can pick it back up.
+    """
+
+    def __init__(self, sprinkler, ioloop, run_station):
+        self.sprinkler = sprinkler
+        self.ioloop = ioloop
+        self.run_station = run_station
+
+        self.state_path = os.path.join(sprinkler.state_dir, 'queue.json')
+
+        self._reset()
+
+    def _reset(self):
+        self.steps = []
+        self.gap = 0
+        self.index = None
+        self.step_started = None
+
+        # 'idle', 'running' (a step is watering) or 'waiting' (in a gap)
+        self.state = 'idle'
+
+        self._gap_timeout = None
+
+    @property
+    def active(self):
+        return self.state != 'idle'
+
+    @property
+    def current_station(self):
+        """
+        The station the program is watering right now, or None.
+        """
+        if self.state != 'running':
+            return None
+        return self.steps[self.index][0]
+
+    ### Commands ###
+
+    def submit(self, steps, gap=0):
+        """
+        Starts a new program, replacing any program already running.
+        """
+        if self.active:
+            self.sprinkler.log('Program replaced by a new one.')
+            self.cancel()
+
+        self.steps = [(int(station), int(minutes)) for station, minutes in steps]
+        self.gap = gap
+        self.sprinkler.log('Starting program with %d steps: %s' % (len(self.steps),
+            ', '.join('station %d for %d minutes' % step for step in self.steps)))
+
+        self._start_step(0)
+
+    def skip(self):
+        """
+        Ends the current step (or gap) now and moves on to the next step.
+        Returns False if no program is running.
+        """
+        if not self.active:
+            return False
+
+        self.sprinkler.log('Skipping step %d of the program.' % (self.index + 1))
+        self._clear_gap_timeout()
+
+        # Stop the current step ourselves so its completion callback never fires
+        self._stop_current()
+
+        self._start_step(self.index + 1)
+        return True
+
+    def cancel(self):
+        """
+        Stops the program and turns its station off. Other stations that are
+        running are left alone. Returns False if no program is running.
+        """
+        if not self.active:
+            return False
+
+        self.sprinkler.log('Program cancelled.')
+        self._stop_current()
+        self.abandon()
+        return True
+
+    def abandon(self):
+        """
+        Forgets the program without touching the stations. Used when something
+        else (a manual run or a scheduled event) takes over the program's
+        station. If the step's station is still running, it stops when its
+        time is up as usual.
+        """
+        self._clear_gap_timeout()
+        self._reset()
+        self._save()
+
+    def status(self):
+        """
+        Returns a dictionary describing the program and how far along it is.
+        """
+        status = {
+            'state': self.state,
+            'steps': [{'station': station, 'minutes': minutes} for station, minutes in self.steps],
+            'gap': self.gap,
+            'current_step': None if self.index is None else self.index + 1,
+            'step_started': self.step_started,
+        }
+        return status
+
+    ### Running Steps ###
+
+    def _start_step(self, index, minutes=None):
+        """
+        Starts the step at index (or finishes the program if there are no
+        more). `minutes` overrides the step's time when resuming.
+        """
+        while index < len(self.steps):
+            station, step_minutes = self.steps[index]
+            run_minutes = minutes if minutes is not None else step_minutes
+            minutes = None
+
+            # A resumed step counts as having started when it first did
+            self.index = index
+            self.step_started = clock.time() - (step_minutes - run_minutes) * 60
+            self.state = 'running'
+
+            if self.run_station(self.sprinkler, station, run_minutes, on_complete=self._step_finished):
+                self._save()
+                return
+
+            # A delay (or standby) is in effect, so move straight on
+            self.sprinkler.log('Program step %d (station %d) could not run. Skipping.' % (index + 1, station))
+            index += 1
+
+        self.sprinkler.log('Program complete.')
+        self._reset()
+        self._save()
+
+    def _step_finished(self):
+        if self.state != 'running':
+            return
+
+        next_index = self.index + 1
+
+        if self.gap and next_index < len(self.steps):
+            self.state = 'waiting'
+            self._save()
+            self._gap_timeout = self.ioloop.add_timeout(clock.time() + self.gap,
+                lambda: self._start_step(next_index))
+        else:
+            self._start_step(next_index)
+
+    def _stop_current(self):
+        """
+        Turns off the current step's station and cancels its timer.
+        """
+        station = self.current_station
+        if station is None:
+            return
+        timeout = self.sprinkler.timeouts.pop(station, None)
+        if timeout is not None:
+            self.ioloop.remove_timeout(timeout)
+        self.sprinkler.stop_station(station)
+
+    def _clear_gap_timeout(self):
+        if self._gap_timeout is not None:
+            self.ioloop.remove_timeout(self._gap_timeout)
+            self._gap_timeout = None
+
+    ### Persistence ###
+
+    def _save(self):
+        """
+        Writes the program's progress, or removes the file when idle. The
+        file work goes on the controller's file executor, in order with
+        other writes to queue.json.
+        """
+        self.sprinkler.notify_listeners()
+
+        if not self.active:
+            self.sprinkler._in_background(self.state_path, self._remove)
+            return
+
+        # The progress keeps changing, so it is encoded here and only the
+        # writing is handed off
+        self.sprinkler._in_background(self.state_path, self._write, json.dumps(self.status()))
+
+    def _write(self, text):
+        temp_path = '%s.tmp' % self.state_path
+        with open(temp_path, 'w') as f:
+            f.write(text)
+        os.rename(temp_path, self.state_path)
+
+    def _remove(self):
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+
+    def restore(self, resume=True):
+        """
+        Looks for a program that was running when the server went down. With
+        resume, the program carries on from where it was (the current step
+        runs for whatever time it had left); otherwise it is dropped.
+        """
+        if not os.path.exists(self.state_path):
+            return
+
+        try:
+            with open(self.state_path, 'r') as f:
+                saved = json.load(f)
+            steps = [(step['station'], step['minutes']) for step in saved['steps']]
+            index = saved['current_step'] - 1
+            step_started = saved['step_started']
+            gap = saved['gap']
+        except (ValueError, KeyError, TypeError):
+            self.sprinkler.log('Could not read saved program. Discarding it.')
+            os.remove(self.state_path)
+            return
+
+        if not resume:
+            self.sprinkler.log('Discarding the program that was running when the server stopped.')
+            os.remove(self.state_path)
+            return
+
+        self.steps = steps
+        self.gap = gap
+
+        # Work out how much of the current step is left
+        remaining = step_started + steps[index][1] * 60 - clock.time()
+        if saved['state'] == 'running' and remaining > 0:
+            self.sprinkler.log('Resuming program at step %d.' % (index + 1))
+            self._start_step(index, minutes=int(math.ceil(remaining / 60.0)))
+        else:
+            self.sprinkler.log('Resuming program after step %d.' % (index + 1))
+            self._start_step(index + 1)
@@ -0,0 +1,383 @@
+"""
+Packs zones into a watering window and writes the result as a schedule.json
+the server can run. Rather than working out start times by hand (and
+finding out later that two events at the same start preempt each other),
+describe what each zone needs:
+
+    {
+        "window": {"start": "04:00", "end": "07:00"},
+        "days": ["Monday", "Wednesday", "Friday"],
+        "max_concurrency": 2,
+        "max_flow": 12,
+        "zones": [
+            {"station": 1, "minutes": 20, "flow": 4},
+            {"station": 2, "minutes": 45, "flow": 6, "days": ["Tuesday", "Saturday"]},
+            {"station": 5, "minutes": 15, "controller": "back"}
+        ]
+    }
+
+Each zone runs for its minutes on each of its days (the top-level "days" if
+it doesn't give any, or every day). At most max_concurrency zones run at
+once on a controller, and if max_flow is given, the flows of the zones
+running at once (in the same unit as the zones' "flow") never add up to
+more. "controllers" can set max_concurrency and max_flow for one controller:
+{"back": {"max_concurrency": 1}}. Runs longer than max_run_minutes (by default the
+most a schedule event can run, 30) are split into shorter ones. Windows can
+run past midnight, like 22:00 to 02:00.
+
+The zones are placed longest first, each at the earliest time it fits.
+That's the classic longest-processing-time heuristic; it's quick enough for
+hundreds of zones and rarely far from the shortest possible window.
+
+    $ python scheduler/planner.py --zones zones.json --output scheduler/schedule.json
+
+A report of how long each day takes (the makespan) and how busy the valves
+are is printed as JSON. Without --output, the schedule is printed along with
+it.
+"""
+# Within the scheduler package a bare "scheduler" would mean scheduler.py
+from __future__ import absolute_import
+
+import bisect
+import json
+import os
+import sys
+
+CUR_DIR = os.path.dirname(os.path.realpath(__file__))
+PARENT_DIR = os.path.abspath(os.path.join(CUR_DIR, os.pardir))
+
+# Add the parent dir to the search path so we can check the schedule the
+# same way the server reads it
+sys.path.insert(0, PARENT_DIR)
+from scheduler.scheduler import (DAY_NAMES, DAY_NUMBERS, MAX_RUN_MINUTES, MINUTES_PER_DAY,
+    ScheduleError, parse_events)
+
+
+def _parse_minute(value, name, errors):
+    try:
+        hour, minute = [int(part) for part in value.split(':')]
+        if not (0 <= hour < 24 and 0 <= minute < 60):
+            raise ValueError
+        return hour * 60 + minute
+    except (ValueError, AttributeError):
+        errors.append('Bad %s time: %s' % (name, value))
+        return 0
+
+
+def _parse_days(value, name, errors):
+    if not isinstance(value, list) or not value:
+        errors.append('%s must be a list of days' % name)
+        return []
+    unknown = [day for day in value if day not in DAY_NUMBERS]
+    if unknown:
+        errors.append('%s has an unknown day: %s' % (name, ', '.join(map(str, unknown))))
+    return sorted(set(DAY_NUMBERS[day] for day in value if day in DAY_NUMBERS))
+
+
+def _positive(value, name, errors, number_type=int):
+    if not isinstance(value, number_type) or isinstance(value, bool) or value <= 0:
+        errors.append('Bad %s: %s' % (name, value))
+        return None
+    return value
+
+
+class Requirements():
+    """
+    What the zones need and the limits they have to fit in. Every problem
+    with the input is collected and raised together in a ScheduleError.
+    """
+
+    def __init__(self, data):
+        errors = []
+        if not isinstance(data, dict):
+            raise ScheduleError('Requirements must be an object')
+
+        window = data.get('window')
+        if not isinstance(window, dict):
+            raise ScheduleError('Missing window: {"start": "HH:MM", "end": "HH:MM"}')
+        self.window_start = _parse_minute(window.get('start'), 'window start', errors)
+        window_end = _parse_minute(window.get('end'), 'window end', errors)
+
+        # A window that ends before it starts runs past midnight
+        self.window_minutes = (window_end - self.window_start) % MINUTES_PER_DAY or MINUTES_PER_DAY
+
+        days = _parse_days(data['days'], 'days', errors) if 'days' in data else range(1, 8)
+
+        # Schedule events can't be any longer than MAX_RUN_MINUTES, so longer
+        # runs are split
+        self.max_run_minutes = _positive(data.get('max_run_minutes', MAX_RUN_MINUTES),
+            'max_run_minutes', errors)
+        if self.max_run_minutes > MAX_RUN_MINUTES:
+            errors.append('max_run_minutes can be at most %d' % MAX_RUN_MINUTES)
+        default_limits = self._limits(data, 'the schedule', {'max_concurrency': 1, 'max_flow': None}, errors)
+
+        self.limits = {}
+        controllers = data.get('controllers', {})
+        if not isinstance(controllers, dict):
+            errors.append('controllers must be an object')
+            controllers = {}
+        for controller_id, item in controllers.items():
+            if not isinstance(item, dict):
+                errors.append('Controller %s must be an object' % controller_id)
+                continue
+            self.limits[controller_id] = self._limits(item, 'controller %s' % controller_id,
+                default_limits, errors)
+
+        # (controller, station, minutes, flow, days) for every zone
+        self.zones = []
+        zones = data.get('zones')
+        if not isinstance(zones, list) or not zones:
+            errors.append('zones must be a list with at least one zone')
+            zones = []
+
+        seen = set()
+        for number, zone in enumerate(zones, 1):
+            zone_errors = []
+            if not isinstance(zone, dict):
+                errors.append('Zone %d: must be an object' % number)
+                continue
+
+            station = _positive(zone.get('station'), 'station', zone_errors)
+            minutes = _positive(zone.get('minutes'), 'minutes', zone_errors)
+            flow = zone.get('flow', 0)
+            if not isinstance(flow, (int, float)) or isinstance(flow, bool) or flow < 0:
+                zone_errors.append('Bad flow: %s' % flow)
+            zone_days = _parse_days(zone['days'], 'days', zone_errors) if 'days' in zone else days
+            controller = zone.get('controller')
+
+            # A zone that can't fit under the flow limit on its own never will
+            max_flow = self.limits_for(controller, default_limits)['max_flow']
+            if not zone_errors and max_flow is not None and flow > max_flow:
+                zone_errors.append('Flow %s is over the max_flow of %s' % (flow, max_flow))
+
+            if (controller, station) in seen:
+                zone_errors.append('Station %s is listed twice' % station)
+            seen.add((controller, station))
+
+            if zone_errors:
+                errors.extend('Zone %d: %s' % (number, error) for error in zone_errors)
+                continue
+            self.zones.append((controller, station, minutes, flow, zone_days))
+
+        if errors:
+            raise ScheduleError(errors)
+
+        self.default_limits = default_limits
+
+    def _limits(self, item, name, defaults, errors):
+        limits = dict(defaults)
+        if 'max_concurrency' in item:
+            limits['max_concurrency'] = _positive(item['max_concurrency'],
+                'max_concurrency for %s' % name, errors)
+        if 'max_flow' in item:
+            limits['max_flow'] = _positive(item['max_flow'], 'max_flow for %s' % name, errors,
+                (int, float))
+        return limits
+
+    def limits_for(self, controller, defaults=None):
+        return self.limits.get(controller, defaults or self.default_limits)
+
+    def runs(self, minutes):
+        """
+        Splits a zone's minutes into runs no longer than max_run_minutes,
+        as evenly as possible.
+        """
+        count = -(-minutes // self.max_run_minutes)
+        return [minutes // count + (1 if index < minutes % count else 0) for index in range(count)]
+
+
+class DayPlan():
+    """
+    The runs placed on one controller on one day, in minutes from midnight
+    at the start of the window.
+
+    How many runs are going (and how much water they use) is kept as a
+    profile: segment i lasts from times[i] until times[i+1] (the last one
+    forever) with counts[i] runs using flows[i]. A run can only start at one
+    of those times, and when one of the segments it would cover is over a
+    limit, the next time worth trying is the end of that segment. Segments
+    at the front that nothing left could use are skipped for good.
+    """
+
+    def __init__(self, start, max_concurrency, max_flow, min_flow=0):
+        self.max_concurrency = max_concurrency
+        self.max_flow = max_flow
+
+        # The least flow of any run still to be placed
+        self.min_flow = min_flow
+
+        self.times = [start]
+        self.counts = [0]
+        self.flows = [0]
+
+        # Segments before this one are full
+        self.first_open = 0
+
+        # station -> [(start, end)] of its runs, since a station can't run
+        # twice at once
+        self.stations = {}
+
+    def place(self, minutes, station, flow):
+        """
+        Puts a run at the earliest time it fits and returns that time.
+        """
+        times, counts, flows = self.times, self.counts, self.flows
+        busy = self.stations.setdefault(station, [])
+
+        index = self.first_open
+        while True:
+            start = times[index]
+            end = start + minutes
+
+            # The first segment in the way, if any. Nothing runs in the last
+            # segment, so a run always fits there.
+            blocked = index
+            while blocked < len(times) and times[blocked] < end:
+                if counts[blocked] >= self.max_concurrency or (self.max_flow is not None
+                        and flows[blocked] + flow > self.max_flow):
+                    break
+                blocked += 1
+            else:
+                clashes = [run_end for run_start, run_end in busy if run_start < end and run_end > start]
+                if not clashes:
+                    break
+
+                # The station's own run ends at one of the times
+                index = bisect.bisect_left(times, max(clashes), index)
+                continue
+            index = blocked + 1
+
+        first = self._split(start)
+        last = self._split(end)
+        for segment in range(first, last):
+            counts[segment] += 1
+            flows[segment] += flow
+        busy.append((start, end))
+
+        while self._full(self.first_open):
+            self.first_open += 1
+        return start
+
+    def _split(self, moment):
+        """
+        Makes sure a segment starts at `moment` and returns its index.
+        """
+        index = bisect.bisect_left(self.times, moment)
+        if index == len(self.times) or self.times[index] != moment:
+            self.times.insert(index, moment)
+            self.counts.insert(index, self.counts[index - 1])
+            self.flows.insert(index, self.flows[index - 1])
+        return index
+
+    def _full(self, index):
+        return self.counts[index] >= self.max_concurrency or (self.max_flow is not None
+            and self.flows[index] + self.min_flow > self.max_flow)
+
+
+def plan(requirements):
+    """
+    Packs the zones and returns (events, report). The events are in
+    schedule.json's format.
+    """
+    # (controller, day) -> [(minutes, station, flow)]
+    jobs = {}
+    for controller, station, minutes, flow, days in requirements.zones:
+        for day in days:
+            for run in requirements.runs(minutes):
+                jobs.setdefault((controller, day), []).append((run, station, flow))
+
+    window_end = requirements.window_start + requirements.window_minutes
+
+    # (controller, station, minutes, start minute) -> days
+    placed = {}
+    report_days = []
+    for (controller, day), runs in sorted(jobs.items()):
+        limits = requirements.limits_for(controller)
+        day_plan = DayPlan(requirements.window_start, limits['max_concurrency'], limits['max_flow'],
+            min(run[2] for run in runs))
+
+        # Longest first, then the thirstiest, then by station so the plan
+        # is the same every time
+        last_end = requirements.window_start
+        late = []
+        for minutes, station, flow in sorted(runs, key=lambda run: (-run[0], -run[2], run[1])):
+            start = day_plan.place(minutes, station, flow)
+            last_end = max(last_end, start + minutes)
+            if start + minutes > window_end:
+                late.append(station)
+
+            # Runs after midnight happen on the next day
+            run_day = (day - 1 + start // MINUTES_PER_DAY) % 7 + 1
+            placed.setdefault((controller, station, minutes, start % MINUTES_PER_DAY), set()).add(run_day)
+
+        busy = sum(run[0] for run in runs)
+        makespan = last_end - requirements.window_start
+        report_days.append({
+            'controller': controller,
+            'day': DAY_NAMES[day - 1],
+            'runs': len(runs),
+            'minutes': busy,
+            'makespan_minutes': makespan,
+            'window_minutes': requirements.window_minutes,
+            'utilization': round(float(busy) / (makespan * limits['max_concurrency']), 3),
+            'late_stations': sorted(set(late)),
+        })
+
+    events = []
+    for (controller, station, minutes, start), days in placed.items():
+        event = {
+            'station': station,
+            'minutes': minutes,
+            'start': '%02d:%02d' % divmod(start, 60),
+            'days': [DAY_NAMES[day - 1] for day in sorted(days)],
+        }
+        if controller is not None:
+            event['controller'] = controller
+        events.append(event)
+    events.sort(key=lambda event: (event.get('controller') or '', event['start'], event['station']))
+
+    total = sum(day['minutes'] for day in report_days)
+    capacity = sum(day['makespan_minutes'] * requirements.limits_for(day['controller'])['max_concurrency']
+        for day in report_days)
+    report = {
+        'events': len(events),
+        'runs': sum(day['runs'] for day in report_days),
+        'makespan_minutes': max(day['makespan_minutes'] for day in report_days),
+        'utilization': round(float(total) / capacity, 3),
+        'fits_window': not any(day['late_stations'] for day in report_days),
+        'days': report_days,
+    }
+    return events, report
+
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--zones', required=True, help='JSON file describing the zones and limits')
+    parser.add_argument('--output', help='where to write the schedule (default: print it)')
+    args = parser.parse_args()
+
+    try:
+        with open(args.zones, 'r') as f:
+            data = json.load(f)
+    except IOError:
+        sys.exit('Could not open %s' % args.zones)
+    except ValueError:
+        sys.exit('Error in %s syntax. Invalid JSON.' % args.zones)
+
+    try:
+        events, report = plan(Requirements(data))
+    except ScheduleError, e:
+        sys.exit('Error reading zones:\n' + '\n'.join(e.errors))
+
+    # Make sure the server will read it
+    schedule = json.dumps(events, indent=4, sort_keys=True)
+    parse_events(schedule)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(schedule + '\n')
+        print json.dumps(report, indent=2, sort_keys=True)
+    else:
+        print json.dumps({'schedule': events, 'report': report}, indent=2, sort_keys=True)
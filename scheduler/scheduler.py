@@ -1,26 +1,100 @@
 import argparse
+import bisect
 import datetime
+import functools
+import hashlib
 import json
 import os
 import sys
+import time
 
 CUR_DIR = os.path.dirname(os.path.realpath(__file__))
 PARENT_DIR = os.path.abspath(os.path.join(CUR_DIR, os.pardir))
 LOG_FILE_PATH = os.path.join(PARENT_DIR, 'log.txt')
 
-SERVER_HOST = 'localhost'
-SERVER_PORT = '8888'
+# Add the parent dir to the search path so we can share the log writer and
+# reach the server through its socket
+sys.path.insert(0, PARENT_DIR)
+import clock
+from localclient import ServerError, ServerUnavailable, get_client
+from logwriter import get_log_writer
+
+# Day names in schedule.json and their ISO weekday numbers (Monday is 1)
+DAY_NAMES = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+DAY_NUMBERS = dict((name, number+1) for number, name in enumerate(DAY_NAMES))
+
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+
+# The longest an event can run for, in minutes. This is MAX_RUN_MINUTES in
+# server.py; the watchdog would stop anything longer.
+MAX_RUN_MINUTES = 30
+
+
+class ScheduleError(Exception):
+    """
+    Raised when a schedule can't be loaded. `errors` lists every problem found,
+    not just the first one.
+    """
+
+    def __init__(self, errors):
+        if isinstance(errors, basestring):
+            errors = [errors]
+        self.errors = errors
+        Exception.__init__(self, '; '.join(errors))
+
 
 class Event():
-    
+
     def __init__(self, event_dict):
         try:
             self.start_time = event_dict['start']
             self.minutes = event_dict['minutes']
             self.station = event_dict['station']
-            self.days = self.day_names_to_numbers(event_dict['days'])
+            days = event_dict['days']
         except KeyError, e:
-            sys.exit('Error reading schedule. Missing key: %s' % e)
+            raise ScheduleError('Missing key: %s' % e)
+        except TypeError:
+            raise ScheduleError('Event is not an object')
+
+        errors = []
+
+        # Days are names, like "Monday"
+        if not isinstance(days, list):
+            errors.append('Bad days: %s' % days)
+            days = []
+        unknown_days = []
+        for day in days:
+            if not isinstance(day, basestring):
+                errors.append('Bad day: %s' % day)
+            elif day not in DAY_NUMBERS:
+                unknown_days.append(day)
+        if unknown_days:
+            errors.append('Unknown day: %s' % ', '.join(unknown_days))
+        self.days = sorted(set(DAY_NUMBERS[day] for day in days
+            if isinstance(day, basestring) and day in DAY_NUMBERS))
+
+        # The start time is kept as minutes after midnight
+        try:
+            hour, minute = [int(part) for part in self.start_time.split(':')]
+            if not (0 <= hour < 24 and 0 <= minute < 60):
+                raise ValueError
+            self.minute_of_day = hour * 60 + minute
+        except (ValueError, AttributeError):
+            errors.append('Bad start time: %s' % self.start_time)
+
+        if not isinstance(self.station, int) or self.station < 1:
+            errors.append('Bad station: %s' % self.station)
+
+        if not isinstance(self.minutes, int) or isinstance(self.minutes, bool) or \
+                not 1 <= self.minutes <= MAX_RUN_MINUTES:
+            errors.append('Bad minutes: %s (must be between 1 and %d)' % (self.minutes, MAX_RUN_MINUTES))
+
+        if errors:
+            raise ScheduleError(errors)
+
+        # Events without a controller run on the server's default controller
+        self.controller = event_dict.get('controller')
 
     def __repr__(self):
         day_list = ['Mon','Tue','Wed','Thu','Fri','Sat','Sun']
@@ -28,92 +102,322 @@ class Event():
         return "Station %d, run %d minutes on %s @ %s" % \
             (self.station, self.minutes, days, self.start_time)
 
-    def day_names_to_numbers(self, days):
+    @property
+    def key(self):
         """
-        Takes Day Names and Converts them to ISO Weekdays
-        (Monday is 1 and Sunday is 7)
+        Identifies the event when comparing two versions of a schedule.
         """
-        names = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
-        return [names.index(day)+1 for day in days]
+        return (self.controller, self.station, self.minutes, self.minute_of_day, tuple(self.days))
 
-    def should_run_today(self):
+    def next_run(self, after):
         """
-        Compares the current day number and time to the event to see 
-        if it's supposed to be running today.
+        Returns the first local datetime after `after` that the event runs.
         """
-        now = datetime.datetime.now()
-        day = now.isoweekday()
-
-        # See if today is in the list of days to run
-        if day in self.days:
-            now_hour_min = now.strftime("%H:%M")
-            if now_hour_min < self.start_time:
-                return True
+        for offset in range(0, 8):
+            day = after.date() + datetime.timedelta(days=offset)
+            if day.isoweekday() in self.days:
+                run_at = datetime.datetime.combine(day, datetime.time()) + \
+                    datetime.timedelta(minutes=self.minute_of_day)
+                if run_at > after:
+                    return run_at
+        return None
 
-        # If none of the tests passed, we do not run
-        return False
+    def to_dict(self):
+        return {
+            'station': self.station,
+            'minutes': self.minutes,
+            'start': self.start_time,
+            'days': [DAY_NAMES[day-1] for day in self.days],
+            'controller': self.controller,
+        }
 
     @classmethod
     def log(self, message):
         """
         A convenience method for writing operations to a log file.
         """
-        file_path = os.path.join(PARENT_DIR, 'log.txt')
-        f = open(LOG_FILE_PATH, 'a')
-        now_time = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        msg = '%s\t\t%s\n' % (now_time, message)
-        f.write(msg)
-        print msg
+        now_time = clock.now().strftime('%Y-%m-%d %H:%M:%S')
+        get_log_writer(LOG_FILE_PATH).write(message)
+        print '%s\t\t%s' % (now_time, message)
 
 
-if __name__ == "__main__":
+def parse_events(data):
+    """
+    Turns the contents of a schedule file into a list of Events. Every event
+    is checked, and a ScheduleError listing all of the problems is raised if
+    any are found.
+    """
+    # Turn the contents of the json file into a Python list
+    try:
+        items = json.loads(data)
+    except ValueError:
+        raise ScheduleError("Error in schedule.json syntax. Invalid JSON.")
 
-    # Parse command-line arguments
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--file', required=True)
-    parser.add_argument("--test", action="store_true", dest="test", default=False)
-    args = vars(parser.parse_args())
+    if type(items) is not list:
+        raise ScheduleError("Error in schedule.json syntax. Could not find events list.")
+
+    events = []
+    errors = []
+    for number, item in enumerate(items, 1):
+        try:
+            events.append(Event(item))
+        except ScheduleError, e:
+            errors.extend('Event %d: %s' % (number, error) for error in e.errors)
+
+    if errors:
+        raise ScheduleError(errors)
+
+    return events
 
-    # Try to open up the filename that was passed
+
+def load_events(file_path):
+    """
+    Reads a schedule file and returns its list of Events. Raises a
+    ScheduleError if the file can't be read or is invalid.
+    """
     try:
-        file_path = os.path.abspath(args['file'])
-        f = open(file_path, 'r')
-        data = f.read()
-        f.close()
+        with open(file_path, 'r') as f:
+            data = f.read()
     except IOError:
-        sys.exit("Error opening schedule file: %s" % file_path)
+        raise ScheduleError("Error opening schedule file: %s" % file_path)
 
-    # Turn the contents of the json file into a Python list
-    try:
-        events = json.loads(data)
-    except ValueError:
-        sys.exit("Error in schedule.json syntax. Invalid JSON.")
+    return parse_events(data)
 
-    if type(events) is not list:
-        sys.exit("Error in schedule.json syntax. Could not find events list.")
 
-    # If we get a dump flag, we just want to output the schedule 
-    if args['test']:
-        for item in events:
-            print Event(item)
-        sys.exit()
+def week_minute(when):
+    """
+    Minutes since midnight on Monday for a datetime.
+    """
+    return (when.isoweekday() - 1) * MINUTES_PER_DAY + when.hour * 60 + when.minute
+
+
+class ScheduleIndex():
+    """
+    The schedule compiled into buckets keyed by minute of the week (Monday
+    00:00 is 0). `slots` is the sorted list of minutes that have anything in
+    them, so finding the next run is a binary search.
+    """
+
+    def __init__(self, events=()):
+        self.buckets = {}
+        self.slots = []
+        for event in events:
+            self.add(event)
+
+    def add(self, event):
+        for day in event.days:
+            slot = (day - 1) * MINUTES_PER_DAY + event.minute_of_day
+            if slot not in self.buckets:
+                self.buckets[slot] = []
+                bisect.insort(self.slots, slot)
+            self.buckets[slot].append(event)
+
+    def remove(self, event):
+        for day in event.days:
+            slot = (day - 1) * MINUTES_PER_DAY + event.minute_of_day
+            bucket = self.buckets.get(slot, [])
+            if event in bucket:
+                bucket.remove(event)
+            if not bucket and slot in self.buckets:
+                del self.buckets[slot]
+                self.slots.remove(slot)
+
+    def events_at(self, slot):
+        return list(self.buckets.get(slot, []))
+
+    def next_slot(self, after):
+        """
+        Returns (slot, local datetime) of the first run strictly after the
+        datetime, or None if the schedule is empty.
+        """
+        if not self.slots:
+            return None
+
+        current = week_minute(after)
+        i = bisect.bisect_right(self.slots, current)
+
+        # Past the last slot of the week, so wrap around to next week
+        if i == len(self.slots):
+            slot = self.slots[0]
+            ahead = slot + MINUTES_PER_WEEK - current
+        else:
+            slot = self.slots[i]
+            ahead = slot - current
+
+        start_of_minute = after.replace(second=0, microsecond=0)
+        return slot, start_of_minute + datetime.timedelta(minutes=ahead)
 
-    # Remove any queued events (in case this is run multiple times)
-    os.system('for i in `atq | awk \'{print $1}\'`;do atrm $i;done')
-    
-    # Loop over all the events and find ones that should be scheduled today
-    for item in events:
 
-        # Turn the event dictionary into an object
-        event = Event(item)
+class ScheduleService():
+    """
+    Runs the schedule inside the server. The events are compiled into a
+    ScheduleIndex and a single IOLoop timer is armed for the next minute that
+    has anything scheduled. When it fires, `run_callback(event)` is called for
+    each event in that minute, and the timer is armed for the next one.
 
-        # See if the event is supposed to run today
-        if event.should_run_today():
+    The file is checked for changes every `check_interval` seconds. Only the
+    events that were added or removed are updated in the index.
+    """
 
-            Event.log("Scheduling event: Run station %s for %s minutes today at %s" % (event.station, 
-                event.minutes, event.start_time))
+    def __init__(self, file_path, run_callback, ioloop, check_interval=5):
+        self.file_path = file_path
+        self.run_callback = run_callback
+        self.ioloop = ioloop
+        self.check_interval = check_interval
 
-            url = 'http://%s:%s/station/%s/on/%s/' % (SERVER_HOST, SERVER_PORT, 
-                event.station, event.minutes)
+        self.events = []
+        self.index = ScheduleIndex()
 
-            os.system('echo "curl -s -X POST %s >/dev/null 2>&1" | at %s today' % (url, event.start_time))
+        # What the file looked like when it was last loaded
+        self.mtime = None
+        self.digest = None
+
+        self._timeout = None
+        self._checker = None
+
+    def start(self):
+        """
+        Loads the schedule file (if there is one), starts the timer and starts
+        watching the file for changes.
+        """
+        # Only the server runs the schedule, so checking a file from the
+        # command line doesn't import tornado
+        import tornado.ioloop
+
+        self._checker = tornado.ioloop.PeriodicCallback(self._check_for_changes,
+            self.check_interval * 1000, io_loop=self.ioloop)
+        self._checker.start()
+
+        if not os.path.exists(self.file_path):
+            Event.log("No schedule file found at %s. Scheduler is idle." % self.file_path)
+            return
+        self.reload()
+
+    def reload(self):
+        """
+        Reads the schedule file and brings the index up to date. Returns
+        (added, removed) counts. If the file is invalid, a ScheduleError
+        listing every problem is raised and the current schedule stays.
+        """
+        try:
+            mtime = os.stat(self.file_path).st_mtime
+            with open(self.file_path, 'r') as f:
+                data = f.read()
+        except (IOError, OSError):
+            raise ScheduleError("Error opening schedule file: %s" % self.file_path)
+
+        self.mtime = mtime
+        digest = hashlib.sha1(data).hexdigest()
+        if digest == self.digest:
+            return 0, 0
+
+        events = parse_events(data)
+        self.digest = digest
+
+        # Work out which events are new and which are gone. Events that are
+        # in both versions are left alone.
+        old = {}
+        for event in self.events:
+            old.setdefault(event.key, []).append(event)
+
+        kept = []
+        added = []
+        for event in events:
+            if old.get(event.key):
+                kept.append(old[event.key].pop())
+            else:
+                added.append(event)
+        removed = [event for remaining in old.values() for event in remaining]
+
+        for event in removed:
+            self.index.remove(event)
+        for event in added:
+            self.index.add(event)
+        self.events = kept + added
+
+        Event.log("Loaded schedule from %s: %d events, %d added, %d removed" % (self.file_path,
+            len(self.events), len(added), len(removed)))
+
+        self._arm()
+        return len(added), len(removed)
+
+    def upcoming(self, limit=None):
+        """
+        Returns (datetime, event) pairs for the next run of every event, soonest first.
+        """
+        now = clock.now()
+        runs = sorted((event.next_run(now), event) for event in self.events)
+        return runs[:limit]
+
+    def _check_for_changes(self):
+        try:
+            mtime = os.stat(self.file_path).st_mtime
+        except OSError:
+            return
+
+        if mtime == self.mtime:
+            return
+
+        try:
+            self.reload()
+        except ScheduleError, e:
+            for error in e.errors:
+                Event.log("Schedule not reloaded: %s" % error)
+
+    def _arm(self, after=None):
+        if self._timeout is not None:
+            self.ioloop.remove_timeout(self._timeout)
+            self._timeout = None
+
+        next_slot = self.index.next_slot(after or clock.now())
+        if next_slot is None:
+            return
+
+        slot, run_at = next_slot
+        self._timeout = self.ioloop.add_timeout(time.mktime(run_at.timetuple()),
+            functools.partial(self._fire, slot, run_at))
+
+    def _fire(self, slot, run_at):
+        self._timeout = None
+
+        for event in self.index.events_at(slot):
+            Event.log("Running scheduled event: Run station %s for %s minutes" % (event.station,
+                event.minutes))
+            try:
+                self.run_callback(event)
+            except Exception, e:
+                Event.log("Scheduled event for station %s failed: %s" % (event.station, e))
+
+        # Arm the timer for the next minute that has something in it
+        self._arm(after=run_at)
+
+
+if __name__ == "__main__":
+
+    # Parse command-line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--file', required=True)
+    parser.add_argument("--test", action="store_true", dest="test", default=False)
+    args = vars(parser.parse_args())
+
+    # Read and check the schedule file
+    file_path = os.path.abspath(args['file'])
+    try:
+        events = load_events(file_path)
+    except ScheduleError, e:
+        sys.exit("Error reading schedule:\n" + "\n".join(e.errors))
+
+    # If we get a dump flag, we just want to output the schedule
+    if args['test']:
+        for event in events:
+            print event
+        sys.exit()
+
+    # The server runs the schedule itself; tell it to pick up the changes.
+    # It refuses if this isn't the file it reads.
+    try:
+        print json.dumps(get_client().reload_schedule(file_path))
+    except ServerError, e:
+        sys.exit("Server could not reload the schedule: %s" % e)
+    except ServerUnavailable, e:
+        sys.exit(str(e))
@@ -3,214 +3,1328 @@ import datetime
 import functools
 import json
 import os
-import time
+import socket
 
+import tornado.gen
+import tornado.httpclient
+import tornado.httpserver
+import tornado.httputil
 import tornado.ioloop
+import tornado.iostream
+import tornado.log
+import tornado.netutil
 import tornado.web
 
-from sprinkler import OpenSprinkler
+from actuator import (METRICS_INTERVAL, ActuatorClient, ActuatorServer, RemoteController,
+    RemoteRegistry, WorkerPool)
+import clock
+from controllers import ControllerRegistry
+from events import EVENT_TYPES, parse_time
+from executors import FILE_IO_WORKERS, Executor
+from history import HistoryReader
+import localclient
+import metrics
+from profiling import MAX_PROFILE_SECONDS, SORT_FIELDS, Profiler, SlowCallbackDetector, summarize
+from runqueue import RunQueue
+from scheduler.scheduler import Event, ScheduleError, ScheduleService
+from stream import KEEPALIVE_INTERVAL, MAX_PENDING_EVENTS, StreamHub, format_event
+from usage import PERIODS
+from watchdog import Watchdog
 
+CUR_DIR = os.path.dirname(os.path.realpath(__file__))
+
+# Stations on the main board plus any chained expansion boards (8 per board)
 NUMBER_OF_STATIONS = 8
 DEBUG = True
 
-class DelayCreateHandler(tornado.web.RequestHandler):
+# The longest a station can be run for at once, in minutes. Scheduled events
+# are held to MAX_RUN_MINUTES in scheduler/scheduler.py; keep the two equal.
+MAX_RUN_MINUTES = 30
+
+# The watchdog stops any station that has run for longer than this many
+# minutes (or the station's own limit from controllers.json)
+MAX_STATION_RUNTIME_MINUTES = MAX_RUN_MINUTES
+
+# The watchdog writes this file so utilities/check_pids.py can tell whether the
+# server is alive and what it has running
+HEARTBEAT_FILE_PATH = os.path.join(CUR_DIR, 'heartbeat.json')
+
+# How many stations can run at the same time. When a station is started and
+# this many are already running, the one that started first is stopped. Your
+# water supply has to be able to keep up with this many zones at once.
+MAX_CONCURRENT_STATIONS = 1
+
+# The station wired to a master valve or pump, if any. It is turned on whenever
+# any other station runs and can't be operated by itself.
+MASTER_STATION = None
+
+# How much water each station uses per minute (in gallons, litres or any
+# other unit), used to estimate volume in /usage/, e.g. {1: 2.5, 2: 4}.
+# Controllers in controllers.json can set their own "flow_rates".
+FLOW_RATES = {}
+
+# How many processes serve HTTP. With 0, this process does everything, as it
+# always has. Otherwise this process (the actuator) keeps the hardware,
+# timers and state, and forks this many workers to serve requests. Workers
+# serve /status/, /history/ and /events/ themselves, send commands to the
+# actuator over ACTUATOR_SOCKET_PATH, and pass everything else on to it over
+# ACTUATOR_HTTP_SOCKET_PATH.
+WORKER_PROCESSES = 0
+ACTUATOR_SOCKET_PATH = localclient.SOCKET_PATH
+ACTUATOR_HTTP_SOCKET_PATH = os.path.join(CUR_DIR, 'actuator-http.sock')
+
+# ACTUATOR_SOCKET_PATH is always open, for the scheduler and other tools on
+# the Pi. Only the user running the server can use it unless this is changed,
+# e.g. to 0o660 for its group.
+LOCAL_SOCKET_MODE = 0o600
+
+# Whether a program that was running when the server stopped carries on when it
+# starts again. If not, it is dropped.
+RESUME_PROGRAMS = True
+
+# Whether stations that were running when the server stopped unexpectedly are
+# turned back on for whatever time they had left. If not, they stay off.
+RESUME_RUNS = True
+
+# The schedule the server runs. See docs/scheduler.md
+SCHEDULE_FILE_PATH = os.path.join(CUR_DIR, 'scheduler', 'schedule.json')
+
+# The most operations a single /batch/ request can carry
+BATCH_MAX_OPERATIONS = 500
+
+# /admin/ endpoints answer requests carrying this token in an X-Admin-Token
+# header. If it's None, they only answer requests from this machine.
+ADMIN_TOKEN = None
+
+# Requests that take at least this long (in seconds) are logged
+SLOW_REQUEST_SECONDS = 0.5
+
+# The most history entries a single /history/ request will return
+HISTORY_DEFAULT_LIMIT = 100
+HISTORY_MAX_LIMIT = 1000
+
+# The most events a single /events/ request will return
+EVENTS_DEFAULT_LIMIT = 100
+EVENTS_MAX_LIMIT = 1000
+
+
+def run_station(sprinkler, station, minutes, on_complete=None):
+    """
+    Operates a station and has the IOLoop stop it when the time is up, then
+    call on_complete (if given). Returns False if a delay or standby kept the
+    station from running.
+
+    Every running station has its own timer. If the controller was already
+    running as many stations as it can, the one that started first is turned
+    off; if that was a program's station (or a manual run takes over the
+    program's station) the program is abandoned.
+    """
+    # Operate the station
+    if not sprinkler.operate_station(station, minutes):
+        return False
+
+    ioloop = sprinkler.ioloop
+    current = sprinkler.run_queue.current_station
+
+    # Cancel the callbacks for stations that were turned off to make room, and
+    # for this station if it was already running. We don't want them to fire,
+    # otherwise they would stop the new job when they did
+    for running_station in sprinkler.timeouts.keys():
+        if running_station == station or running_station not in sprinkler.runs:
+            ioloop.remove_timeout(sprinkler.timeouts.pop(running_station))
+
+    if on_complete is None and current is not None and (current == station or current not in sprinkler.runs):
+        sprinkler.log('Program interrupted by station %d.' % station)
+        sprinkler.run_queue.abandon()
+
+    # Schedule the ioloop to call the done function when the operation is complete
+    callback = functools.partial(finish_station, sprinkler, station, on_complete)
+    sprinkler.timeouts[station] = ioloop.add_timeout(clock.time() + minutes * 60, callback)
+
+    return True
+
+
+def resume_runs(sprinkler):
+    """
+    Turns back on the stations that were running when the server stopped (as
+    recorded in the state file) and sets their timers for the time they had
+    left. Runs that have expired since are left off.
+    """
+    ioloop = sprinkler.ioloop
+    for station, (started, expires) in sorted(sprinkler.saved_runs.items()):
+        if sprinkler.resume_station(station, started, expires):
+            callback = functools.partial(finish_station, sprinkler, station, None)
+            sprinkler.timeouts[station] = ioloop.add_timeout(expires, callback)
+    sprinkler.saved_runs = {}
+
+
+def finish_station(sprinkler, station, on_complete):
+    """
+    Called by the IOLoop when a station's time is up.
+    """
+    sprinkler.timeouts.pop(station, None)
+
+    # Keep track of how late the IOLoop got round to stopping the station
+    if station in sprinkler.runs:
+        metrics.TIMER_DRIFT_SECONDS.observe(max(0.0, clock.time() - sprinkler.runs[station][1]))
+
+    sprinkler.stop_station(station)
+    if on_complete:
+        on_complete()
+
+
+def stop_station(sprinkler, station):
+    """
+    Stops a station (0 for all of them) and cancels the callback that would
+    have stopped it. A program is cancelled too if its station is stopped.
+    """
+    if station == 0 or station == sprinkler.run_queue.current_station:
+        sprinkler.run_queue.abandon()
+
+    # Cancel any scheduled callbacks from the operations being stopped
+    ioloop = sprinkler.ioloop
+    for running_station in sprinkler.timeouts.keys():
+        if station == 0 or running_station == station:
+            ioloop.remove_timeout(sprinkler.timeouts.pop(running_station))
+
+    sprinkler.stop_station(station)
+
+
+class RequestHandler(tornado.web.RequestHandler):
+    """
+    The base for every handler. Lets the profiler know when requests start
+    and finish.
+    """
+
+    def prepare(self):
+        self.settings['profiler'].request_started(self)
+
+    def on_finish(self):
+        self.settings['profiler'].request_finished(self)
+
+    def run_blocking(self, key, fn, *args, **kwargs):
+        """
+        Runs blocking file work on the file executor, in order with other work
+        on the same key, and returns a Future. Without an executor it runs
+        right away.
+        """
+        files = self.settings.get('files')
+        if files is None:
+            return tornado.gen.maybe_future(fn(*args, **kwargs))
+        return files.submit(fn, *args, key=key, **kwargs)
+
+
+class BaseHandler(RequestHandler):
+
+    def prepare(self):
+        """
+        Finds the controller the request is for. URLs under /controller/<id>/
+        name one; every other URL is for the default controller.
+        """
+        RequestHandler.prepare(self)
+
+        controller_id = self.path_kwargs.pop('controller_id', None)
+        self.sprinkler = self.settings['registry'].get(controller_id)
+
+        if self.sprinkler is None:
+            self.set_status(404)
+            self.finish({ 'error': 'Controller %s does not exist' % controller_id })
+
+    def check_station(self, station):
+        """
+        Makes sure a station number from the URL exists on this controller.
+        If it doesn't, a 404 is written and False is returned.
+        """
+        if 1 <= station <= self.sprinkler.number_of_stations:
+            return True
+        self.set_status(404)
+        self.write({ 'error': 'Station %d does not exist' % station })
+        return False
+
+    def check_not_master(self, station):
+        """
+        The master valve only runs along with other stations. If the station
+        is the master, a 400 is written and False is returned.
+        """
+        if station != self.sprinkler.master_station:
+            return True
+        self.set_status(400)
+        self.write({ 'error': 'Station %d is the master valve and runs with the other stations' % station })
+        return False
+
+    @tornado.gen.coroutine
+    def run_operation(self, op, **params):
+        """
+        Applies one operation to this controller the same way /batch/ does
+        (so with worker processes, it goes to the actuator). Resolves to the
+        operation's result, or None if it was rejected, in which case a 400
+        has been written.
+        """
+        params.update(op=op, controller=self.sprinkler.controller_id)
+        response = yield tornado.gen.maybe_future(self.settings['execute']([params]))
+        if 'results' not in response:
+            self.set_status(400)
+            self.write({ 'error': response['error'], 'errors': response.get('errors', []) })
+            raise tornado.gen.Return(None)
+        raise tornado.gen.Return(response['results'][0])
+
+
+class DelayCreateHandler(BaseHandler):
 
     def get(self, **kwargs):
         self.set_status(405)
         self.write(json.dumps({'error': 'GET is not supported for this endpoint'}))
 
+    @tornado.gen.coroutine
     def post(self, _station, _hours):
 
         # Cast the station and hours to integers
         station = int(_station)
         hours = int(_hours)
 
+        if not self.check_station(station):
+            return
+
         # Create the delay
-        sprinkler.create_delay(station, hours)
+        result = yield self.run_operation('delay_create', station=station, hours=hours)
+        if result is None:
+            return
         self.write({'response':'ok', 'error': None })
 
 
-class DelayRemoveHandler(tornado.web.RequestHandler):
+class DelayRemoveHandler(BaseHandler):
 
     def get(self, **kwargs):
         self.set_status(405)
         self.write(json.dumps({'error': 'GET is not supported for this endpoint'}))
 
+    @tornado.gen.coroutine
     def post(self, _station=0):
 
-        # Cast the station to an integer
+        # Cast the station to an integer (0 means all stations)
         station = int(_station)
 
+        if station and not self.check_station(station):
+            return
+
         # Remove the delay
-        result = sprinkler.remove_delay(station)
-        
-        if result == True:
+        result = yield self.run_operation('delay_remove', station=station)
+        if result is None:
+            return
+
+        if result['error'] is None:
             self.write({ 'response': 'ok', 'error': None })
         else:
             self.set_status(404)
-            self.write({ 'error': 'No delay was set on station %s' % _station })
+            self.write({ 'error': result['error'] })
 
 
-class StationOnHandler(tornado.web.RequestHandler):
+class StationOnHandler(BaseHandler):
 
     def get(self, **kwargs):
         self.set_status(405)
         self.write(json.dumps({'error': 'GET is not supported for this endpoint'}))
 
+    @tornado.gen.coroutine
     def post(self, _station, _minutes):
 
         # Cast the station and minutes to integers
         station = int(_station)
         minutes = int(_minutes)
 
-        # Cancel any callbacks that would have been scheduled by currently
-        # running jobs. We don't want them to fire, otherwise they would stop
-        # the new job when they did
-        if sprinkler.ioloop_timeout:
-            tornado.ioloop.IOLoop.instance().remove_timeout(sprinkler.ioloop_timeout)
-
-        # Calculate the callback delay in seconds
-        delay = time.time() + (minutes * 60)
+        if not self.check_station(station) or not self.check_not_master(station):
+            return
 
         # Operate the station
-        result = sprinkler.operate_station(station, minutes)
+        result = yield self.run_operation('station_on', station=station, minutes=minutes)
+        if result is None:
+            return
 
-        # Schedule the ioloop to call the done function when the operation is complete
-        callback = functools.partial(sprinkler.stop_station, station)
-        sprinkler.ioloop_timeout = tornado.ioloop.IOLoop.instance().add_timeout(delay, callback)
-
-        if result == True:
+        if result['error'] is None:
             self.write({ 'response': 'ok', 'error': None })
         else:
             self.set_status(403)
-            self.write({ 'error': 'Could not operate station. Delay or Standby in effect.' })
+            self.write({ 'error': result['error'] })
 
 
-class StationOffHandler(tornado.web.RequestHandler):
+class StationOffHandler(BaseHandler):
 
     def get(self, **kwargs):
         self.set_status(405)
         self.write(json.dumps({'error': 'GET is not supported for this endpoint'}))
 
+    @tornado.gen.coroutine
     def post(self, _station=0):
 
-        # Cast the station to an integer
+        # Cast the station to an integer (0 means all stations)
         station = int(_station)
 
-        # Cancel any scheduled callbacks from currently running operations
-        if sprinkler.ioloop_timeout:
-            tornado.ioloop.IOLoop.instance().remove_timeout(sprinkler.ioloop_timeout)
+        if station and not self.check_station(station):
+            return
 
         # Stop the station
-        sprinkler.stop_station(station)
+        result = yield self.run_operation('station_off', station=station)
+        if result is None:
+            return
         self.write({ 'response': 'ok', 'error': None })
 
 
-class StandbyHandler(tornado.web.RequestHandler):
+class StandbyHandler(BaseHandler):
     
     def get(self, **kwargs):
         self.set_status(405)
         self.write(json.dumps({'error': 'GET is not supported for this endpoint'}))
 
+    @tornado.gen.coroutine
     def post(self, mode):
         
         if mode == 'create':
-            result = sprinkler.create_standby()
-            if result == True:
+            result = yield self.run_operation('standby_create')
+            if result is None:
+                return
+            if result['error'] is None:
                 self.write({ 'response': 'ok', 'error': None })
             else:
                 self.set_status(403)
-                self.write(json.dumps({'error': 'System is already in standby mode'}))
+                self.write(json.dumps({'error': result['error']}))
         
         elif mode == 'remove':
-            result = sprinkler.remove_standby()
-            if result == True:
+            result = yield self.run_operation('standby_remove')
+            if result is None:
+                return
+            if result['error'] is None:
                 self.write({ 'response': 'ok', 'error': None })
             else:
                 self.set_status(404)
-                self.write(json.dumps({'error': 'System is not in standby mode'}))
+                self.write(json.dumps({'error': result['error']}))
         
         else:
             self.set_status(404)
             self.write(json.dumps({'error': 'Mode unknown'}))
         
     
-class StatusHandler(tornado.web.RequestHandler):
+class StatusHandler(BaseHandler):
 
     def get(self):
 
-        # We're going to build up a dictionary of station statuses
-        status = {}
-
-        # Loop through each station and figure out if it's running, off, or delayed
-        for station_number in range(1, sprinkler.number_of_stations+1):
-            # See if a delay file exists
-            if os.path.exists('DELAY-%d' % station_number):
-                with open('DELAY-%d' % station_number) as f:
-                    status[station_number] = { 'state': 'delayed','expires': f.read() }
-            elif sprinkler.station_values[station_number-1] == 1:
-                expiration = sprinkler.current_operation_complete
-                status[station_number] = { 'state': 'running', 'expires': expiration }
-            else:
-                status[station_number] = { 'state':'off', 'expires': None }
+        # The snapshot is only rebuilt when the controller state changes
+        etag, body = self.sprinkler.status_snapshot()
+        self.set_header('Etag', etag)
+
+        # If the client already has this version, don't send it again
+        if self.check_etag_header():
+            self.set_status(304)
+            return
 
-        # Status is a dictionary so it will be returned as JSON
-        self.write(status)
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.write(body)
 
 
-class HistoryHandler(tornado.web.RequestHandler):
+class HistoryHandler(BaseHandler):
 
+    @tornado.gen.coroutine
     def get(self):
 
-        # Open up the log file and get the contents
-        with open('log.txt', 'r') as f:
-            contents = f.readlines()
+        # Read the paging arguments. `before` is either the offset of an entry
+        # from a previous page or a timestamp, `since` is a timestamp.
+        try:
+            limit = int(self.get_argument('limit', HISTORY_DEFAULT_LIMIT))
+        except ValueError:
+            self.set_status(400)
+            self.write(json.dumps({'error': 'limit must be an integer'}))
+            return
 
-        # Get the last 100 lines of the contents
-        last_lines = [line.strip().split("\t") for line in reversed(contents)][:100]
+        if limit < 1 or limit > HISTORY_MAX_LIMIT:
+            self.set_status(400)
+            self.write(json.dumps({'error': 'limit must be between 1 and %d' % HISTORY_MAX_LIMIT}))
+            return
 
-        # Split the tab-delimited line into an array of dictionaries
-        line_dicts = [{'date': line[0], 'msg': line[1]} for line in last_lines]
+        before = self.get_argument('before', None)
+        if before is not None and before.isdigit():
+            before = int(before)
+
+        since = self.get_argument('since', None)
+
+        # Walk backwards from the end of the log; only the lines we return are
+        # read. Reading (and flushing anything still queued for the log, so it
+        # shows up) is done on the file executor.
+        history = self.settings['histories'][self.sprinkler.controller_id]
+        line_dicts = yield self.run_blocking(history.log_path, read_history,
+            self.sprinkler.logger, history, limit=limit, before=before, since=since)
 
         # Return the JSON-encoded list
         self.write(json.dumps(line_dicts))
 
 
-class IndexHandler(tornado.web.RequestHandler):
+class EventsHandler(BaseHandler):
+
+    @tornado.gen.coroutine
+    def get(self):
+
+        # Every argument is optional: station, type, from and to (epoch
+        # seconds or a local time like '2016-05-14 22:09:48') and limit
+        try:
+            limit = int(self.get_argument('limit', EVENTS_DEFAULT_LIMIT))
+        except ValueError:
+            self.set_status(400)
+            self.write(json.dumps({'error': 'limit must be an integer'}))
+            return
+
+        if limit < 1 or limit > EVENTS_MAX_LIMIT:
+            self.set_status(400)
+            self.write(json.dumps({'error': 'limit must be between 1 and %d' % EVENTS_MAX_LIMIT}))
+            return
+
+        station = self.get_argument('station', None)
+        if station is not None:
+            if not station.isdigit():
+                self.set_status(400)
+                self.write(json.dumps({'error': 'station must be a number'}))
+                return
+            station = int(station)
+
+        event_type = self.get_argument('type', None)
+        if event_type is not None and event_type not in EVENT_TYPES:
+            self.set_status(400)
+            self.write(json.dumps({'error': 'type must be one of %s' % ', '.join(EVENT_TYPES)}))
+            return
+
+        try:
+            start = self.get_argument('from', None)
+            start = parse_time(start) if start is not None else None
+            end = self.get_argument('to', None)
+            end = parse_time(end) if end is not None else None
+        except ValueError, e:
+            self.set_status(400)
+            self.write(json.dumps({'error': str(e)}))
+            return
+
+        # Newest first, found through the (station, time) or (type, time) index
+        events = yield self.sprinkler.events.query_async(station=station, event_type=event_type,
+            start=start, end=end, limit=limit)
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.write(json.dumps(events))
+
+
+class UsageHandler(BaseHandler):
+
+    def get(self):
+
+        # period is hour, day or month; from and to are dates like
+        # '2016-05-14' (or '2016-05', or '2016-05-14T06' for hours)
+        period = self.get_argument('period', 'day')
+        if period not in PERIODS:
+            self.set_status(400)
+            self.write(json.dumps({'error': 'period must be one of %s' % ', '.join(PERIODS)}))
+            return
+
+        station = self.get_argument('station', None)
+        if station is not None:
+            if not station.isdigit():
+                self.set_status(400)
+                self.write(json.dumps({'error': 'station must be a number'}))
+                return
+            station = int(station)
+
+        start = self.get_argument('from', None)
+        end = self.get_argument('to', None)
+        if start is not None:
+            start = start.strip().replace(' ', 'T')
+        if end is not None:
+            end = end.strip().replace(' ', 'T')
+
+        buckets = self.sprinkler.usage.query(period=period, station=station, start=start, end=end)
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.write(json.dumps({'period': period, 'buckets': buckets}))
+
+
+class QueueHandler(BaseHandler):
+
+    def get(self):
+
+        # Show the program that's running (if any) and how far along it is
+        self.write(self.sprinkler.run_queue.status())
+
+    def post(self):
+
+        # The body is a JSON object like
+        # {"steps": [{"station": 1, "minutes": 10}, ...], "gap": 30}
+        try:
+            body = json.loads(self.request.body)
+            steps = [(int(step['station']), int(step['minutes'])) for step in body['steps']]
+            gap = int(body.get('gap', 0))
+        except (ValueError, KeyError, TypeError):
+            self.set_status(400)
+            self.write({ 'error': 'Body must be JSON with a list of steps, each with a station and minutes' })
+            return
+
+        if not steps:
+            self.set_status(400)
+            self.write({ 'error': 'A program needs at least one step' })
+            return
+
+        for station, minutes in steps:
+            if not self.check_station(station) or not self.check_not_master(station):
+                return
+            if not 1 <= minutes <= MAX_RUN_MINUTES:
+                self.set_status(400)
+                self.write({ 'error': 'Steps must run between 1 and %d minutes' % MAX_RUN_MINUTES })
+                return
+
+        if gap < 0:
+            self.set_status(400)
+            self.write({ 'error': 'gap must not be negative' })
+            return
+
+        self.sprinkler.run_queue.submit(steps, gap)
+        self.write(self.sprinkler.run_queue.status())
+
+
+class QueueCommandHandler(BaseHandler):
+
+    def get(self, **kwargs):
+        self.set_status(405)
+        self.write(json.dumps({'error': 'GET is not supported for this endpoint'}))
+
+    def post(self, command):
+
+        if command == 'skip':
+            result = self.sprinkler.run_queue.skip()
+        else:
+            result = self.sprinkler.run_queue.cancel()
+
+        if result == True:
+            self.write({ 'response': 'ok', 'error': None })
+        else:
+            self.set_status(404)
+            self.write({ 'error': 'No program is running' })
+
+
+class BatchHandler(RequestHandler):
+
+    def get(self, **kwargs):
+        self.set_status(405)
+        self.write(json.dumps({'error': 'GET is not supported for this endpoint'}))
+
+    @tornado.gen.coroutine
+    def post(self):
+
+        # The body is a JSON list of operations like
+        # [{"op": "delay_create", "station": 1, "hours": 24, "controller": "back"}, ...]
+        try:
+            items = json.loads(self.request.body)
+        except ValueError:
+            self.set_status(400)
+            self.write({ 'error': 'Body must be a JSON list of operations' })
+            return
+
+        response = yield tornado.gen.maybe_future(self.settings['execute'](items))
+        if 'results' not in response:
+            self.set_status(400)
+        self.write(response)
+
+
+class StreamHandler(RequestHandler):
+    """
+    Server-Sent Events feed of every controller: a snapshot when the client
+    connects, then a delta whenever something changes and each new log line.
+    Clients that fall too far behind are disconnected.
+    """
+
+    @tornado.web.asynchronous
+    def get(self):
+        self.set_header('Content-Type', 'text/event-stream')
+        self.set_header('Cache-Control', 'no-cache')
+
+        # Events written since the connection's buffer was last empty
+        self.pending = 0
+
+        self.keepalive = tornado.ioloop.PeriodicCallback(self._keepalive, KEEPALIVE_INTERVAL * 1000)
+        self.keepalive.start()
+
+        self.hub = self.settings['stream']
+        self.hub.subscribe(self)
+
+    def send(self, event, data):
+        if self.pending >= MAX_PENDING_EVENTS:
+            self._stop()
+            self.request.connection.close()
+            return
+
+        self.write(format_event(event, data))
+        self._flush()
+
+    def on_connection_close(self):
+        self._stop()
+
+    def _keepalive(self):
+        self.write(': keepalive\n\n')
+        self._flush()
+
+    def _flush(self):
+        # The future resolves once everything written so far has been sent
+        self.pending += 1
+        future = self.flush()
+        if future is not None:
+            future.add_done_callback(self._flushed)
+
+    def _flushed(self, future):
+        self.pending = 0
+
+    def _stop(self):
+        self.hub.unsubscribe(self)
+        self.keepalive.stop()
+
+
+class ScheduleHandler(RequestHandler):
+
+    def get(self):
+
+        # List the upcoming run of every scheduled event, soonest first
+        self.write(json.dumps(upcoming_runs(self.settings['schedule'])))
+
+
+class ScheduleReloadHandler(RequestHandler):
+
+    def get(self, **kwargs):
+        self.set_status(405)
+        self.write(json.dumps({'error': 'GET is not supported for this endpoint'}))
+
+    def post(self):
+
+        # Read the schedule file again. If it's invalid, the old schedule stays.
+        try:
+            result = reload_schedule(self.settings['schedule'])
+        except ScheduleError, e:
+            self.set_status(400)
+            self.write({ 'error': 'Invalid schedule', 'errors': e.errors })
+            return
+
+        result.update(response='ok', error=None)
+        self.write(result)
+
+
+class ControllersHandler(RequestHandler):
+
+    def get(self):
+
+        # List the controllers this server drives, default first
+        self.write(json.dumps(list_controllers(self.settings['registry'])))
+
+
+class MetricsHandler(RequestHandler):
+
+    def get(self):
+
+        # Prometheus text exposition format, with the workers' requests
+        # added in
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(metrics.render(self.settings['worker_metrics']()))
+
+
+class ProfileHandler(RequestHandler):
+    """
+    Profiles the running server. POST with ?seconds= to profile everything for
+    that long, or with ?handler=<class name>&requests= to profile the next
+    requests to one handler. The response comes back when the profile is done.
+    """
+
+    def prepare(self):
+        RequestHandler.prepare(self)
+
+        # Only the admin can profile the server
+        token = self.request.headers.get('X-Admin-Token')
+        if ADMIN_TOKEN is not None:
+            allowed = token == ADMIN_TOKEN
+        else:
+            allowed = self.request.remote_ip in ('127.0.0.1', '::1')
+
+        if not allowed:
+            self.set_status(403)
+            self.finish({ 'error': 'Admin access required' })
+
+    def get(self):
+
+        # Show the profile that's running, if any
+        self.write(self.settings['profiler'].status())
+
+    @tornado.gen.coroutine
+    def post(self):
+        profiler = self.settings['profiler']
+
+        try:
+            seconds = float(self.get_argument('seconds', 0))
+            count = int(self.get_argument('requests', 0))
+            limit = int(self.get_argument('limit', 30))
+        except ValueError:
+            self.set_status(400)
+            self.write({ 'error': 'seconds, requests and limit must be numbers' })
+            return
+
+        handler_name = self.get_argument('handler', None)
+        sort = self.get_argument('sort', 'cumulative')
+
+        if sort not in SORT_FIELDS:
+            self.set_status(400)
+            self.write({ 'error': 'sort must be one of %s' % ', '.join(sorted(SORT_FIELDS)) })
+            return
+
+        # This process can only profile the requests it handles itself
+        if WORKER_PROCESSES and handler_name in [handler.__name__ for handler in WORKER_HANDLERS]:
+            self.set_status(400)
+            self.write({ 'error': '%s runs in the worker processes, which can\'t be profiled' %
+                handler_name })
+            return
+
+        if profiler.active:
+            self.set_status(409)
+            self.write({ 'error': 'A profile is already running' })
+            return
+
+        if handler_name and count > 0:
+            stats = yield profiler.profile_requests(handler_name, count)
+        elif 0 < seconds <= MAX_PROFILE_SECONDS:
+            stats = yield profiler.profile_window(seconds)
+        else:
+            self.set_status(400)
+            self.write({ 'error': 'Give seconds (up to %d) or a handler and a number of requests' %
+                MAX_PROFILE_SECONDS })
+            return
+
+        self.write({ 'response': 'ok', 'error': None, 'functions': summarize(stats, limit, sort) })
+
+
+class UnixResolver(tornado.netutil.Resolver):
+    """
+    Resolves every host name to a Unix domain socket, so the HTTP client can
+    talk to the actuator.
+    """
+
+    def initialize(self, path, io_loop=None):
+        self.path = path
+
+    def close(self):
+        pass
+
+    @tornado.gen.coroutine
+    def resolve(self, host, port, family=socket.AF_UNSPEC):
+        raise tornado.gen.Return([(socket.AF_UNIX, self.path)])
+
+
+class ActuatorProxyHandler(RequestHandler):
+    """
+    Used by workers for everything they don't serve themselves. The request
+    is passed to the actuator's application and the response is streamed
+    back as it arrives, so /stream/ works too.
+    """
+
+    SUPPORTED_METHODS = ('GET', 'POST')
+
+    def initialize(self):
+        self.closed = False
+
+    @tornado.gen.coroutine
+    def get(self, *args):
+        headers = tornado.httputil.HTTPHeaders(self.request.headers)
+        headers['X-Real-Ip'] = self.request.remote_ip
+        headers.pop('Connection', None)
+
+        request = tornado.httpclient.HTTPRequest('http://actuator%s' % self.request.uri,
+            method=self.request.method, headers=headers,
+            body=self.request.body if self.request.method == 'POST' else None,
+            header_callback=self._header_received, streaming_callback=self._chunk_received,
+            follow_redirects=False, decompress_response=False, request_timeout=0)
+
+        try:
+            response = yield self.settings['proxy_client'].fetch(request, raise_error=False)
+        except tornado.iostream.StreamClosedError:
+            return
+
+        if self.closed:
+            return
+        if response.code == 599 and not self._headers_written:
+            self.clear()
+            self.set_status(502)
+            self.write({ 'error': 'The actuator is not responding' })
+        self.finish()
+
+    post = get
+
+    def on_connection_close(self):
+        self.closed = True
+
+    def _header_received(self, line):
+        if line.startswith('HTTP/'):
+            start_line = tornado.httputil.parse_response_start_line(line.strip())
+            self.set_status(start_line.code, start_line.reason)
+            self.clear_header('Content-Type')
+        elif line.strip():
+            name, value = line.split(':', 1)
+            if name.lower() not in ('content-length', 'transfer-encoding', 'connection', 'date', 'server'):
+                self.add_header(name, value.strip())
+
+    def _chunk_received(self, chunk):
+        # Stop relaying (which closes the connection to the actuator) once
+        # the client has gone
+        if self.closed:
+            raise tornado.iostream.StreamClosedError()
+        self.write(chunk)
+        self.flush()
+
+
+class IndexHandler(RequestHandler):
 
     def get(self):
         self.write('<!-- Index goes here -->')
 
 
-if __name__ == "__main__":
+def read_history(logger, history, **kwargs):
+    """
+    Flushes a controller's log and reads a page of its history.
+    """
+    logger.flush()
+    return history.read(**kwargs)
+
+
+def upcoming_runs(schedule):
+    """
+    Lists every scheduled event with its next run, soonest first.
+    """
+    runs = []
+    for run_at, event in schedule.upcoming():
+        run = event.to_dict()
+        run['next_run'] = run_at.isoformat()
+        runs.append(run)
+    return runs
+
+
+def reload_schedule(schedule):
+    """
+    Reads the schedule file again and says what changed. Raises a
+    ScheduleError if it's invalid, in which case the old schedule stays.
+    """
+    added, removed = schedule.reload()
+    return { 'events': len(schedule.events), 'added': added, 'removed': removed }
+
+
+def list_controllers(registry):
+    return [{'id': sprinkler.controller_id, 'stations': sprinkler.number_of_stations,
+        'max_concurrency': sprinkler.max_concurrency, 'master_station': sprinkler.master_station}
+        for sprinkler in registry]
+
+
+def make_calls(registry, schedule):
+    """
+    Returns the calls the local socket offers besides operations, for the
+    scheduler, check_pids and other tools on the Pi (see localclient.py).
+    """
+
+    def controller_status(message):
+        sprinkler = registry.get(message.get('controller'))
+        if sprinkler is None:
+            raise ValueError('Controller %s does not exist' % message.get('controller'))
+        etag, body = sprinkler.status_snapshot()
+        return json.loads(body)
+
+    def schedule_reload(message):
+        # A tool that checked a file first says which, so it doesn't report
+        # success for a file the server never reads
+        file_path = message.get('file')
+        if file_path and os.path.realpath(file_path) != os.path.realpath(schedule.file_path):
+            raise ValueError('The server runs the schedule in %s, not %s' % (schedule.file_path, file_path))
+        try:
+            return reload_schedule(schedule)
+        except ScheduleError, e:
+            raise ValueError('Invalid schedule: %s' % '; '.join(e.errors))
+
+    return {
+        'status': controller_status,
+        'controllers': lambda message: list_controllers(registry),
+        'schedule': lambda message: upcoming_runs(schedule),
+        'schedule_reload': schedule_reload,
+    }
+
+
+def run_scheduled_event(registry, event):
+    """
+    Called by the schedule service when an event is due.
+    """
+    sprinkler = registry.get(event.controller)
+    if sprinkler is None:
+        Event.log("Scheduled event is for unknown controller %s. Skipping." % event.controller)
+        return
+    run_station(sprinkler, event.station, event.minutes)
+
+
+# The operations /batch/ understands and the parameters each one takes
+BATCH_OPERATIONS = {
+    'station_on': ('station', 'minutes'),
+    'station_off': ('station',),
+    'delay_create': ('station', 'hours'),
+    'delay_remove': ('station',),
+    'standby_create': (),
+    'standby_remove': (),
+}
 
-    app = tornado.web.Application([
-        (r'/delay/(?P<_station>[1-8])/create/(?P<_hours>\d{1,})/', DelayCreateHandler),
-        (r'/delay/(?P<_station>[1-8])/remove/', DelayRemoveHandler),
+
+def parse_batch_operation(registry, item):
+    """
+    Checks one /batch/ operation and returns (sprinkler, op, params). Raises a
+    ValueError describing the problem if it's invalid.
+    """
+    try:
+        op = item['op']
+    except (KeyError, TypeError):
+        raise ValueError('Operation must be an object with an op')
+
+    if not isinstance(op, basestring) or op not in BATCH_OPERATIONS:
+        raise ValueError('Unknown operation: %s' % op)
+
+    try:
+        params = dict((name, int(item[name])) for name in BATCH_OPERATIONS[op])
+    except KeyError, e:
+        raise ValueError('Missing key: %s' % e)
+    except (TypeError, ValueError):
+        raise ValueError('Parameters must be integers')
+
+    sprinkler = registry.get(item.get('controller'))
+    if sprinkler is None:
+        raise ValueError('Controller %s does not exist' % item.get('controller'))
+
+    # Station 0 means all stations when turning off or removing delays
+    station = params.get('station')
+    if station is not None and not (station == 0 and op in ('station_off', 'delay_remove')):
+        if not 1 <= station <= sprinkler.number_of_stations:
+            raise ValueError('Station %d does not exist' % station)
+
+    if op == 'station_on':
+        if station == sprinkler.master_station:
+            raise ValueError('Station %d is the master valve and runs with the other stations' % station)
+        if not 1 <= params['minutes'] <= MAX_RUN_MINUTES:
+            raise ValueError('minutes must be between 1 and %d' % MAX_RUN_MINUTES)
+
+    if op == 'delay_create' and params['hours'] < 1:
+        raise ValueError('hours must be at least 1')
+
+    return sprinkler, op, params
+
+
+def run_batch(registry, items):
+    """
+    Checks and applies a list of operations (the body of a /batch/ request,
+    or a command from a worker) and returns the response. If any operation
+    is invalid, none of them are applied and the response has no results.
+
+    Only the checking is all-or-nothing. Once the operations are applied,
+    one that can't take effect (a station held off by a delay, say) gets an
+    error in its result, and the ones before it are not undone.
+    """
+    if type(items) is not list or not 1 <= len(items) <= BATCH_MAX_OPERATIONS:
+        return { 'error': 'Body must be a list of 1 to %d operations' % BATCH_MAX_OPERATIONS }
+
+    # Check every operation before any of them are applied. If one is bad,
+    # nothing is done.
+    operations = []
+    errors = []
+    for number, item in enumerate(items, 1):
+        try:
+            operations.append(parse_batch_operation(registry, item))
+        except ValueError, e:
+            errors.append('Operation %d: %s' % (number, e))
+
+    if errors:
+        return { 'error': 'Invalid batch. No operations were applied.', 'errors': errors }
+
+    results = apply_batch(operations)
+
+    failed = len([result for result in results if result['error']])
+    return { 'response': 'ok', 'error': '%d operations failed' % failed if failed else None,
+        'results': results }
+
+
+def apply_batch(operations):
+    """
+    Applies checked /batch/ operations in order. Each controller involved is
+    updated once at the end: one shift register write, one delay journal
+    append and one status change. Returns a result for each operation.
+
+    This is not a transaction. An operation that fails, or raises, leaves
+    the ones already applied in place, and what they changed is still
+    written out when the batch ends.
+    """
+    sprinklers = []
+    for sprinkler, op, params in operations:
+        if sprinkler not in sprinklers:
+            sprinklers.append(sprinkler)
+
+    for sprinkler in sprinklers:
+        sprinkler.begin_batch()
+
+    results = []
+    try:
+        for sprinkler, op, params in operations:
+            error = None
+
+            if op == 'station_on':
+                if not run_station(sprinkler, params['station'], params['minutes']):
+                    error = 'Could not operate station. Delay or Standby in effect.'
+            elif op == 'station_off':
+                stop_station(sprinkler, params['station'])
+            elif op == 'delay_create':
+                sprinkler.create_delay(params['station'], params['hours'])
+            elif op == 'delay_remove':
+                if not sprinkler.remove_delay(params['station']):
+                    error = 'No delay was set on station %d' % params['station']
+            elif op == 'standby_create':
+                if not sprinkler.create_standby():
+                    error = 'System is already in standby mode'
+            elif op == 'standby_remove':
+                if not sprinkler.remove_standby():
+                    error = 'System is not in standby mode'
+
+            result = dict(params, op=op, controller=sprinkler.controller_id, error=error)
+            results.append(result)
+    finally:
+        for sprinkler in sprinklers:
+            sprinkler.end_batch()
+
+    return results
+
+
+def log_request(handler):
+    """
+    Records how long each request took, then writes the usual access log line.
+    Requests slow enough to have held up the IOLoop are logged.
+    """
+    status = handler.get_status()
+    request_time = handler.request.request_time()
+    metrics.REQUEST_SECONDS.observe(request_time,
+        (type(handler).__name__, handler.request.method, status))
+
+    # Long-running requests like /stream/ and profiles don't block anything.
+    # The actuator logs the requests workers pass on to it.
+    if request_time >= SLOW_REQUEST_SECONDS and not isinstance(handler,
+            (StreamHandler, ProfileHandler, ActuatorProxyHandler)):
+        handler.settings['registry'].get().log('Slow request: %s took %.0fms' %
+            (handler._request_summary(), 1000.0 * request_time))
+
+    if status < 400:
+        log_method = tornado.log.access_log.info
+    elif status < 500:
+        log_method = tornado.log.access_log.warning
+    else:
+        log_method = tornado.log.access_log.error
+    log_method("%d %s %.2fms", status, handler._request_summary(), 1000.0 * request_time)
+
+
+def make_routes(registry):
+    """
+    Returns the routes for the controllers in the registry. Every endpoint
+    is available at its usual URL for the default controller, and under
+    /controller/<id>/ for any controller.
+    """
+
+    # Route pattern for station numbers, sized to the biggest controller.
+    # Numbers that match but are past the last station are rejected by the handlers.
+    station_pattern = r'[1-9]\d{0,%d}' % (len(str(registry.max_stations)) - 1)
+
+    routes = [
+        (r'/delay/(?P<_station>%s)/create/(?P<_hours>\d{1,})/' % station_pattern, DelayCreateHandler),
+        (r'/delay/(?P<_station>%s)/remove/' % station_pattern, DelayRemoveHandler),
         (r'/delay/all/remove/', DelayRemoveHandler),
+        (r'/events/', EventsHandler),
         (r'/history/', HistoryHandler),
         (r'/standby/(?P<mode>create)/', StandbyHandler),
         (r'/standby/(?P<mode>remove)/', StandbyHandler),
-        (r'/station/(?P<_station>[1-8])/on/(?P<_minutes>30|[1-2][0-9]|[1-9])/', StationOnHandler),
-        (r'/station/(?P<_station>[1-8])/off/', StationOffHandler),
+        (r'/station/(?P<_station>%s)/on/(?P<_minutes>30|[1-2][0-9]|[1-9])/' % station_pattern, StationOnHandler),
+        (r'/station/(?P<_station>%s)/off/' % station_pattern, StationOffHandler),
         (r'/station/all/off/', StationOffHandler),
         (r'/status/', StatusHandler),
+        (r'/usage/', UsageHandler),
+        (r'/queue/', QueueHandler),
+        (r'/queue/(?P<command>skip|cancel)/', QueueCommandHandler),
+    ]
+
+    controller_routes = [(r'/controller/(?P<controller_id>[\w-]+)' + pattern, handler)
+        for pattern, handler in routes]
+
+    return controller_routes + routes + [
+        (r'/batch/', BatchHandler),
+        (r'/stream/', StreamHandler),
+        (r'/controllers/', ControllersHandler),
+        (r'/metrics/?', MetricsHandler),
+        (r'/admin/profile/', ProfileHandler),
+        (r'/schedule/', ScheduleHandler),
+        (r'/schedule/reload/', ScheduleReloadHandler),
         (r'/', IndexHandler),
-    ], debug=DEBUG)
+    ]
+
+
+def make_histories(registry):
+    """
+    Each controller has its own log.txt, read backwards for /history/
+    """
+    return dict((sprinkler.controller_id, HistoryReader(sprinkler.logger.path))
+        for sprinkler in registry)
+
+
+def make_app(registry, schedule, stream, files=None, worker_metrics=list):
+    """
+    Builds the application for the controllers in the registry. Blocking file
+    reads are done on the `files` executor, if there is one. `worker_metrics`
+    returns the metrics the workers sent, for /metrics/.
+    """
+    return tornado.web.Application(make_routes(registry), debug=DEBUG, log_function=log_request,
+        registry=registry, histories=make_histories(registry), schedule=schedule, stream=stream,
+        execute=functools.partial(run_batch, registry), files=files, worker_metrics=worker_metrics,
+        profiler=Profiler(tornado.ioloop.IOLoop.instance()))
+
+
+# The handlers a worker serves itself. Everything else goes to the actuator.
+WORKER_HANDLERS = [StatusHandler, HistoryHandler, EventsHandler, DelayCreateHandler,
+    DelayRemoveHandler, StationOnHandler, StationOffHandler, StandbyHandler, BatchHandler]
+
+
+def make_worker_app(registry, client, files):
+    """
+    Builds the application a worker process serves, for a RemoteRegistry.
+    Commands go to the actuator through the client.
+    """
+    routes = [route for route in make_routes(registry) if route[1] in WORKER_HANDLERS]
+    proxy_client = tornado.httpclient.AsyncHTTPClient(force_instance=True,
+        resolver=UnixResolver(path=ACTUATOR_HTTP_SOCKET_PATH), max_clients=100)
+
+    return tornado.web.Application(routes + [(r'.*', ActuatorProxyHandler)], debug=False,
+        log_function=log_request, registry=registry, histories=make_histories(registry),
+        execute=client.execute, proxy_client=proxy_client, files=files,
+        profiler=Profiler(tornado.ioloop.IOLoop.instance()))
+
+
+def run_worker(sockets, controllers):
+    """
+    Runs in each worker process: connects to the actuator, then serves HTTP
+    on the sockets the actuator opened until the actuator goes away.
+    """
+    # The IOLoop the actuator created was copied by the fork, and shares its
+    # epoll set with the actuator's. Leave it alone and start afresh.
+    tornado.ioloop.IOLoop.clear_current()
+    tornado.ioloop.IOLoop.clear_instance()
+    ioloop = tornado.ioloop.IOLoop.instance()
+
+    client = ActuatorClient(ACTUATOR_SOCKET_PATH, ioloop)
+    registry = RemoteRegistry([RemoteController(client, *description) for description in controllers])
+
+    # Workers only read files, but that still shouldn't block them
+    files = Executor('files', FILE_IO_WORKERS, ioloop)
+    for controller in registry:
+        controller.events.executor = files
+
+    ioloop.run_sync(client.connect)
+    client.on_close = ioloop.stop
+
+    # The actuator serves /metrics/, so it needs to know what the workers did
+    tornado.ioloop.PeriodicCallback(client.send_metrics, METRICS_INTERVAL * 1000, io_loop=ioloop).start()
+
+    server = tornado.httpserver.HTTPServer(make_worker_app(registry, client, files))
+    server.add_sockets(sockets)
+    ioloop.start()
+
+
+if __name__ == "__main__":
+
+    registry = ControllerRegistry.load(debug=DEBUG, number_of_stations=NUMBER_OF_STATIONS,
+        max_concurrency=MAX_CONCURRENT_STATIONS, master_station=MASTER_STATION,
+        flow_rates=FLOW_RATES)
+
+    # The schedule runs inside the server, on the IOLoop
+    schedule = ScheduleService(SCHEDULE_FILE_PATH,
+        functools.partial(run_scheduled_event, registry), tornado.ioloop.IOLoop.instance())
+
+    # The shift registers are written from one thread, so writes are made in
+    # order, and files are written from a small pool
+    hardware = Executor('hardware', 1, tornado.ioloop.IOLoop.instance())
+    files = Executor('files', FILE_IO_WORKERS, tornado.ioloop.IOLoop.instance())
+
+    for sprinkler in registry:
+
+        # Keep blocking work off the IOLoop
+        sprinkler.attach_executors(hardware, files)
+
+        # The IOLoop timeout that will close each running station when its operation completes
+        sprinkler.ioloop = tornado.ioloop.IOLoop.instance()
+        sprinkler.timeouts = {}
+
+        # Expire delays from a timer as soon as they run out
+        sprinkler.delays.attach(tornado.ioloop.IOLoop.instance())
+
+        # Save the usage totals a few seconds after they change, not on
+        # every change
+        sprinkler.usage.attach(tornado.ioloop.IOLoop.instance())
+
+        # Runs programs (lists of stations) one step after another
+        sprinkler.run_queue = RunQueue(sprinkler, tornado.ioloop.IOLoop.instance(), run_station)
+
+        # Make sure all stations are off (in case the server was restarted in
+        # mid-run), then pick back up any runs that hadn't finished. This
+        # process owns those stations now, so the pid files the old one left
+        # go too; otherwise check_pids.py would turn the resumed runs off.
+        sprinkler.reset_all_stations()
+        sprinkler.take_over_pid_files()
+        if RESUME_RUNS:
+            resume_runs(sprinkler)
+
+        # Pick up (or drop) any program that was running when the server stopped
+        sprinkler.run_queue.restore(resume=RESUME_PROGRAMS)
+
+    # Pushes state changes and log lines to /stream/ clients
+    stream = StreamHub(registry, tornado.ioloop.IOLoop.instance())
+
+    # Commands and calls from local tools and from the workers
+    actuator = ActuatorServer(registry, functools.partial(run_batch, registry),
+        tornado.ioloop.IOLoop.instance(), make_calls(registry, schedule))
+
+    app = make_app(registry, schedule, stream, files, actuator.worker_metrics)
+
+    # Start running the schedule
+    try:
+        schedule.start()
+    except ScheduleError, e:
+        for error in e.errors:
+            Event.log("Schedule not loaded: %s" % error)
+
+    # Stop runaway stations and keep the heartbeat file fresh
+    watchdog = Watchdog(registry, tornado.ioloop.IOLoop.instance(), stop_station,
+        HEARTBEAT_FILE_PATH, MAX_STATION_RUNTIME_MINUTES, executor=files)
+    watchdog.start()
 
-    sprinkler = OpenSprinkler(debug=DEBUG, number_of_stations=NUMBER_OF_STATIONS)
+    # We want registry.cleanup() to run when this script exits to make sure
+    # no stations can be left in a running state. The heartbeat is removed
+    # after that (atexit runs functions in reverse order).
+    atexit.register(watchdog.remove_heartbeat)
+    atexit.register(registry.cleanup)
 
-    # Store a variable so we can make the IOLoop close a station when operation completes
-    sprinkler.ioloop_timeout = None
+    # Measure how late the IOLoop runs timeouts, and log anything that blocks it
+    metrics.IOLoopLagProbe(tornado.ioloop.IOLoop.instance()).start()
+    SlowCallbackDetector(tornado.ioloop.IOLoop.instance(), registry.get().log).start()
 
-    # Make sure all stations are off (in case the server was restarted in mid-run)
-    sprinkler.reset_all_stations()
+    # Open the socket for local tools and the workers
+    actuator.listen_unix(ACTUATOR_SOCKET_PATH, mode=LOCAL_SOCKET_MODE)
 
-    # We want sprinkler.cleanup() to run when this script exits to make sure
-    # no stations can be left in a running state
-    atexit.register(sprinkler.cleanup)
+    if WORKER_PROCESSES:
+        # Everything else the workers pass on. The workers say who the client
+        # was, and only they can reach this socket.
+        actuator_http = tornado.httpserver.HTTPServer(app, xheaders=True)
+        actuator_http.add_socket(tornado.netutil.bind_unix_socket(ACTUATOR_HTTP_SOCKET_PATH))
 
-    app.listen(8888)
-    print "Server Started. Listening on port 8888"
+        controllers = [RemoteController.describe(sprinkler) for sprinkler in registry]
+        workers = WorkerPool(WORKER_PROCESSES,
+            functools.partial(run_worker, tornado.netutil.bind_sockets(8888), controllers),
+            tornado.ioloop.IOLoop.instance(), registry.get().log)
+        workers.start()
+        atexit.register(workers.stop)
+        print "Server Started. %d workers listening on port 8888" % WORKER_PROCESSES
+    else:
+        app.listen(8888)
+        print "Server Started. Listening on port 8888"
 
-    tornado.ioloop.IOLoop.instance().start()
\ No newline at end of file
+    tornado.ioloop.IOLoop.instance().start()
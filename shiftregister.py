@@ -0,0 +1,148 @@
+class MockGPIO():
+    """
+    Stubs out the GPIO methods the driver needs. It's used in place of
+    RPi.GPIO off the Pi, and by the simulator, which must never drive the
+    real pins.
+    """
+
+    def __init__(self):
+        self.BCM = 0
+        self.OUT = 0
+        self.RPI_REVISION = 2
+
+    def cleanup(self):
+        return
+
+    def setmode(self, mode):
+        return
+
+    def setup(self, pin, mode):
+        return
+
+    def output(self, pin, value):
+        return
+
+try:
+    import RPi.GPIO as GPIO
+except ImportError:
+
+    # GPIO is only available on the PI, so use the stubs for development purposes
+    print "** GPIO Not Found. Running in demo mode **"
+    GPIO = MockGPIO()
+
+from metrics import GPIO_WRITE_SECONDS, GPIO_WRITES, STATION_TRANSITIONS
+
+# The default pin map for the shift registers on the OpenSprinkler Pi. The data
+# pin depends on the revision of the Pi unless it is set explicitly.
+DEFAULT_PINS = {'clock': 4, 'enable': 17, 'latch': 22, 'data': None}
+
+# Each OpenSprinkler board (the main board and every expansion board chained
+# to it) has one 8-bit shift register
+STATIONS_PER_BOARD = 8
+
+
+def resolve_pins(pins=None):
+    """
+    Fills in a pin map from the defaults, working out the data pin from the
+    revision of the Pi if it isn't given.
+    """
+    pins = dict(DEFAULT_PINS, **(pins or {}))
+    if pins['data'] is None:
+        pins['data'] = 27 if GPIO.RPI_REVISION == 2 else 21
+    return pins
+
+
+class ShiftRegisterDriver():
+    """
+    Drives the chain of 74HC595 shift registers on the OpenSprinkler Pi and any
+    daisy-chained expansion boards. Station state is an integer bitmask; bit 0
+    is station 1.
+
+    The driver remembers the last level it put on every pin, so nothing is
+    written when the stations haven't changed and a pin is only touched when
+    its level actually changes.
+    """
+
+    def __init__(self, number_of_stations, clock_pin, latch_pin, data_pin, enable_pin):
+        self.number_of_stations = number_of_stations
+
+        # The chain is always a whole number of boards long. Unused outputs on
+        # the last board are shifted as zeros.
+        self.boards = (number_of_stations + STATIONS_PER_BOARD - 1) // STATIONS_PER_BOARD
+        self.length = self.boards * STATIONS_PER_BOARD
+
+        self.clock_pin = clock_pin
+        self.latch_pin = latch_pin
+        self.data_pin = data_pin
+        self.enable_pin = enable_pin
+
+        # What's currently latched into the registers (None until first write)
+        self.bits = None
+
+        # The last level written to each pin
+        self.levels = {}
+
+    def _output(self, pin, level):
+        if self.levels.get(pin) != level:
+            GPIO.output(pin, level)
+            self.levels[pin] = level
+
+    def setup(self):
+        """
+        Configures the pins. Output stays disabled until enable_output().
+        """
+        GPIO.setmode(GPIO.BCM)
+
+        GPIO.setup(self.clock_pin, GPIO.OUT)
+        GPIO.setup(self.enable_pin, GPIO.OUT)
+
+        self.disable_output()
+
+        GPIO.setup(self.data_pin, GPIO.OUT)
+        GPIO.setup(self.latch_pin, GPIO.OUT)
+
+        # After setup we can't be sure what levels the pins are at
+        self.levels = {}
+        self.bits = None
+
+    def enable_output(self):
+        GPIO.output(self.enable_pin, False)
+        self.levels[self.enable_pin] = False
+
+    def disable_output(self):
+        GPIO.output(self.enable_pin, True)
+        self.levels[self.enable_pin] = True
+
+    def write(self, bits, force=False):
+        """
+        Shifts the station bitmask out to the registers and latches it. Does
+        nothing if the registers already hold these values, unless forced.
+        Returns True if anything was written.
+        """
+        if bits == self.bits and not force:
+            GPIO_WRITES.inc(labels=('false',))
+            return False
+
+        timer = GPIO_WRITE_SECONDS.time()
+
+        self._output(self.clock_pin, False)
+        self._output(self.latch_pin, False)
+
+        # The last station in the chain is shifted in first
+        for s in range(self.length - 1, -1, -1):
+            self._output(self.clock_pin, False)
+            self._output(self.data_pin, (bits >> s) & 1)
+            self._output(self.clock_pin, True)
+
+        self._output(self.latch_pin, True)
+
+        timer.stop()
+        GPIO_WRITES.inc(labels=('true',))
+
+        # Count the stations that were switched on and off
+        previous = self.bits or 0
+        STATION_TRANSITIONS.inc(bin(bits & ~previous).count('1'), labels=('on',))
+        STATION_TRANSITIONS.inc(bin(previous & ~bits).count('1'), labels=('off',))
+
+        self.bits = bits
+        return True
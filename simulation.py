@@ -0,0 +1,437 @@
+"""
+Plays a schedule out against a virtual clock, so a change to schedule.json
+can be checked without waiting for it to run. Weeks of watering take a
+second or two:
+
+    $ python simulation.py --schedule scheduler/schedule.json --start 2016-05-16 --days 28
+
+The controllers (from controllers.json, if there is one), the schedule, the
+station timers, delays and programs are the server's own code. The IOLoop is
+replaced with one that jumps straight to the next timer, and the controllers
+run on MockGPIO in a temporary directory, so the real pins and state files
+are never touched.
+
+A scenario file can add things that happen along the way. Each entry is an
+operation /batch/ understands plus the local time to apply it:
+
+    [
+        {"at": "2016-05-17 04:00", "op": "delay_create", "station": 2, "hours": 48},
+        {"at": "2016-05-20 00:00", "op": "standby_create"},
+        {"at": "2016-05-21 00:00", "op": "standby_remove"},
+        {"at": "2016-05-22 05:05", "op": "station_on", "station": 1, "minutes": 10}
+    ]
+
+The report (JSON) has a timeline of what the shift registers held for each
+controller and a list of conflicts:
+
+    overlap             scheduled events that run at the same time, beyond
+                        what the controller can run at once
+    unknown_controller  a scheduled event for a controller that doesn't exist
+    preempted           a station stopped early to make room for another
+    refused             a run that didn't happen because of a delay, standby
+                        or the master valve
+    rejected            a scenario operation the server turned down
+
+With --strict the exit status is 1 if there were any, so it can be used to
+check a schedule before it's put in place.
+"""
+import bisect
+import datetime
+import functools
+import heapq
+import itertools
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import tornado.concurrent
+
+# The demo mode notice is printed on import; keep it out of the JSON
+stdout, sys.stdout = sys.stdout, sys.stderr
+import clock
+import controllers
+from controllers import ControllerRegistry
+import events
+from events import parse_time
+from logwriter import get_log_writer
+from runqueue import RunQueue
+import scheduler.scheduler
+from scheduler.scheduler import DAY_NAMES, MINUTES_PER_DAY, MINUTES_PER_WEEK, ScheduleError, ScheduleService
+import server
+import shiftregister
+from shiftregister import MockGPIO
+import sprinkler as sprinkler_module
+sys.stdout = stdout
+
+# How many days to simulate if --days isn't given
+DEFAULT_DAYS = 7
+
+# The most events read back from each controller for the report
+MAX_EVENTS = 1000000
+
+
+class SimulatedIOLoop():
+    """
+    Enough of the IOLoop for the controllers, the schedule and programs.
+    Nothing waits: run_until() runs every timeout in order, moving the clock
+    to each one's deadline first.
+    """
+
+    def __init__(self, start):
+        self.now = start
+        self._timeouts = []
+        self._callbacks = []
+        self._sequence = itertools.count()
+
+    def time(self):
+        return self.now
+
+    def add_timeout(self, deadline, callback, *args, **kwargs):
+        if isinstance(deadline, datetime.timedelta):
+            deadline = self.now + deadline.total_seconds()
+
+        # [deadline, tie breaker, callback]. A removed timeout keeps its place
+        # in the heap with no callback.
+        timeout = [max(deadline, self.now), next(self._sequence),
+            functools.partial(callback, *args, **kwargs)]
+        heapq.heappush(self._timeouts, timeout)
+        return timeout
+
+    def call_later(self, delay, callback, *args, **kwargs):
+        return self.add_timeout(self.now + delay, callback, *args, **kwargs)
+
+    def remove_timeout(self, timeout):
+        timeout[2] = None
+
+    def add_callback(self, callback, *args, **kwargs):
+        self._callbacks.append(functools.partial(callback, *args, **kwargs))
+
+    def run_until(self, end):
+        """
+        Runs everything due up to `end` (epoch seconds), then leaves the clock there.
+        """
+        while True:
+            self._run_callbacks()
+            if not self._timeouts or self._timeouts[0][0] > end:
+                break
+            deadline, sequence, callback = heapq.heappop(self._timeouts)
+            if callback is not None:
+                self.now = deadline
+                callback()
+        self.now = end
+
+    def _run_callbacks(self):
+        while self._callbacks:
+            callbacks, self._callbacks = self._callbacks, []
+            for callback in callbacks:
+                callback()
+
+
+class DiscardingExecutor():
+    """
+    Takes the controllers' background file work and drops it.
+    """
+
+    def submit(self, fn, *args, **kwargs):
+        future = tornado.concurrent.Future()
+        future.set_result(None)
+        return future
+
+    def drain(self):
+        pass
+
+
+class TimelineRecorder():
+    """
+    Listens to the controllers and notes what their shift registers hold each
+    time it changes.
+    """
+
+    def __init__(self, registry):
+        self.timelines = dict((sprinkler.controller_id, []) for sprinkler in registry)
+        self.last = {}
+        for sprinkler in registry:
+            sprinkler.listeners.append(self.record)
+
+    def record(self, sprinkler):
+        bits = sprinkler.driver.bits
+        if self.last.get(sprinkler.controller_id) == bits:
+            return
+        self.last[sprinkler.controller_id] = bits
+
+        now = clock.time()
+        self.timelines[sprinkler.controller_id].append({
+            'time': now,
+            'date': _format_time(now),
+            'registers': ''.join(str((bits >> s) & 1) for s in range(sprinkler.number_of_stations)),
+        })
+
+
+def _format_time(when):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(when))
+
+
+def find_overlaps(schedule_events, registry):
+    """
+    Checks the schedule itself for events that can't all run: more running
+    at once on a controller than it allows, the same station scheduled twice
+    at once, or events for controllers that don't exist.
+    """
+    conflicts = []
+
+    # Each run in minutes since Monday 00:00, per controller
+    runs = {}
+    for event in schedule_events:
+        sprinkler = registry.get(event.controller)
+        if sprinkler is None:
+            conflicts.append({'type': 'unknown_controller', 'controller': event.controller,
+                'events': [repr(event)]})
+            continue
+        for day in event.days:
+            runs.setdefault(sprinkler.controller_id, []).append(
+                ((day - 1) * MINUTES_PER_DAY + event.minute_of_day, event))
+
+    for controller_id, items in sorted(runs.items()):
+        limit = registry.get(controller_id).max_concurrency
+        items.sort(key=lambda item: item[0])
+        longest = max(event.minutes for start, event in items)
+
+        # Runs late on Sunday carry over into Monday, so last week's runs are
+        # in the list too
+        candidates = [(start - MINUTES_PER_WEEK, event) for start, event in items] + items
+        starts = [start for start, event in candidates]
+
+        # One conflict for each minute something starts while too much is running
+        found = {}
+        for start, event in items:
+            first = bisect.bisect_left(starts, start - longest + 1)
+            last = bisect.bisect_right(starts, start)
+            active = [other for other_start, other in candidates[first:last]
+                if other_start + other.minutes > start]
+
+            stations = set(other.station for other in active)
+            if len(active) > limit or len(stations) < len(active):
+                found[start] = {'type': 'overlap', 'controller': controller_id,
+                    'day': DAY_NAMES[start // MINUTES_PER_DAY], 'start': event.start_time,
+                    'events': [repr(other) for other in active]}
+
+        conflicts.extend(found[start] for start in sorted(found))
+
+    return conflicts
+
+
+def load_scenario(path):
+    """
+    Reads a scenario file into a list of (epoch time, operation) pairs.
+    Raises a ValueError describing the problem if it's invalid.
+    """
+    try:
+        with open(path, 'r') as f:
+            items = json.load(f)
+    except IOError:
+        raise ValueError('Could not open scenario file %s' % path)
+
+    if type(items) is not list:
+        raise ValueError('Scenario must be a list of operations')
+
+    actions = []
+    for number, item in enumerate(items, 1):
+        if not isinstance(item, dict) or 'at' not in item:
+            raise ValueError('Operation %d: must be an object with an "at" time' % number)
+        try:
+            when = parse_time(str(item['at']))
+        except ValueError, e:
+            raise ValueError('Operation %d: %s' % (number, e))
+        operation = dict((key, value) for key, value in item.items() if key != 'at')
+        actions.append((when, operation))
+    return actions
+
+
+def _apply_action(registry, conflicts, operation):
+    response = server.run_batch(registry, [operation])
+    if 'results' in response:
+        error = response['results'][0]['error']
+    else:
+        error = '; '.join(response.get('errors') or [response['error']])
+
+    if error:
+        now = clock.time()
+        conflicts.append({'type': 'rejected', 'time': now, 'date': _format_time(now),
+            'operation': operation, 'error': error})
+
+
+def _runtime_conflicts(sprinkler):
+    """
+    Reads back the runs that were cut short or never started.
+    """
+    conflicts = []
+    for event_type, conflict_type in ((events.PREEMPT, 'preempted'), (events.REFUSED, 'refused')):
+        for event in sprinkler.events.query(event_type=event_type, limit=MAX_EVENTS):
+            conflict = {'type': conflict_type, 'controller': sprinkler.controller_id,
+                'time': event['time'], 'date': event['date'], 'station': event['station']}
+            if conflict_type == 'preempted':
+                conflict.update(by=event['by'], minutes_run=round(event['seconds'] / 60.0, 1))
+            else:
+                conflict.update(reason=event['reason'], minutes=event['minutes'])
+            conflicts.append(conflict)
+    return conflicts
+
+
+def _summary(sprinkler):
+    """
+    How many runs each station started and how many minutes it watered.
+    """
+    stations = {}
+    for event in sprinkler.events.query(limit=MAX_EVENTS):
+        if event['station'] is None or event['station'] == 0:
+            continue
+        totals = stations.setdefault(str(event['station']), {'runs': 0, 'minutes': 0.0})
+        if event['type'] == events.OPERATE:
+            totals['runs'] += 1
+        elif event['type'] in (events.STOP, events.PREEMPT):
+            totals['minutes'] = round(totals['minutes'] + event['seconds'] / 60.0, 1)
+    return stations
+
+
+def _use_gpio(gpio):
+    """
+    Points every module that talks to the pins at `gpio`, and returns what
+    they used before.
+    """
+    previous = shiftregister.GPIO
+    shiftregister.GPIO = sprinkler_module.GPIO = controllers.GPIO = gpio
+    return previous
+
+
+def simulate(schedule_path, start, days=DEFAULT_DAYS, actions=(), config_path=controllers.CONFIG_FILE_PATH,
+             number_of_stations=server.NUMBER_OF_STATIONS, max_concurrency=server.MAX_CONCURRENT_STATIONS,
+             master_station=server.MASTER_STATION):
+    """
+    Runs the schedule from `start` (epoch seconds) for `days` days, applying
+    the (time, operation) `actions` along the way, and returns the report.
+    Raises a ScheduleError if the schedule is invalid.
+    """
+    started = time.time()
+    end = start + days * 24 * 3600
+    work_dir = tempfile.mkdtemp(prefix='neptune-sim-')
+
+    ioloop = SimulatedIOLoop(start)
+    clock.set_source(ioloop.time)
+    gpio = _use_gpio(MockGPIO())
+
+    # The scheduler logs to the server's log; keep this run's lines out of it
+    log_path = scheduler.scheduler.LOG_FILE_PATH
+    scheduler.scheduler.LOG_FILE_PATH = os.path.join(work_dir, 'log.txt')
+
+    # The controllers print every line they log; keep that out of the report
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+
+    registry = None
+    try:
+        registry = ControllerRegistry.load(number_of_stations=number_of_stations,
+            config_path=config_path, max_concurrency=max_concurrency,
+            master_station=master_station, state_root=work_dir)
+
+        for sprinkler in registry:
+            sprinkler.ioloop = ioloop
+            sprinkler.timeouts = {}
+            sprinkler.delays.attach(ioloop)
+            sprinkler.run_queue = RunQueue(sprinkler, ioloop, server.run_station)
+
+            # Nothing reads the pid files, state file or usage totals back
+            # during a simulation, and writing them on every change is most
+            # of the time it would take. The events are kept for the report.
+            sprinkler.files = DiscardingExecutor()
+            sprinkler.state_file.sync = False
+            sprinkler.usage.save = lambda: None
+
+        recorder = TimelineRecorder(registry)
+        for sprinkler in registry:
+            recorder.record(sprinkler)
+
+        schedule = ScheduleService(schedule_path,
+            functools.partial(server.run_scheduled_event, registry), ioloop)
+        schedule.reload()
+
+        conflicts = find_overlaps(schedule.events, registry)
+        for when, operation in actions:
+            ioloop.add_timeout(when, _apply_action, registry, conflicts, operation)
+
+        ioloop.run_until(end)
+
+        report_controllers = {}
+        for sprinkler in registry:
+            conflicts.extend(_runtime_conflicts(sprinkler))
+            report_controllers[sprinkler.controller_id] = {
+                'stations': _summary(sprinkler),
+                'timeline': recorder.timelines[sprinkler.controller_id],
+            }
+
+        # The schedule's conflicts first, then everything else as it happened
+        conflicts.sort(key=lambda conflict: conflict.get('time', 0))
+
+        return {
+            'start': _format_time(start),
+            'end': _format_time(end),
+            'days': days,
+            'events': len(schedule.events),
+            'controllers': report_controllers,
+            'conflicts': conflicts,
+            'elapsed_seconds': round(time.time() - started, 3),
+        }
+    finally:
+        if registry is not None:
+            for sprinkler in registry:
+                sprinkler.logger.close()
+                sprinkler.events.close()
+                sprinkler.state_file.close()
+        get_log_writer(scheduler.scheduler.LOG_FILE_PATH).close()
+
+        sys.stdout.close()
+        sys.stdout = stdout
+        scheduler.scheduler.LOG_FILE_PATH = log_path
+        _use_gpio(gpio)
+        clock.set_source()
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--schedule', default=server.SCHEDULE_FILE_PATH)
+    parser.add_argument('--start', help='local date or time to start at (default: today)')
+    parser.add_argument('--days', type=int, default=DEFAULT_DAYS)
+    parser.add_argument('--scenario', help='JSON file of operations to apply along the way')
+    parser.add_argument('--controllers', default=controllers.CONFIG_FILE_PATH,
+        help='controllers.json to simulate (default: the server\'s)')
+    parser.add_argument('--strict', action='store_true', default=False,
+        help='exit with status 1 if there are any conflicts')
+    args = parser.parse_args()
+
+    try:
+        if args.start:
+            start = parse_time(args.start)
+        else:
+            start = time.mktime(datetime.date.today().timetuple())
+        actions = load_scenario(args.scenario) if args.scenario else []
+    except ValueError, e:
+        sys.exit(str(e))
+
+    if args.days < 1:
+        sys.exit('--days must be at least 1')
+
+    try:
+        report = simulate(os.path.abspath(args.schedule), start, args.days, actions,
+            config_path=args.controllers)
+    except ScheduleError, e:
+        sys.exit("Error reading schedule:\n" + "\n".join(e.errors))
+
+    print json.dumps(report, indent=2, sort_keys=True)
+
+    if args.strict and report['conflicts']:
+        sys.exit(1)
@@ -1,37 +1,46 @@
-import arrow
 import datetime
+import errno
+import json
 import os
 import sys
 
+import clock
+import events
+from delays import DelayManager
+from logwriter import get_log_writer
+from shiftregister import DEFAULT_PINS, GPIO, ShiftRegisterDriver, resolve_pins
+from statefile import StateFile
+from usage import UsageTracker
+
 CUR_DIR = os.path.dirname(os.path.realpath(__file__))
 
-try:
-    import RPi.GPIO as GPIO
-except ImportError:
+# GPIO.cleanup() resets every pin, so it must only run once per process, not
+# once for every controller
+_gpio_cleaned_up = False
 
-    # GPIO is only available on the PI, so these stub out the 
-    # required methods for development purposes
-    print "** GPIO Not Found. Running in demo mode **"
+def _isoformat(epoch):
+    """
+    Formats epoch seconds as an ISO 8601 UTC timestamp.
+    """
+    return datetime.datetime.utcfromtimestamp(epoch).isoformat() + '+00:00'
 
-    class MockGPIO():
-        def __init__(self):
-            self.BCM = 0
-            self.OUT = 0
-            self.RPI_REVISION = 2
 
-        def cleanup(self):
-            return
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
 
-        def setmode(self, mode):
-            return
 
-        def setup(self, pin, mode):
-            return
+def _write_standby_file(file_path):
+    with open(file_path, 'w') as f:
+        f.write('%s' % datetime.datetime.now())
 
-        def output(self, pin, value):
-            return
 
-    GPIO = MockGPIO()
+def _remove_standby_file(file_path):
+    if os.path.exists(file_path):
+        os.remove(file_path)
 
 
 class OpenSprinkler():
@@ -43,65 +52,140 @@ class OpenSprinkler():
         Low-level function to enable shift register output. Don't call this
         yourself unless you know why you are doing it.
         """
-        GPIO.output(self.PIN_SR_NOE, False)
+        self._require_writable()
+        self.driver.enable_output()
 
     def _disable_shift_register_output(self):
         """
         Low-level function to disable shift register output. Don't call this
         yourself unless you know why you are doing it.
         """
-        GPIO.output(self.PIN_SR_NOE, True)
+        self._require_writable()
+        self.driver.disable_output()
 
-    def _set_shift_registers(self, new_values):
+    def _require_writable(self):
         """
-        This is the low-level function that is called to set the shift registers.
-        I don't pretent do understand the inner workings here, but it works. Don't
-        use this to turn on/off stations, use set_station_status() as the
-        higher-level interface.
+        Refuses to change anything on a controller opened read-only.
         """
-        GPIO.output(self.PIN_SR_CLK, False)
-        GPIO.output(self.PIN_SR_LAT, False)
+        if self.readonly:
+            raise RuntimeError('Controller %s was opened read-only' % self.controller_id)
 
-        for s in range(0, self.number_of_stations):
-            GPIO.output(self.PIN_SR_CLK, False)
-            GPIO.output(self.PIN_SR_DAT, new_values[self.number_of_stations-1-s])
-            GPIO.output(self.PIN_SR_CLK, True)
+    def _set_shift_registers(self, new_bits):
+        """
+        This is the low-level function that is called to set the shift registers.
+        It takes a bitmask of station values (bit 0 is station 1). Nothing is
+        sent to the hardware if the registers already hold these values. Don't
+        use this to turn on/off stations, use operate_station() as the
+        higher-level interface.
 
-        GPIO.output(self.PIN_SR_LAT, True)
+        With a hardware executor attached the write happens on its thread,
+        in order with every other write.
+        """
+        self._require_writable()
+        if self.hardware is None:
+            self.driver.write(new_bits)
+        else:
+            self._hardware_pending += 1
+            future = self.hardware.submit(self.driver.write, new_bits, key='gpio')
+            future.add_done_callback(self._hardware_written)
 
         # Update the status
         self._update_status()
 
+    def _hardware_written(self, future):
+        self._hardware_pending -= 1
+        try:
+            future.result()
+        except Exception, e:
+            self.log('Error writing the shift registers: %s' % e)
+
+    @property
+    def hardware_busy(self):
+        """
+        True while writes to the shift registers are waiting to be made.
+        """
+        return self._hardware_pending > 0
+
+    def rewrite_shift_registers(self):
+        """
+        Writes the current station state to the registers again, even if the
+        driver thinks they already hold it.
+        """
+        self._require_writable()
+        if self.hardware is None:
+            self.driver.write(self.station_bits, force=True)
+        else:
+            self._hardware_pending += 1
+            future = self.hardware.submit(self.driver.write, self.station_bits, force=True, key='gpio')
+            future.add_done_callback(self._hardware_written)
+
+    def attach_executors(self, hardware, files):
+        """
+        Moves the blocking work off the caller's thread: shift register
+        writes go to the `hardware` executor and file writes to `files`.
+        """
+        self.hardware = hardware
+        self.files = files
+        self.delays.executor = files
+        self.events.executor = files
+        self.usage.executor = files
+        self.state_file.sync = False
+
+    def drain_executors(self):
+        """
+        Waits for any queued hardware and file work to finish.
+        """
+        if self.hardware is not None:
+            self.hardware.drain()
+        if self.files is not None:
+            self.files.drain()
+
+    def _in_background(self, key, fn, *args):
+        """
+        Runs blocking file work on the file executor (in order with other
+        work on the same key), or right away if there isn't one.
+        """
+        if self.files is None:
+            fn(*args)
+        else:
+            self.files.submit(fn, *args, key=key).add_done_callback(self._background_done)
+
+    def _background_done(self, future):
+        try:
+            future.result()
+        except Exception, e:
+            self.log('Error writing state files: %s' % e)
+
     def _initialize_hardware(self):
         """
         This contains the low-level stuff required to make the GPIO operations work. Someone
         smarter than me wrote this stuff, I just smile and nod.
         """
-        self.PIN_SR_CLK = 4
-        self.PIN_SR_NOE = 17
-        self.PIN_SR_LAT = 22
-        self.PIN_SR_DAT = 21
+        global _gpio_cleaned_up
 
-        # The 2nd revision of the RPI has a different pin value
-        if GPIO.RPI_REVISION == 2:
-            self.PIN_SR_DAT = 27
+        # The 2nd revision of the RPI has a different data pin
+        pins = resolve_pins(self.pins)
+
+        self.PIN_SR_CLK = pins['clock']
+        self.PIN_SR_NOE = pins['enable']
+        self.PIN_SR_LAT = pins['latch']
+        self.PIN_SR_DAT = pins['data']
+
+        driver = ShiftRegisterDriver(self.number_of_stations, clock_pin=self.PIN_SR_CLK,
+            latch_pin=self.PIN_SR_LAT, data_pin=self.PIN_SR_DAT, enable_pin=self.PIN_SR_NOE)
 
         # Not sure why this is called, but it was in the original script.
-        GPIO.cleanup()
+        if not _gpio_cleaned_up:
+            GPIO.cleanup()
+            _gpio_cleaned_up = True
 
         # setup GPIO pins to interface with shift register. Don't muck with this
         # stuff unless you know why you are doing it.
-        GPIO.setmode(GPIO.BCM)
-
-        GPIO.setup(self.PIN_SR_CLK, GPIO.OUT)
-        GPIO.setup(self.PIN_SR_NOE, GPIO.OUT)
-
-        self._disable_shift_register_output()
+        driver.setup()
 
-        GPIO.setup(self.PIN_SR_DAT, GPIO.OUT)
-        GPIO.setup(self.PIN_SR_LAT, GPIO.OUT)
-
-        self._set_shift_registers(self.station_values)
+        driver.write(self.station_bits, force=True)
+        self.driver = driver
+        self._update_status()
         self._enable_shift_register_output()
 
     ### Convenience methods for filesystem operations. You don't need to call these
@@ -113,135 +197,327 @@ class OpenSprinkler():
         """
         self.status = "%s" % "".join([str(s) for s in self.station_values])
 
+    @property
+    def station_values(self):
+        """
+        The station bitmask as a list of 0/1 values, station 1 first.
+        """
+        return [(self.station_bits >> s) & 1 for s in range(self.number_of_stations)]
+
+    def is_running(self, station_number):
+        return bool(self.station_bits & (1 << (station_number-1)))
+
     ### PID File Handling ###
 
-    def _create_pid_file(self, minutes_to_run):
+    def _create_pid_file(self):
         """
         Writes a PID file to the directory to indicate what the PID of the
-        current program is and when it expires.
+        current program is and when the last running station expires.
         """
-        expiration = arrow.utcnow().replace(minutes=+minutes_to_run).isoformat()
-        file_path = os.path.join(CUR_DIR, '%s.pid' % self.pid)
-        self.log("Creating pid file: %s" % file_path)
+        expiration = int(max(expires for started, expires in self.runs.values()))
+        file_path = os.path.join(self.state_dir, '%s.pid' % self.pid)
+        self._in_background(file_path, self._write_pid_file, file_path, expiration)
+
+    def _write_pid_file(self, file_path, expiration):
+        if not os.path.exists(file_path):
+            self.log("Creating pid file: %s" % file_path)
         with open(file_path, 'w') as f:
-            f.write("%s" % expiration)
+            f.write("%d" % expiration)
 
     def _remove_pid_file(self):
         """
         Handles removal of the PID file.
         """
-        file_path = os.path.join(CUR_DIR, '%s.pid' % self.pid)
-        self.log("Removing pid file: %s" % file_path)
+        file_path = os.path.join(self.state_dir, '%s.pid' % self.pid)
+        self._in_background(file_path, self._delete_pid_file, file_path)
+
+    def _delete_pid_file(self, file_path):
         if os.path.exists(file_path):
+            self.log("Removing pid file: %s" % file_path)
             os.remove(file_path)
 
+    def take_over_pid_files(self):
+        """
+        Removes the PID files left by servers that are no longer running.
+        The server calls this once it owns the pins and has turned every
+        station off (and maybe resumed some), so the stations those files
+        describe are its own now. Left in place, check_pids.py would see
+        them as orphaned and turn the resumed stations off.
+        """
+        self._require_writable()
+        for file_name in os.listdir(self.state_dir):
+            pid = file_name[:-len('.pid')]
+            if not file_name.endswith('.pid') or not pid.isdigit() or int(pid) == self.pid:
+                continue
+            if _process_alive(int(pid)):
+                continue
+            file_path = os.path.join(self.state_dir, file_name)
+            self.log("Taking over pid file left by process %s: %s" % (pid, file_path))
+            self._in_background(file_path, self._delete_pid_file, file_path)
+
     ### Station Operation ###
 
-    def cleanup(self):
+    def cleanup(self, gpio_cleanup=True):
         """
         This runs at the termination of the file, turning off all stations, making
-        sure that any PID files are removed, and running GPIO cleanup.
+        sure that any PID files are removed, and running GPIO cleanup. When several
+        controllers share the GPIO pins, pass gpio_cleanup=False and let the
+        registry run it once all of them are off.
         """
+        # A read-only controller never changed anything
+        if self.readonly:
+            return
+
         self.log("Running Cleanup.")
         self.reset_all_stations()
         self._remove_pid_file()
-        GPIO.cleanup()
+
+        # The usage totals may be waiting for their timer
+        self.usage.flush()
+
+        # The stations have to actually be off before the pins are released
+        self.drain_executors()
+        if gpio_cleanup:
+            GPIO.cleanup()
+
+        # Make sure everything we logged is on disk before the process goes away
+        self.logger.flush()
 
     def stop_station(self, station_number):
         """
-        This method stops a station (actually, any stations)
+        This method stops a station. Station 0 stops every station.
         """
+        self._require_writable()
         self.log('Stopping station %s.' % station_number)
-        self._remove_pid_file()
-        self.reset_all_stations()
+
+        if station_number == 0:
+            self.reset_all_stations()
+        elif station_number in self.runs:
+            self._record_stop(events.STOP, station_number)
+            del self.runs[station_number]
+            self._apply_runs()
 
     def operate_station(self, station_number, minutes):
         """
-        This is the method that operates a station. Running it causes any
-        currently-running stations to turn off, then a pid file is created that
-        lets the system know that there is a process running. When it completes,
-        ALL stations are turned off and the file is cleaned up.
+        This is the method that operates a station. Up to max_concurrency
+        stations can run at once; if that many are already running, the one
+        that started first is turned off to make room. Running a station that
+        is already on restarts its time. A pid file lets the system know that
+        stations are running, and the master valve (if there is one) is kept
+        on while any station is.
         """
+        self._require_writable()
         self.log("Operating station %d for %d minutes." % (station_number, minutes))
 
         # Check to see if the system is in standby mode
         if self.check_for_standby():
             self.log('Standby mode is in effect. Job will not run.')
+            self.events.record(events.REFUSED, station_number, minutes=minutes, reason='standby')
             return False
 
         # Check to see if a delay is in effect
         delay = self.check_for_delay(station_number)
         if delay:
             self.log("Delay in effect until %s. Job will not run." % delay)
+            self.events.record(events.REFUSED, station_number, minutes=minutes, reason='delay')
             return False
 
-        # First, set all stations to zero
-        self.station_values = [0] * self.number_of_stations
-
-        # Next, enable just the station to run (adjusting for 0-based index)
-        try:
-            self.station_values[station_number-1] = 1
-        except IndexError:
+        if not 1 <= station_number <= self.number_of_stations:
             self.log("Invalid station number %d passed. Skipping." % station_number)
+            self.events.record(events.REFUSED, station_number, minutes=minutes, reason='invalid')
+            return False
+
+        if station_number == self.master_station:
+            self.log("Station %d is the master valve and can't be run by itself." % station_number)
+            self.events.record(events.REFUSED, station_number, minutes=minutes, reason='master')
+            return False
 
-        # Keep track of when this operation will complete
-        self.current_operation_complete = arrow.utcnow().replace(minutes=+minutes).isoformat()
+        now = clock.time()
+
+        # Make room if we're at the limit, stopping whatever started first.
+        # A run whose time is up doesn't count. Its timer stops it as soon
+        # as the IOLoop gets round to it, which is a little after it ends,
+        # and a run packed straight after it (as the planner does) shouldn't
+        # push it out in the meantime.
+        if station_number not in self.runs:
+            live = [station for station, (started, expires) in self.runs.items() if expires > now]
+            while len(live) >= self.max_concurrency:
+                first = min(live, key=lambda station: self.runs[station][0])
+                self.log("Stopping station %d to make room for station %d." % (first, station_number))
+                self._record_stop(events.PREEMPT, first, now, by=station_number)
+                del self.runs[first]
+                live.remove(first)
+
+        # Running a station that's already on starts a new run; count what
+        # it has watered so far
+        if station_number in self.runs:
+            self.usage.add_time(station_number, self.runs[station_number][0], now)
+        self.usage.count_run(station_number, now)
+
+        # Keep track of when this operation started and when it will complete
+        self.runs[station_number] = (now, now + minutes * 60)
+        self.events.record(events.OPERATE, station_number, minutes=minutes,
+            expires=self.runs[station_number][1])
 
         # Send the command
-        self._set_shift_registers(self.station_values)
+        self._apply_runs()
+
+        return True
+
+    def resume_station(self, station_number, started, expires):
+        """
+        Turns a station back on for a run that was in progress when the
+        server stopped, keeping its original start and expiration. Returns
+        False if the run can't be resumed.
+        """
+        self._require_writable()
+        if expires <= clock.time() or self.check_for_standby() or self.check_for_delay(station_number):
+            return False
+
+        if not 1 <= station_number <= self.number_of_stations or station_number == self.master_station:
+            return False
+
+        if station_number not in self.runs and len(self.runs) >= self.max_concurrency:
+            return False
+
+        self.log("Resuming station %d until %s." % (station_number, _isoformat(expires)))
+        self.runs[station_number] = (started, expires)
+        self.events.record(events.RESUME, station_number, started=started, expires=expires)
+        self._apply_runs()
 
-        # Create a filesystem flag to indicate that the system is running
-        self._create_pid_file(minutes)
-        
         return True
 
     def reset_all_stations(self):
         """
         A convenience method for turning everything off.
         """
+        self._require_writable()
         self.log("Reset Command Received. Turning Off All Stations.")
-        off_values = [0] * self.number_of_stations
-        self.station_values = off_values
-        self._set_shift_registers(off_values)
-        self.current_operation_complete = None
+        now = clock.time()
+        for station_number in sorted(self.runs):
+            self._record_stop(events.STOP, station_number, now)
+        self.runs = {}
+        self._apply_runs()
+
+    def _record_stop(self, event_type, station_number, now=None, **data):
+        """
+        Records a running station being turned off, with how long it ran,
+        and adds the time to its usage.
+        """
+        if now is None:
+            now = clock.time()
+        started, expires = self.runs[station_number]
+        self.events.record(event_type, station_number, seconds=now - started, **data)
+        self.usage.add_time(station_number, started, now)
+
+    def _apply_runs(self):
+        """
+        Sends the combined state of every running station (plus the master
+        valve) to the shift registers in one write, and updates the pid file.
+        During a batch this waits until the batch ends.
+        """
+        if self._batch_depth:
+            self._runs_dirty = True
+            return
+
+        bits = 0
+        for station_number in self.runs:
+            bits |= 1 << (station_number-1)
+
+        # The master valve (or pump) is on whenever any station is
+        if bits and self.master_station:
+            bits |= 1 << (self.master_station-1)
+
+        self.station_bits = bits
+        self._set_shift_registers(bits)
+
+        # Create a filesystem flag to indicate that the system is running
+        if self.runs:
+            self._create_pid_file()
+        else:
+            self._remove_pid_file()
+
+        self._state_changed()
+
+    def begin_batch(self):
+        """
+        Starts a batch of operations. Until end_batch() is called, the shift
+        registers aren't written, the delay journal isn't appended to and the
+        state version doesn't change; end_batch() does each of those once for
+        the whole batch. Batches can be nested.
+        """
+        self._require_writable()
+        if not self._batch_depth:
+            self.delays.hold()
+            self.events.hold()
+        self._batch_depth += 1
+
+    def end_batch(self):
+        """
+        Ends a batch of operations and applies everything it changed at once.
+        """
+        self._batch_depth -= 1
+        if self._batch_depth:
+            return
+
+        self.delays.release()
+        self.events.release()
+
+        runs_dirty, state_dirty = self._runs_dirty, self._state_dirty
+        self._runs_dirty = self._state_dirty = False
+        if runs_dirty:
+            self._apply_runs()
+        elif state_dirty:
+            self._state_changed()
+
+    def run_expiration(self, station_number):
+        """
+        Returns the epoch time a running station will stop, or None. The
+        master valve runs until the last station stops.
+        """
+        if station_number in self.runs:
+            return self.runs[station_number][1]
+        if station_number == self.master_station and self.runs:
+            return max(expires for started, expires in self.runs.values())
+        return None
 
     ### Delay Handling ###
 
     def remove_delay(self, station):
         """
-        Removes a delay file for a station. If station is zero,
-        then we need to remove all delay files.
+        Removes the delay for a station. If station is zero,
+        then we need to remove all delays.
         """
+        self._require_writable()
         if station == 0:
             # 0 is the number for "all stations"
-            self.log('Removing all delay files')
-            pid_files = [f for f in os.listdir(CUR_DIR) if f.startswith("DELAY-")]
-            for pid_file in pid_files:
-                os.remove(pid_file)
+            self.log('Removing all delays')
+            self.delays.clear()
+            self.events.record(events.DELAY_REMOVE, 0)
+            self._state_changed()
             return True
         else:
-            self.log("Removing delay file for station %d" % station)
-            delay_file_path = 'DELAY-%d' % station
-            if os.path.exists(delay_file_path):
-                os.remove(delay_file_path)
+            self.log("Removing delay for station %d" % station)
+            if self.delays.remove(station):
+                self.events.record(events.DELAY_REMOVE, station)
+                self._state_changed()
                 return True
             else:
                 return False
 
     def create_delay(self, station, hours):
         """
-        Creates a delay file for a specific station that expires after the number of hours passed
+        Creates a delay for a specific station that expires after the number of hours passed
         """
-        # Calculate what the datetime object will be by adding the current time
-        # and the number of hours to delay. This will be the body of the DELAY file.
-        expiration = arrow.utcnow().replace(hours=+hours).isoformat()
+        self._require_writable()
+        # The delay is kept as the epoch time it expires
+        expiration = int(clock.time()) + hours * 3600
 
-        # Write out the DELAY file and make the body the expiration time.
-        self.log("Creating delay file for station %d with expiration %s" % (station, expiration))
+        self.log("Creating delay for station %d with expiration %s" % (station, _isoformat(expiration)))
 
-        delay_file_path = os.path.join(CUR_DIR, 'DELAY-%d' % station)
-        with open(delay_file_path, 'w') as f:
-            f.write(expiration)
+        self.delays.set(station, expiration)
+        self.events.record(events.DELAY_CREATE, station, hours=hours, expires=expiration)
+        self._state_changed()
 
         return True
 
@@ -250,99 +526,272 @@ class OpenSprinkler():
         Creates a file called STANDBY in the root directory. This file
         prevents all station operations.
         """
-        standby_file_path = os.path.join(CUR_DIR, 'STANDBY')
+        self._require_writable()
+        standby_file_path = os.path.join(self.state_dir, 'STANDBY')
         
-        # If the file already exists, return false
-        if os.path.exists(standby_file_path):
+        # If we're already in standby, return false
+        if self.standby:
             return False
         else:
-            with open(standby_file_path, 'w') as f:
-                f.write('%s' % datetime.datetime.now())
+            self._in_background(standby_file_path, _write_standby_file, standby_file_path)
+            self.standby = True
+            self.events.record(events.STANDBY_CREATE)
+            self._state_changed()
             return True
 
     def remove_standby(self):
         """
         Removes the file called STANDBY in the root directory.
         """
-        standby_file_path = os.path.join(CUR_DIR, 'STANDBY')
-        if os.path.exists(standby_file_path):
-            os.remove(standby_file_path)
+        self._require_writable()
+        standby_file_path = os.path.join(self.state_dir, 'STANDBY')
+        if self.standby:
+            self._in_background(standby_file_path, _remove_standby_file, standby_file_path)
+            self.standby = False
+            self.events.record(events.STANDBY_REMOVE)
+            self._state_changed()
             return True
         else:
             return False
 
     def check_for_standby(self):
         """
-        Look at the filesystem to see if a STANDBY file exists.
+        Returns True if the system is in standby mode.
         """
-        standby_file_path = os.path.join(CUR_DIR, 'STANDBY')
-        return os.path.exists(standby_file_path)
+        return self.standby
 
     def check_for_delay(self, station):
         """
-        Look at the filesystem to see if a DELAY file exists for a station. If the
-        file does exist, open it up to see if it's expired. If so, remove the file.
+        Returns the expiration of the delay on a station, or None if there
+        isn't one.
+        """
+        expiration = self.delays.get(station)
+        if expiration is None:
+            return None
+        return _isoformat(expiration)
+
+    def _delay_expired(self, station):
+        """
+        Called by the delay manager when a delay runs out.
         """
-        delay_file_path = os.path.join(CUR_DIR, 'DELAY-%d' % station)
+        self.log("Delay for station %d has expired. Removing." % station)
+        self.events.record(events.DELAY_EXPIRE, station)
+        self._state_changed()
 
-        # If the delay file exists, see if it's valid
-        if os.path.exists(delay_file_path):
+    ### In-Memory State ###
 
-            # Read the file so we can inspect the contents
-            with open(delay_file_path, 'r') as f:
-                data = f.read()
+    def _load_state(self):
+        """
+        Reads the standby flag and delays left by a previous run. After this,
+        the state kept in memory is the authority and the files just mirror it.
+
+        The runs that were in progress when the previous run stopped are read
+        from the state file into saved_runs, so the server can resume them.
 
-            # The file might have a bad value. Check carefully.
+        A read-only controller reads the same files but leaves them as they
+        are: the server that owns them may be writing to them.
+        """
+        self.standby = os.path.exists(os.path.join(self.state_dir, 'STANDBY'))
+
+        # Everything is mirrored into one memory-mapped state file. Opened
+        # read-only, a missing file (or one for another number of stations)
+        # just means there is no saved state.
+        state_path = os.path.join(self.state_dir, 'state.bin')
+        try:
+            self.state_file = StateFile(state_path, self.number_of_stations, readonly=self.readonly)
+            saved = self.state_file.read()
+        except ValueError:
+            self.state_file = None
+            saved = None
+        self.saved_runs = saved['runs'] if saved else {}
+
+        # Delays are replayed from their journal. A reader lets delays that
+        # run out drop away without recording anything.
+        self.delays = DelayManager(os.path.join(self.state_dir, 'delays.journal'),
+            on_expire=None if self.readonly else self._delay_expired, readonly=self.readonly)
+
+        if self.readonly:
+            return
+
+        # Older versions kept each delay in its own DELAY-n file. Move any of
+        # those into the journal.
+        for file_name in os.listdir(self.state_dir):
+            if not file_name.startswith('DELAY-'):
+                continue
+            file_path = os.path.join(self.state_dir, file_name)
+
+            # The file might have a bad value. Check carefully. These are rare
+            # now, so arrow is only imported when one turns up.
+            import arrow
             try:
-                # Try to turn the body into a datetime object
-                expiration = arrow.get(data)
-                # If the expiration time is less than now (i.e. it has passed) remove the file
-                if arrow.utcnow() >= expiration:
-                    self.log("Found expired delay file for station %d. Removing." % station)
-                    os.remove(delay_file_path)
-                else:
-                    return expiration.isoformat()
-            except ValueError:
-                # If we can't cast the value of the file into a date object, there is
-                # no sense keeping the file around. Deleate it.
-                self.log("Could not read date in delay file. Removing file.")
-                os.remove(delay_file_path)
-                return None
-        else:
-            return None
+                station = int(file_name[len('DELAY-'):])
+                with open(file_path, 'r') as f:
+                    expiration = arrow.get(f.read()).timestamp
+                if expiration > clock.time():
+                    self.delays.set(station, expiration)
+            except (ValueError, arrow.parser.ParserError):
+                self.log("Could not read date in delay file %s. Removing file." % file_name)
+
+            os.remove(file_path)
+
+    def _state_changed(self):
+        """
+        Bumps the state version. Anything cached from the old state (like the
+        status snapshot) is rebuilt the next time it's asked for.
+        """
+        if self._batch_depth:
+            self._state_dirty = True
+            return
+        self.version += 1
+        self.state_file.write(self.station_bits, self.standby, self.runs, self.delays.expirations)
+        if not self.state_file.sync:
+            self._in_background(self.state_file.path, self.state_file.flush)
+        self.usage.save()
+        self.notify_listeners()
+
+    def notify_listeners(self):
+        """
+        Tells everything watching this controller (like /stream/) that its
+        state has changed.
+        """
+        for listener in self.listeners:
+            listener(self)
+
+    def get_status(self):
+        """
+        Returns a dictionary with the state ('running', 'delayed' or 'off') and
+        expiration for every station.
+        """
+        status = {}
+
+        for station_number in range(1, self.number_of_stations+1):
+            delay = self.check_for_delay(station_number)
+            if delay:
+                status[station_number] = { 'state': 'delayed', 'expires': delay }
+            elif self.is_running(station_number):
+                expiration = _isoformat(self.run_expiration(station_number))
+                status[station_number] = { 'state': 'running', 'expires': expiration }
+            else:
+                status[station_number] = { 'state': 'off', 'expires': None }
+
+        return status
+
+    def status_snapshot(self):
+        """
+        Returns (etag, json) for the current status. The JSON is only rebuilt
+        when the state version changes or a delay in it runs out.
+        """
+        if self._snapshot is not None:
+            version, valid_until, etag, body = self._snapshot
+            if version == self.version and (valid_until is None or clock.time() < valid_until):
+                return etag, body
+
+        # Building the status can expire delays, which bumps the version
+        status = self.get_status()
+
+        valid_until = self.delays.next_expiration()
+        etag = '"%s-%d"' % (self.pid, self.version)
+        body = json.dumps(status)
+        self._snapshot = (self.version, valid_until, etag, body)
+
+        return etag, body
 
     ### Logging ###
 
     def log(self, message):
-        now_time = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        msg = '%s\t\t%s\n' % (now_time, message)
-        file_path = os.path.join(CUR_DIR, 'log.txt')
-        print msg.strip()
-        with open(file_path, 'a') as f:
-            f.write('%s\t\t%s\n' % (now_time, message))
+        """
+        Queues a message for log.txt. The file is written in batches by a
+        background thread, so this never waits on the disk.
+        """
+        now_time = clock.now().strftime('%Y-%m-%d %H:%M:%S')
+        print '%s\t\t%s' % (now_time, message)
+        if self.logger is not None:
+            self.logger.write(message)
 
 
-    def __init__(self, debug=False, number_of_stations=8):
+    def __init__(self, debug=False, number_of_stations=8, controller_id='default',
+                 state_dir=CUR_DIR, pins=None, max_concurrency=1, master_station=None,
+                 max_runtimes=None, flow_rates=None, initialize_hardware=True):
 
         self.number_of_stations = number_of_stations
 
         # If debug is true, we print log messages to console
         self.debug = debug
 
+        # Each controller keeps its state files (pid, delays, standby, log)
+        # in its own directory and drives the shift registers on its own pins
+        self.controller_id = controller_id
+        self.state_dir = state_dir
+        self.pins = dict(DEFAULT_PINS, **(pins or {}))
+
+        # Without the hardware, the controller is only for looking at the
+        # state a server keeps. It opens every file read-only and refuses to
+        # change anything.
+        self.readonly = not initialize_hardware
+
+        if not self.readonly and not os.path.exists(self.state_dir):
+            os.makedirs(self.state_dir)
+
+        # Log messages are handed off to a background writer. A read-only
+        # controller only prints them.
+        self.logger = None
+        if not self.readonly:
+            self.logger = get_log_writer(os.path.join(self.state_dir, 'log.txt'))
+
+        # Every operation is also recorded as a structured event
+        self.events = events.EventStore(os.path.join(self.state_dir, 'events.db'),
+            readonly=self.readonly)
+
+        # Running totals of watering time and volume per station
+        self.usage = UsageTracker(os.path.join(self.state_dir, 'usage.json'), flow_rates)
+
         # We need to save the PID of the current process.
         self.pid = os.getpid()
 
-        # Initial values are zero (off) for all stations.
-        self.station_values = [0] * number_of_stations
+        # Initial values are zero (off) for all stations. Bit 0 is station 1.
+        self.station_bits = 0
+
+        # station -> (started, expires) epoch times for every running station
+        self.runs = {}
 
-        # When an operation runs, we store the time it will complete
-        self.current_operation_complete = None
+        # How many stations may run at once, and the station (if any) wired
+        # to a master valve or pump that must be on whenever any station is
+        self.max_concurrency = max_concurrency
+        self.master_station = master_station
+
+        # station -> the most minutes it may run for before the watchdog
+        # stops it. Stations not listed use the server's limit.
+        self.max_runtimes = dict(max_runtimes or {})
 
         # Keep a running status of the current stations
         self._update_status()
 
-        # Get the hardware ready for operations
-        self._initialize_hardware()
+        # Every change to the state below bumps the version, so anything
+        # derived from it knows when to rebuild
+        self.version = 0
+        self._snapshot = None
+
+        # Functions called with this controller whenever its state changes
+        self.listeners = []
+
+        # Blocking work runs right here until attach_executors() is called
+        self.hardware = None
+        self.files = None
+        self._hardware_pending = 0
+
+        # Operations between begin_batch() and end_batch() are applied at once
+        self._batch_depth = 0
+        self._runs_dirty = False
+        self._state_dirty = False
+
+        # Delays and standby live in memory; the files are read once here
+        self._load_state()
+
+        # Get the hardware ready for operations. Read-only controllers never
+        # touch the pins.
+        self.driver = None
+        if not self.readonly:
+            self._initialize_hardware()
 
 
 if __name__ == "__main__":
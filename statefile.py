@@ -0,0 +1,226 @@
+"""
+A fixed-layout binary file holding a controller's whole state: which
+stations are on, when each run started and expires, delays and standby. The
+file is memory-mapped, so updating it is a few stores into memory and
+reading it back at startup (or from another process) is just as cheap.
+
+Layout (little-endian):
+
+    header  magic 'NEPT', layout version, number of stations, slot size
+    slot 0  sequence, crc32, standby, station bitmap, one record per station
+    slot 1  the same
+
+Each station record is the run's start and expiration (doubles, 0 if not
+running) and the delay expiration (64-bit epoch seconds, 0 if none).
+
+Writes alternate between the two slots. A slot's sequence number is made odd
+before its body is written and even again once the body and its checksum are
+in place, so a reader (or a restart after a crash part way through a write)
+ignores a slot that is odd or fails its checksum and uses the other one.
+
+To look at a state file from the command line:
+
+    $ python statefile.py state.bin
+"""
+import json
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+MAGIC = 'NEPT'
+LAYOUT_VERSION = 1
+
+HEADER = struct.Struct('<4sHHI')
+SLOT_HEADER = struct.Struct('<QIB3x')
+STATION = struct.Struct('<ddq')
+
+# Whether every write is flushed to disk (msync) before returning
+SYNC_WRITES = True
+
+# How many times a reader retries a slot that is being written
+READ_RETRIES = 100
+
+
+class StateFile():
+    """
+    A memory-mapped state file for one controller.
+    """
+
+    def __init__(self, path, number_of_stations, sync=SYNC_WRITES, readonly=False):
+        self.path = path
+        self.number_of_stations = number_of_stations
+        self.sync = sync
+        self.readonly = readonly
+
+        self.bitmap_size = (number_of_stations + 7) // 8
+        self.slot_size = SLOT_HEADER.size + self.bitmap_size + STATION.size * number_of_stations
+        self.size = HEADER.size + 2 * self.slot_size
+
+        self.map = None
+        self.seq = 0
+        self._open()
+
+    def _open(self):
+        """
+        Maps the file, starting a new one if it's missing or was made for a
+        different number of stations.
+        """
+        fresh = True
+        if os.path.exists(self.path) and os.path.getsize(self.path) == self.size:
+            with open(self.path, 'rb') as f:
+                magic, version, stations, slot_size = HEADER.unpack(f.read(HEADER.size))
+            fresh = (magic, version, stations, slot_size) != \
+                (MAGIC, LAYOUT_VERSION, self.number_of_stations, self.slot_size)
+
+        if fresh and self.readonly:
+            raise ValueError('%s is not a state file for %d stations' % (self.path, self.number_of_stations))
+
+        if fresh:
+            temp_path = '%s.tmp' % self.path
+            with open(temp_path, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, LAYOUT_VERSION, self.number_of_stations, self.slot_size))
+                f.write('\0' * (2 * self.slot_size))
+            os.rename(temp_path, self.path)
+
+        f = open(self.path, 'rb' if self.readonly else 'r+b')
+        try:
+            if self.readonly:
+                self.map = mmap.mmap(f.fileno(), self.size, access=mmap.ACCESS_READ)
+            else:
+                self.map = mmap.mmap(f.fileno(), self.size)
+        finally:
+            f.close()
+
+        state = self.read()
+        self.seq = state['seq'] if state else 0
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    ### Writing ###
+
+    def write(self, station_bits, standby, runs, delays):
+        """
+        Stores a new state. `runs` maps stations to (started, expires) and
+        `delays` maps stations to their expiration.
+        """
+        seq = self.seq + 2
+        offset = HEADER.size + ((seq // 2) % 2) * self.slot_size
+
+        bitmap = bytearray(self.bitmap_size)
+        for i in range(self.bitmap_size):
+            bitmap[i] = (station_bits >> (8 * i)) & 0xff
+
+        records = []
+        for station in range(1, self.number_of_stations + 1):
+            started, expires = runs.get(station, (0, 0))
+            records.append(STATION.pack(started, expires, delays.get(station) or 0))
+
+        standby = 1 if standby else 0
+        payload = str(bitmap) + ''.join(records)
+        crc = zlib.crc32(chr(standby) + payload) & 0xffffffff
+
+        # Mark the slot as being written, fill it in, then mark it complete
+        self.map[offset:offset + 8] = struct.pack('<Q', seq - 1)
+        self.map[offset + 8:offset + self.slot_size] = struct.pack('<IB3x', crc, standby) + payload
+        self.map[offset:offset + 8] = struct.pack('<Q', seq)
+
+        if self.sync:
+            self.map.flush()
+
+        self.seq = seq
+
+    def flush(self):
+        """
+        Flushes the map to disk. Used when writes don't sync themselves.
+        """
+        self.map.flush()
+
+    ### Reading ###
+
+    def read(self):
+        """
+        Returns the newest complete state as a dictionary, or None if neither
+        slot holds one.
+        """
+        best = None
+        for slot in (0, 1):
+            state = self._read_slot(HEADER.size + slot * self.slot_size)
+            if state is not None and (best is None or state['seq'] > best['seq']):
+                best = state
+        return best
+
+    def _read_slot(self, offset):
+        for _ in range(READ_RETRIES):
+            seq, crc, standby = SLOT_HEADER.unpack(self.map[offset:offset + SLOT_HEADER.size])
+            if seq == 0:
+                return None
+            if seq % 2:
+                # A write is in progress (or was cut short by a crash)
+                continue
+
+            payload = self.map[offset + SLOT_HEADER.size:offset + self.slot_size]
+
+            # The slot could have been rewritten while we copied it
+            if struct.unpack('<Q', self.map[offset:offset + 8])[0] != seq:
+                continue
+
+            if zlib.crc32(chr(standby) + payload) & 0xffffffff != crc:
+                return None
+
+            return self._decode(seq, standby, payload)
+        return None
+
+    def _decode(self, seq, standby, payload):
+        bitmap = bytearray(payload[:self.bitmap_size])
+        station_bits = 0
+        for i, byte in enumerate(bitmap):
+            station_bits |= byte << (8 * i)
+
+        runs = {}
+        delays = {}
+        for station in range(1, self.number_of_stations + 1):
+            start = self.bitmap_size + (station - 1) * STATION.size
+            started, expires, delay = STATION.unpack(payload[start:start + STATION.size])
+            if expires:
+                runs[station] = (started, expires)
+            if delay:
+                delays[station] = delay
+
+        return {'seq': seq, 'station_bits': station_bits, 'standby': bool(standby),
+            'runs': runs, 'delays': delays}
+
+
+def read_state(path):
+    """
+    Reads a state file without knowing how many stations it was made for.
+    Returns None if there is no usable state in it.
+    """
+    with open(path, 'rb') as f:
+        magic, version, stations, slot_size = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC or version != LAYOUT_VERSION:
+        return None
+
+    try:
+        state_file = StateFile(path, stations, readonly=True)
+    except ValueError:
+        return None
+    try:
+        return state_file.read()
+    finally:
+        state_file.close()
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) != 2:
+        sys.exit('usage: python statefile.py <state file>')
+
+    state = read_state(sys.argv[1])
+    if state is None:
+        sys.exit('No state found in %s' % sys.argv[1])
+    print json.dumps(state, indent=2, sort_keys=True)
@@ -0,0 +1,114 @@
+import functools
+import json
+
+# How often an idle stream gets a comment line, in seconds, so proxies and
+# clients can tell the connection is still alive
+KEEPALIVE_INTERVAL = 15
+
+# A client that has this many events it hasn't read yet is disconnected
+# rather than letting them pile up in memory
+MAX_PENDING_EVENTS = 100
+
+
+class StreamHub():
+    """
+    Pushes state changes to /stream/ clients. Every controller tells the hub
+    when its state changes; the hub works out what's different (once per
+    IOLoop iteration, however many changes there were) and sends each
+    subscriber a delta. New log lines are sent as they are written.
+
+    Subscribers are objects with a send(event, data) method.
+    """
+
+    def __init__(self, registry, ioloop):
+        self.registry = registry
+        self.ioloop = ioloop
+
+        self.subscribers = set()
+
+        # The last state sent to subscribers, by controller id
+        self.states = {}
+
+        # Controller ids that have changed since the last publish
+        self._dirty = set()
+
+        for sprinkler in registry:
+            self.states[sprinkler.controller_id] = self._controller_state(sprinkler)
+            sprinkler.listeners.append(self._state_changed)
+
+            # Log lines are written by the writer thread, so hop back onto
+            # the IOLoop before touching the subscribers
+            sprinkler.logger.listeners.append(
+                functools.partial(self._lines_written, sprinkler.controller_id))
+
+    def subscribe(self, subscriber):
+        """
+        Adds a subscriber and sends it a snapshot of every controller.
+        """
+        self._publish()
+        self.subscribers.add(subscriber)
+        subscriber.send('snapshot', self.states)
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+
+    ### State ###
+
+    def _controller_state(self, sprinkler):
+        run_queue = getattr(sprinkler, 'run_queue', None)
+        return {
+            'stations': sprinkler.get_status(),
+            'standby': sprinkler.check_for_standby(),
+            'queue': run_queue.status() if run_queue else None,
+        }
+
+    def _state_changed(self, sprinkler):
+        if not self._dirty:
+            self.ioloop.add_callback(self._publish)
+        self._dirty.add(sprinkler.controller_id)
+
+    def _publish(self):
+        """
+        Sends a delta for every controller that changed. Only the stations
+        that changed are included.
+        """
+        dirty, self._dirty = self._dirty, set()
+
+        for controller_id in dirty:
+            state = self._controller_state(self.registry.get(controller_id))
+            previous = self.states[controller_id]
+            self.states[controller_id] = state
+
+            delta = {}
+            stations = dict((station, value) for station, value in state['stations'].items()
+                if previous['stations'].get(station) != value)
+            if stations:
+                delta['stations'] = stations
+            for key in ('standby', 'queue'):
+                if state[key] != previous[key]:
+                    delta[key] = state[key]
+
+            if delta:
+                delta['controller'] = controller_id
+                self._send('delta', delta)
+
+    ### Log Lines ###
+
+    def _lines_written(self, controller_id, lines):
+        self.ioloop.add_callback(self._send_lines, controller_id, lines)
+
+    def _send_lines(self, controller_id, lines):
+        for line in lines:
+            fields = line.rstrip('\n').split('\t')
+            self._send('log', {'controller': controller_id, 'date': fields[0], 'msg': fields[-1]})
+
+    def _send(self, event, data):
+        for subscriber in list(self.subscribers):
+            subscriber.send(event, data)
+
+
+def format_event(event, data):
+    """
+    Formats an event for a text/event-stream response.
+    """
+    return 'event: %s\ndata: %s\n\n' % (event, json.dumps(data))
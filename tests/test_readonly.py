@@ -0,0 +1,89 @@
+"""
+A controller opened with initialize_hardware=False looks at the state a
+running server keeps. It must not change any of the server's files.
+
+    $ python -m unittest discover tests
+"""
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+CUR_DIR = os.path.dirname(os.path.realpath(__file__))
+PARENT_DIR = os.path.abspath(os.path.join(CUR_DIR, os.pardir))
+
+# Add the parent dir to the search path
+sys.path.insert(0, PARENT_DIR)
+
+from logwriter import get_log_writer
+from sprinkler import OpenSprinkler
+
+
+class ReadOnlyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='neptune-test-')
+        self.state_dir = os.path.join(self.work_dir, 'default')
+
+        # The server has a delay in its journal, a station running and a
+        # delay file left by an older version
+        server = OpenSprinkler(state_dir=self.state_dir)
+        server.create_delay(3, 2)
+        server.operate_station(2, 10)
+        server.logger.flush()
+        with open(os.path.join(self.state_dir, 'DELAY-5'), 'w') as f:
+            f.write('2099-01-01T00:00:00+00:00')
+
+    def tearDown(self):
+        get_log_writer(os.path.join(self.state_dir, 'log.txt')).flush()
+        shutil.rmtree(self.work_dir)
+
+    def files(self):
+        """
+        The contents of every file in the state directory, leaving out the
+        shared memory SQLite's readers use to find their way around the
+        write-ahead log.
+        """
+        files = {}
+        for name in os.listdir(self.state_dir):
+            if name.endswith('-shm'):
+                continue
+            with open(os.path.join(self.state_dir, name), 'rb') as f:
+                files[name] = hashlib.md5(f.read()).hexdigest()
+        return files
+
+    def test_reads_state_without_writing(self):
+        before = self.files()
+        threads = threading.active_count()
+
+        sprinkler = OpenSprinkler(state_dir=self.state_dir, initialize_hardware=False)
+        self.assertEqual(sprinkler.get_status()[3]['state'], 'delayed')
+        self.assertEqual(sprinkler.saved_runs.keys(), [2])
+        self.assertEqual(sprinkler.events.query(limit=1)[0]['type'], 'operate')
+        sprinkler.cleanup()
+
+        # A state file made for another number of stations is left alone too
+        OpenSprinkler(state_dir=self.state_dir, number_of_stations=16, initialize_hardware=False)
+
+        self.assertEqual(self.files(), before)
+        self.assertEqual(threading.active_count(), threads)
+
+    def test_refuses_changes(self):
+        sprinkler = OpenSprinkler(state_dir=self.state_dir, initialize_hardware=False)
+        self.assertRaises(RuntimeError, sprinkler.operate_station, 1, 5)
+        self.assertRaises(RuntimeError, sprinkler.create_delay, 1, 2)
+        self.assertRaises(RuntimeError, sprinkler.create_standby)
+
+    def test_missing_state_dir(self):
+        state_dir = os.path.join(self.work_dir, 'missing')
+        sprinkler = OpenSprinkler(state_dir=state_dir, initialize_hardware=False)
+        self.assertFalse(os.path.exists(state_dir))
+        self.assertEqual(sprinkler.get_status()[1]['state'], 'off')
+        self.assertEqual(sprinkler.events.query(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+"""
+A server that restarts after a crash resumes the runs that were cut short.
+check_pids.py must leave those alone, while still catching runs left on by
+a server that nobody restarted.
+
+    $ python -m unittest discover tests
+"""
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+CUR_DIR = os.path.dirname(os.path.realpath(__file__))
+PARENT_DIR = os.path.abspath(os.path.join(CUR_DIR, os.pardir))
+
+# Add the parent dir (and the utilities) to the search path
+sys.path.insert(0, PARENT_DIR)
+sys.path.insert(0, os.path.join(PARENT_DIR, 'utilities'))
+
+import check_pids
+import clock
+import server
+from logwriter import get_log_writer
+from simulation import SimulatedIOLoop
+from sprinkler import OpenSprinkler
+
+
+def dead_pid():
+    """
+    Returns the pid of a process that has exited.
+    """
+    process = subprocess.Popen(['true'])
+    process.wait()
+    return process.pid
+
+
+class RestartTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='neptune-test-')
+        self.state_dir = os.path.join(self.work_dir, 'default')
+        self.heartbeat_path = check_pids.HEARTBEAT_FILE_PATH
+        check_pids.HEARTBEAT_FILE_PATH = os.path.join(self.work_dir, 'heartbeat.json')
+
+        # The first server starts station 2 and dies. Its pid file is left
+        # behind under a pid that no longer exists.
+        first = OpenSprinkler(state_dir=self.state_dir)
+        first.operate_station(2, 10)
+        first.logger.flush()
+        self.old_pid_file = os.path.join(self.state_dir, '%d.pid' % dead_pid())
+        os.rename(os.path.join(self.state_dir, '%d.pid' % os.getpid()), self.old_pid_file)
+
+    def tearDown(self):
+        check_pids.HEARTBEAT_FILE_PATH = self.heartbeat_path
+        get_log_writer(os.path.join(self.state_dir, 'log.txt')).flush()
+        shutil.rmtree(self.work_dir)
+
+    def write_heartbeat(self, pid, runs):
+        with open(check_pids.HEARTBEAT_FILE_PATH, 'w') as f:
+            json.dump({'pid': pid, 'time': clock.time(), 'controllers': {'default': {
+                'state_dir': self.state_dir, 'stations': 8, 'runs': runs}}}, f)
+
+    def restart(self):
+        """
+        Starts the controller the way server.py does.
+        """
+        sprinkler = OpenSprinkler(state_dir=self.state_dir)
+        sprinkler.ioloop = SimulatedIOLoop(clock.time())
+        sprinkler.timeouts = {}
+        sprinkler.reset_all_stations()
+        sprinkler.take_over_pid_files()
+        server.resume_runs(sprinkler)
+        sprinkler.logger.flush()
+        return sprinkler
+
+    def pid_files(self):
+        return sorted(name for name in os.listdir(self.state_dir) if name.endswith('.pid'))
+
+    def test_check_after_restart_leaves_resumed_runs(self):
+        sprinkler = self.restart()
+        self.assertTrue(sprinkler.is_running(2))
+        self.assertEqual(self.pid_files(), ['%d.pid' % os.getpid()])
+
+        # The restarted server is healthy and says so in its heartbeat
+        self.write_heartbeat(os.getpid(), {'2': list(sprinkler.runs[2])})
+
+        self.assertEqual(check_pids.check(), 0)
+        self.assertTrue(sprinkler.is_running(2))
+
+    def test_check_without_restart_turns_off(self):
+        # Nobody restarted the server, so the stations are turned off and its
+        # pid file removed
+        self.write_heartbeat(dead_pid(), {})
+
+        self.assertEqual(check_pids.check(), 1)
+        self.assertEqual(self.pid_files(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,213 @@
+"""
+Running totals of how long each station has watered, how many times it ran
+and roughly how much water it used, bucketed by hour, day and month.
+
+The totals are updated as stations start and stop, so answering a usage
+question means adding up a handful of buckets instead of reading the log.
+Volume is estimated from a flow rate per station (in whatever unit per
+minute you like, gallons or litres); stations without one report no volume.
+"""
+import datetime
+import json
+import os
+import time
+
+import clock
+
+PERIODS = ['hour', 'day', 'month']
+
+# The bucket key formats. Keys sort in time order and a date like
+# '2016-05' is a prefix of every key inside it.
+KEY_FORMATS = {
+    'hour': '%Y-%m-%dT%H',
+    'day': '%Y-%m-%d',
+    'month': '%Y-%m',
+}
+
+# With an IOLoop attached, the totals are saved this many seconds after they
+# first change, along with every change made in the meantime
+SAVE_DELAY = 10.0
+
+# How many of each bucket are kept. Months are kept forever.
+RETENTION = {
+    'hour': 24 * 62,
+    'day': 366 * 3,
+    'month': None,
+}
+
+
+def _hour_start(when):
+    """
+    Returns the epoch time of the start of the local hour containing `when`.
+    """
+    moment = datetime.datetime.fromtimestamp(when).replace(minute=0, second=0, microsecond=0)
+    return time.mktime(moment.timetuple())
+
+
+class UsageTracker():
+    """
+    Per-station usage for one controller, kept in memory and saved to a
+    small JSON file. Each bucket maps a station to [seconds, runs, volume].
+    """
+
+    def __init__(self, path, flow_rates=None):
+        self.path = path
+        self.flow_rates = flow_rates or {}
+
+        self.buckets = dict((period, {}) for period in PERIODS)
+        self.dirty = False
+
+        # If set, the file is written on this executor's threads
+        self.executor = None
+
+        # If set, saves wait for a timer on this IOLoop
+        self.ioloop = None
+        self._timeout = None
+
+        self._load()
+
+    ### Updating ###
+
+    def count_run(self, station, when=None):
+        """
+        Counts a run of a station, starting at `when`.
+        """
+        if when is None:
+            when = clock.time()
+        self._add(station, when, 0, 1)
+
+    def add_time(self, station, started, stopped):
+        """
+        Adds the time a station ran, split at hour boundaries so each bucket
+        only gets the part of the run that fell inside it.
+        """
+        while started < stopped:
+            boundary = _hour_start(started) + 3600
+            end = min(boundary, stopped)
+            self._add(station, started, end - started, 0)
+            started = end
+
+    def _add(self, station, when, seconds, runs):
+        moment = datetime.datetime.fromtimestamp(when)
+        volume = seconds / 60.0 * self.flow_rates.get(station, 0)
+        for period in PERIODS:
+            bucket = self.buckets[period].setdefault(moment.strftime(KEY_FORMATS[period]), {})
+            totals = bucket.setdefault(station, [0.0, 0, 0.0])
+            totals[0] += seconds
+            totals[1] += runs
+            totals[2] += volume
+        self.dirty = True
+
+    ### Querying ###
+
+    def query(self, period='day', station=None, start=None, end=None):
+        """
+        Returns the buckets for a period, oldest first. `start` and `end` are
+        dates like '2016-05-14' (or any prefix of one); `start` is inclusive
+        and so is `end`, along with everything inside it.
+        """
+        rows = []
+        for key in sorted(self.buckets[period]):
+            if start is not None and key < start:
+                continue
+            if end is not None and key[:len(end)] > end:
+                break
+
+            stations = {}
+            for number, (seconds, runs, volume) in self.buckets[period][key].items():
+                if station is None or number == station:
+                    stations[str(number)] = self._totals(number, seconds, runs, volume)
+            if not stations:
+                continue
+
+            row = {'start': key, 'stations': stations}
+            volumes = [totals['volume'] for totals in stations.values() if totals['volume'] is not None]
+            row['total'] = {
+                'seconds': round(sum(totals['seconds'] for totals in stations.values()), 1),
+                'runs': sum(totals['runs'] for totals in stations.values()),
+                'volume': round(sum(volumes), 2) if volumes else None,
+            }
+            rows.append(row)
+        return rows
+
+    def _totals(self, station, seconds, runs, volume):
+        return {
+            'seconds': round(seconds, 1),
+            'runs': runs,
+            'volume': round(volume, 2) if station in self.flow_rates else None,
+        }
+
+    ### Persistence ###
+
+    def attach(self, ioloop):
+        """
+        Save SAVE_DELAY seconds after a change rather than on every change.
+        Encoding every bucket is too much work to do each time a station
+        starts or stops.
+        """
+        self.ioloop = ioloop
+
+    def save(self):
+        """
+        Saves the totals if they have changed. With an IOLoop attached this
+        only starts the timer; call flush() to save straight away.
+        """
+        if not self.dirty:
+            return
+        if self.ioloop is None:
+            self.flush()
+        elif self._timeout is None:
+            self._timeout = self.ioloop.add_timeout(clock.time() + SAVE_DELAY, self.flush)
+
+    def flush(self):
+        """
+        Writes the totals out if they have changed, dropping buckets that
+        are past their retention.
+        """
+        if self._timeout is not None:
+            self.ioloop.remove_timeout(self._timeout)
+            self._timeout = None
+
+        if not self.dirty:
+            return
+
+        for period in PERIODS:
+            keep = RETENTION[period]
+            if keep is not None and len(self.buckets[period]) > keep:
+                for key in sorted(self.buckets[period])[:-keep]:
+                    del self.buckets[period][key]
+
+        # Stations are stored as strings since they're JSON object keys
+        data = dict((period, dict((key, dict((str(station), totals) for station, totals in bucket.items()))
+            for key, bucket in self.buckets[period].items())) for period in PERIODS)
+
+        # The totals keep changing, so they are encoded here and only the
+        # writing is handed off
+        text = json.dumps(data, separators=(',', ':'))
+        if self.executor is not None:
+            self.executor.submit(self._write, text, key=self.path)
+        else:
+            self._write(text)
+
+        self.dirty = False
+
+    def _write(self, text):
+        temp_path = '%s.tmp' % self.path
+        with open(temp_path, 'w') as f:
+            f.write(text)
+        os.rename(temp_path, self.path)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            buckets = dict((period, dict((key, dict((int(station), totals) for station, totals in bucket.items()))
+                for key, bucket in data.get(period, {}).items())) for period in PERIODS)
+        except (ValueError, AttributeError, TypeError):
+            # Start again rather than refuse to run
+            return
+
+        self.buckets = buckets
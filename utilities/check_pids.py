@@ -1,55 +1,200 @@
+"""
+A lightweight check for stations left running by a server that has died or
+hung. The server's own watchdog stops runaway stations while it is running;
+this covers the case where the server itself has stopped. Run it from cron:
+
+    * * * * * /path/to/python /path/to/code/utilities/check_pids.py
+
+It reads the heartbeat file the server writes and the .pid files of each
+controller. Nothing touches the GPIO pins unless a controller actually needs
+to be turned off, and even then only that controller's shift registers are
+written. If the server is still answering, it is asked to turn the stations
+off through its socket instead, so the pins keep a single owner.
+"""
+import calendar
+import datetime
+import errno
+import json
 import os
 import sys
-import datetime
+import time
 
 CUR_DIR = os.path.dirname(os.path.realpath(__file__))
 PARENT_DIR = os.path.abspath(os.path.join(CUR_DIR, os.pardir))
 
-# Add the parent dir to the search path so we can import config
+# Add the parent dir to the search path so we can use the driver, log writer
+# and the server's socket. They're only imported when something has to be
+# turned off, so the usual run (nothing to do) starts quickly.
 sys.path.insert(0, PARENT_DIR)
-from sprinkler import OpenSprinkler
 
-# Look in the main directory for any files that end in .pid. The name of 
-# the file represents the pid of any running Sprinkler programs
-pid_files = [f for f in os.listdir(PARENT_DIR) if f.endswith('.pid')]
+HEARTBEAT_FILE_PATH = os.path.join(PARENT_DIR, 'heartbeat.json')
+
+# If the heartbeat is older than this many seconds, the server is treated as
+# hung even if its process is still there
+STALE_SECONDS = 60
+
+# How long past its expiration a .pid file can be before the stations are
+# turned off, in seconds. This leaves the server time to stop them itself.
+GRACE_SECONDS = 60
+
+# Without a heartbeat there is just the default controller to check
+DEFAULT_STATIONS = 8
+
+
+def read_heartbeat():
+    """
+    Returns the contents of the heartbeat file, or None.
+    """
+    try:
+        with open(HEARTBEAT_FILE_PATH, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
 
-needs_cleanup = False
-old_pid_files = []
+def write_heartbeat(heartbeat):
+    temp_path = '%s.tmp' % HEARTBEAT_FILE_PATH
+    with open(temp_path, 'w') as f:
+        json.dump(heartbeat, f)
+    os.rename(temp_path, HEARTBEAT_FILE_PATH)
 
-# Look through any pid files we found and see if they are older than the 
-# expiration time they contain. If any files older than the max age 
-# allowed are found, we'll flag them and run some cleanup.
-for file_name in pid_files:
 
-    file_path = os.path.join(PARENT_DIR, file_name)
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
 
-    # Read the contents of the file to find out when it expires
-    with open(file_path, 'r') as f:
-        data = f.read()
+
+def parse_expiration(data):
+    """
+    Turns the expiration in a .pid file into epoch seconds. The server writes
+    epoch seconds; older versions wrote an ISO 8601 UTC timestamp
+    (2016-05-14T22:09:48.172993+00:00). Returns None if it can't be read.
+    """
+    data = data.strip()
+    if data.isdigit():
+        return int(data)
 
     try:
-        expiration = datetime.datetime.strptime(data, '%Y-%m-%d %H:%M')
+        when = datetime.datetime.strptime(data[:19], '%Y-%m-%dT%H:%M:%S')
     except ValueError:
-        # If the file contains badly formatted data, the best thing to do is 
-        # assume the worst and close all stations, then remove the file.
-        expiration = datetime.datetime.now() - datetime.timedelta(minutes=10)
-
-    if datetime.datetime.now() >= expiration:
-        needs_cleanup = True
-        old_pid_files.append(file_path)
-
-# If we found any old files, we need to delete the file and turn the system off
-# in case it's errantly running.
-if not needs_cleanup:
-    sys.exit("No old PID files found. Aborting.")
-
-# If we got here, we should ensure that all stations are turned off.
-sprinkler = OpenSprinkler(debug=True, number_of_stations=8)
-sprinkler.log('Error! Found PID file past its expiration.')
-sprinkler.reset_all_stations()
-
-# Any old files we found should be removed now that we've finished our 
-# housekeeping.
-for old_file in old_pid_files:
-    print "Deleting File: %s" % old_file
-    os.remove(old_file)
+        return None
+    return calendar.timegm(when.timetuple())
+
+
+def stale_pid_files(state_dir, now):
+    """
+    Returns (overdue, orphaned): the .pid files in a directory whose
+    expiration has passed (or can't be read), and the others whose server
+    process is gone.
+    """
+    overdue = []
+    orphaned = []
+    for file_name in os.listdir(state_dir):
+        if not file_name.endswith('.pid'):
+            continue
+        file_path = os.path.join(state_dir, file_name)
+        with open(file_path, 'r') as f:
+            expiration = parse_expiration(f.read())
+
+        # If the file contains badly formatted data, the best thing to do is
+        # assume the worst
+        if expiration is None or now >= expiration + GRACE_SECONDS:
+            overdue.append(file_path)
+        elif file_name[:-len('.pid')].isdigit() and not process_alive(int(file_name[:-len('.pid')])):
+            orphaned.append(file_path)
+    return overdue, orphaned
+
+
+def turn_off(controller_id, controller, reason, server_ok=False):
+    """
+    Turns off every station on a controller and logs why. A server that is
+    still answering is asked to do it; otherwise zeros are written to the
+    controller's shift registers.
+    """
+    from localclient import ServerError, ServerUnavailable, get_client
+    from logwriter import get_log_writer
+    from shiftregister import ShiftRegisterDriver, resolve_pins
+
+    logger = get_log_writer(os.path.join(controller['state_dir'], 'log.txt'))
+    message = 'Error! %s. Turning off all stations on controller %s.' % (reason, controller_id)
+    print message
+    logger.write(message)
+
+    if server_ok:
+        try:
+            get_client().station_off(0, controller=controller_id)
+            return
+        except (ServerError, ServerUnavailable), e:
+            message = 'Server could not turn off the stations (%s). Writing to the pins directly.' % e
+            print message
+            logger.write(message)
+
+    pins = resolve_pins(controller.get('pins'))
+    driver = ShiftRegisterDriver(controller['stations'], clock_pin=pins['clock'],
+        latch_pin=pins['latch'], data_pin=pins['data'], enable_pin=pins['enable'])
+    driver.setup()
+    driver.write(0, force=True)
+    driver.enable_output()
+
+
+def check(now=None):
+    """
+    Turns off any controller that has stations running with nobody to stop
+    them. Returns the number of controllers turned off.
+    """
+    if now is None:
+        now = time.time()
+
+    heartbeat = read_heartbeat()
+
+    if heartbeat is None:
+        server_ok = False
+        controllers = {'default': {'state_dir': PARENT_DIR, 'stations': DEFAULT_STATIONS, 'runs': {}}}
+    else:
+        server_ok = process_alive(heartbeat['pid']) and now - heartbeat['time'] < STALE_SECONDS
+        controllers = heartbeat['controllers']
+
+    turned_off = 0
+    for controller_id, controller in sorted(controllers.items()):
+        reasons = []
+
+        # Stations the server had running the last time it checked in
+        if controller.get('runs') and not server_ok:
+            reasons.append('Server is not responding with stations running')
+
+        # A .pid file past its expiration means a station wasn't stopped, and
+        # one left by a dead server means nothing will stop it
+        overdue, orphaned = stale_pid_files(controller['state_dir'], now)
+        if overdue:
+            reasons.append('Found PID file past its expiration')
+        if orphaned:
+            reasons.append('Found PID file left by a server that is no longer running')
+
+        if not reasons:
+            continue
+
+        turn_off(controller_id, controller, '; '.join(reasons), server_ok)
+        turned_off += 1
+        controller['runs'] = {}
+
+        # Any old files we found should be removed now that we've finished
+        # our housekeeping
+        for old_file in overdue + orphaned:
+            print "Deleting File: %s" % old_file
+            os.remove(old_file)
+
+    # Record that the stations are off so they aren't turned off again on the
+    # next run. A server that was only hung rewrites this when it recovers.
+    if turned_off and heartbeat is not None and not server_ok:
+        write_heartbeat(heartbeat)
+
+    return turned_off
+
+
+if __name__ == "__main__":
+
+    if not check():
+        sys.exit("No runaway stations found.")
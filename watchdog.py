@@ -0,0 +1,132 @@
+import json
+import os
+
+import tornado.ioloop
+
+import clock
+
+# How often the watchdog checks the running stations, in seconds
+WATCHDOG_INTERVAL = 5
+
+# How long past its expiration a station can run before the watchdog decides
+# its timer has gone missing and stops it, in seconds
+GRACE_SECONDS = 10
+
+# The heartbeat is written on every check while anything is running, and at
+# least this often (in seconds) while the controllers are idle
+HEARTBEAT_IDLE_INTERVAL = 60
+
+
+class Watchdog():
+    """
+    Checks every controller's running stations from a periodic IOLoop
+    callback and stops any that have:
+
+        * run longer than their maximum runtime (`max_runtimes` on the
+          controller, in minutes, or `max_minutes` for stations without one)
+        * run more than GRACE_SECONDS past the time they were due to stop
+
+    It also makes sure the shift registers hold what the run records say
+    they should. Stations are stopped with `stop_station(sprinkler, station)`
+    so timers and programs are cleaned up the same way as any other stop.
+
+    After every check a heartbeat file is written describing the running
+    stations and the board each controller is on, so a sidecar
+    (utilities/check_pids.py) can turn them off if the server dies or hangs.
+    """
+
+    def __init__(self, registry, ioloop, stop_station, heartbeat_path, max_minutes,
+                 interval=WATCHDOG_INTERVAL, executor=None):
+        self.registry = registry
+        self.ioloop = ioloop
+        self.stop_station = stop_station
+        self.heartbeat_path = heartbeat_path
+        self.max_minutes = max_minutes
+        self.interval = interval
+
+        # If set, the heartbeat is written on this executor's threads
+        self.executor = executor
+
+        self.heartbeat_written = 0
+        self._checker = None
+
+    def start(self):
+        self._checker = tornado.ioloop.PeriodicCallback(self.check, self.interval * 1000,
+            io_loop=self.ioloop)
+        self._checker.start()
+        self.check()
+
+    def stop(self):
+        if self._checker is not None:
+            self._checker.stop()
+            self._checker = None
+
+    def check(self):
+        now = clock.time()
+
+        for sprinkler in self.registry:
+            for station, (started, expires) in sorted(sprinkler.runs.items()):
+                max_minutes = sprinkler.max_runtimes.get(station, self.max_minutes)
+                if now - started > max_minutes * 60:
+                    sprinkler.log('Watchdog: station %d has run for more than %d minutes. Stopping it.' %
+                        (station, max_minutes))
+                    self.stop_station(sprinkler, station)
+                elif now > expires + GRACE_SECONDS:
+                    sprinkler.log('Watchdog: station %d was due to stop %d seconds ago. Stopping it.' %
+                        (station, now - expires))
+                    self.stop_station(sprinkler, station)
+
+            # The registers should hold exactly what the run records say, once
+            # any writes on their way to them have been made
+            if not sprinkler.hardware_busy and sprinkler.driver.bits != sprinkler.station_bits:
+                sprinkler.log('Watchdog: shift registers out of step with the stations. Rewriting them.')
+                sprinkler.rewrite_shift_registers()
+
+        running = any(sprinkler.runs for sprinkler in self.registry)
+        if running or now - self.heartbeat_written >= HEARTBEAT_IDLE_INTERVAL:
+            self.write_heartbeat(now)
+
+    def write_heartbeat(self, now=None):
+        """
+        Writes the heartbeat file: when it was written, by which process, and
+        for each controller its board, state directory and running stations.
+        """
+        if now is None:
+            now = clock.time()
+
+        controllers = {}
+        for sprinkler in self.registry:
+            controllers[sprinkler.controller_id] = {
+                'state_dir': sprinkler.state_dir,
+                'stations': sprinkler.number_of_stations,
+                'pins': {'clock': sprinkler.PIN_SR_CLK, 'enable': sprinkler.PIN_SR_NOE,
+                         'latch': sprinkler.PIN_SR_LAT, 'data': sprinkler.PIN_SR_DAT},
+                'runs': dict((str(station), expires) for station, (started, expires) in sprinkler.runs.items()),
+            }
+
+        heartbeat = {'pid': os.getpid(), 'time': now, 'interval': self.interval,
+            'controllers': controllers}
+
+        # Encoded here, written in order with the other heartbeat writes
+        text = json.dumps(heartbeat)
+        if self.executor is not None:
+            self.executor.submit(self._write, text, key=self.heartbeat_path)
+        else:
+            self._write(text)
+
+        self.heartbeat_written = now
+
+    def _write(self, text):
+        temp_path = '%s.tmp' % self.heartbeat_path
+        with open(temp_path, 'w') as f:
+            f.write(text)
+        os.rename(temp_path, self.heartbeat_path)
+
+    def remove_heartbeat(self):
+        """
+        Removes the heartbeat file when the server shuts down cleanly.
+        """
+        if self.executor is not None:
+            self.executor.drain()
+        if os.path.exists(self.heartbeat_path):
+            os.remove(self.heartbeat_path)